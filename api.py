@@ -1,33 +1,69 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Callable, List, Optional
 import yaml
 import os
-from services.image_search import IMAGE_SEARCH_SERVICE
+from services.image_search import IMAGE_SEARCH_SERVICE, InvalidSearchRequest
 
 from config.settings import Config
 from config.api_settings import load_config
-from services.community_service import CommunityService
+from services.community_manifest import COMMUNITY_MANIFESTS
+from services.thumbnail import THUMBNAIL_SERVICE
+from services.search_executor import SearchExecutor, SearchQueueFull
+from services.response_cache import RESPONSE_CACHE
+from services.image_server import ImageServer
+from services.metrics import METRICS, SEARCH_STAGE_SECONDS
 
 import uvicorn
 
-from middleware.protected_mode import ProtectedModeMiddleware
-from middleware.rate_limiter import RateLimitMiddleware
+from middleware.guard import RequestGuardMiddleware
+from middleware.admission import AdmissionControlMiddleware, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 import re
 import json
+import time
 
 # 初始化核心组件
 config = Config()
 search_engine = IMAGE_SEARCH_SERVICE
 api_config = load_config() 
 app = FastAPI(title="VVQuest API")
+# 阻塞的搜索在专用线程池中执行，不占用事件循环
+search_executor = SearchExecutor(**api_config.search_executor.dict())
+# 按sha256提供已启用资源包中的图片和缩略图
+image_server = ImageServer(lambda: search_engine.resource_pack_manager.get_enabled_packs())
 
-# 注册保护模式中间件
-if api_config.protected_mode:
-    app.add_middleware(ProtectedModeMiddleware, config=api_config)
+@app.on_event("startup")
+async def start_background_jobs():
+    # 社区manifest在后台刷新，/libs_manifest只读取快照
+    COMMUNITY_MANIFESTS.start_background_refresh()
 
-if api_config.rate_limit.enabled:
-    app.add_middleware(RateLimitMiddleware, config=api_config)
+def classify_request(path: str, body: Optional[bytes]):
+    """准入控制：返回请求的(代价, 优先级)，ai_search的搜索代价高、优先级低，嵌入已缓存的搜索优先"""
+    cost = api_config.admission.route_costs.get(path, 0)
+    if not cost or body is None:
+        return cost, PRIORITY_NORMAL
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return cost, PRIORITY_NORMAL
+    if not isinstance(request, dict):
+        return cost, PRIORITY_NORMAL
+    if request.get("ai_search"):
+        return api_config.admission.ai_search_cost, PRIORITY_LOW
+    query = request.get("query")
+    if isinstance(query, str) and search_engine.embedding_service.has_cached_embedding(query, request.get("model")):
+        return cost, PRIORITY_HIGH
+    return cost, PRIORITY_NORMAL
+
+# 准入控制在最内层，先经过保护模式和限流
+if api_config.admission.enabled:
+    app.add_middleware(AdmissionControlMiddleware, config=api_config, classifier=classify_request,
+                       body_paths=["/search", "/search/stream"])
+
+# 限流和保护模式合并为一层中间件
+if api_config.protected_mode or api_config.rate_limit.enabled:
+    app.add_middleware(RequestGuardMiddleware, config=api_config)
 
 # 数据模型定义
 class SearchRequest(BaseModel):
@@ -37,6 +73,8 @@ class SearchRequest(BaseModel):
 class SearchRequestEnhanced(SearchRequest):
     resource_pack_uuids: List[str] = []  # 添加默认空列表
     ai_search: bool = False
+    model: Optional[str] = None  # 嵌入模型，默认使用当前模型
+    thumbnail_size: Optional[int] = None  # 返回缩略图而不是原图，取不小于该值的固定尺寸
 
 class ConfigUpdate(BaseModel):
     api_key: Optional[str] = None
@@ -45,28 +83,55 @@ class ConfigUpdate(BaseModel):
 class ModelDownloadRequest(BaseModel):
     model_id: str
 
-def search_result_postprocess(results:List[str]):
+def to_thumbnail_results(results: List, size: int) -> List:
+    """把搜索结果替换为缩略图，hash模式下文件名为 <hash>_<尺寸>.webp"""
     ret = []
     for v in results:
-        if api_config.urls.return_type == "abs_path":
-            pass
-        elif api_config.urls.return_type == "rel_path":
-            v = os.path.relpath(v, Config().base_dir)
-        elif api_config.urls.return_type == "sha256":
-            v = v[1] + os.path.splitext(os.path.basename(v[0]))[1]  # 假设v是一个元组，v[1]是sha256，v[0]是文件名
-        reg_pattern = api_config.urls.path_replace_regex
-        if reg_pattern:
-            v = re.sub(reg_pattern, "", v)
-
-        if api_config.urls.url_prefix:
-            v = f'{api_config.urls.url_prefix}/{v}'
-        if api_config.urls.url_postfix:
-            if not v.endswith(api_config.urls.url_postfix):
-                v = f'{v}/{api_config.urls.url_prefix}'
-
+        if isinstance(v, list):
+            thumbnail_path = THUMBNAIL_SERVICE.get_thumbnail(v[0], size, v[1])
+            if thumbnail_path != v[0]:
+                v = [thumbnail_path, os.path.splitext(os.path.basename(thumbnail_path))[0]]
+        else:
+            v = THUMBNAIL_SERVICE.get_thumbnail(v, size)
         ret.append(v)
     return ret
 
+def build_result_formatter(urls) -> Callable[[str, Optional[str]], str]:
+    """
+    根据api_config.urls生成计算对外URL/标识的函数，参数为(图片路径, sha256)。
+    配置只读取一次，正则预先编译，资源包向量加载时对每行调用一次。
+    """
+    return_type = urls.return_type
+    base_dir = Config().base_dir
+    pattern = re.compile(urls.path_replace_regex) if urls.path_replace_regex else None
+    prefix = f'{urls.url_prefix}/' if urls.url_prefix else ''
+    postfix = urls.url_postfix
+    postfix_suffix = f'/{urls.url_prefix}'
+
+    def format_result(path: str, file_hash: Optional[str]) -> str:
+        if return_type == "rel_path":
+            v = os.path.relpath(path, base_dir)
+        elif return_type == "sha256" and file_hash:
+            v = file_hash + os.path.splitext(path)[1]
+        else:
+            v = path
+        if pattern is not None:
+            v = pattern.sub("", v)
+        v = prefix + v
+        if postfix and not v.endswith(postfix):
+            v += postfix_suffix
+        return v
+
+    return format_result
+
+format_result = build_result_formatter(api_config.urls)
+# 每行的对外URL在加载资源包向量时预先计算，搜索时直接取出
+search_engine.set_result_formatter(format_result)
+
+def search_result_postprocess(results: List) -> List[str]:
+    """缩略图等搜索后才确定的结果，逐条计算对外URL"""
+    return [format_result(v[0], v[1]) if isinstance(v, list) else format_result(v, None) for v in results]
+
 # API 端点
 # @app.post("/search")
 # async def search_images(request: SearchRequest):
@@ -81,20 +146,84 @@ def search_result_postprocess(results:List[str]):
 #     except Exception as e:
 #         raise HTTPException(status_code=500, detail=str(e))
 
+def run_search(request: SearchRequestEnhanced) -> List:
+    """在搜索线程池中执行，包含嵌入请求、图片去重、缩略图等所有阻塞操作"""
+    results = search_engine.search(
+        request.query,
+        request.n_results,
+        request.resource_pack_uuids,
+        api_key = config.api.embedding_models.api_key,
+        use_llm = request.ai_search,
+        return_type = "hash" if request.thumbnail_size else "public",
+        model_name = request.model
+    )
+    # 默认返回的URL在加载资源包时已计算好，同样记录postprocess，各阶段的计数与搜索次数一致
+    with SEARCH_STAGE_SECONDS.time("postprocess"):
+        if request.thumbnail_size:
+            return search_result_postprocess(to_thumbnail_results(results, request.thumbnail_size))
+        return results
+
+def run_search_stream(request: SearchRequestEnhanced):
+    """在搜索线程池中创建流式搜索，结果事件中的result已转换为对外的URL"""
+    events = search_engine.search_stream(
+        request.query,
+        request.n_results,
+        request.resource_pack_uuids,
+        api_key = config.api.embedding_models.api_key,
+        use_llm = request.ai_search,
+        return_type = "hash" if request.thumbnail_size else "public",
+        model_name = request.model
+    )
+    return postprocess_events(events, request.thumbnail_size)
+
+def postprocess_events(events, thumbnail_size: Optional[int]):
+    """逐条转换结果事件，累计的postprocess耗时在done事件时记录一次"""
+    seconds = 0.0
+    for event in events:
+        if event["event"] == "result":
+            started = time.perf_counter()
+            if thumbnail_size:
+                event = {**event, "result": search_result_postprocess(to_thumbnail_results([event["result"]], thumbnail_size))[0]}
+            seconds += time.perf_counter() - started
+        elif event["event"] == "done":
+            SEARCH_STAGE_SECONDS.observe(seconds, "postprocess")
+        yield event
+
+@app.post("/search/stream")
+async def search_images_stream(request: SearchRequestEnhanced):
+    """流式搜索，以NDJSON逐行返回阶段耗时和结果，本地已有的结果先返回"""
+    try:
+        events = await search_executor.stream(run_search_stream, request)
+    except SearchQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except InvalidSearchRequest as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(ndjson_lines(events), media_type="application/x-ndjson")
+
+async def ndjson_lines(events):
+    """
+    逐行输出事件。响应头已经发出，迭代中的异常无法再改为500，
+    改为输出最后一行error事件，客户端可以区分出错和正常结束
+    """
+    try:
+        async for event in events:
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    except Exception as e:
+        yield json.dumps({"event": "error", "detail": str(e)}, ensure_ascii=False) + "\n"
+    finally:
+        await events.aclose()
+
 @app.post("/search")
 async def search_images(request: SearchRequestEnhanced):
     """执行图片搜索"""
     try:
-        results = search_engine.search(
-            request.query,
-            request.n_results,
-            request.resource_pack_uuids,
-            api_key = config.api.embedding_models.api_key,
-            use_llm = request.ai_search,
-            return_type = "hash" if api_config.urls.return_type == "sha256" else "default"
-        )
-
-        return {"results": search_result_postprocess(results)}
+        return {"results": await search_executor.run(run_search, request)}
+    except SearchQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except InvalidSearchRequest as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -104,22 +233,18 @@ async def root():
     return {"message": "Welcome to the VVQuest API"}
 
 @app.get("/libs_manifest")
-async def get_libs_manifest():
-    
-    manifest_path = os.path.join(Config().temp_dir, "all_manifest.json")
-    if not os.path.exists(manifest_path):
-        CommunityService().reload_community_info()
-    
-    try:
-        with open(manifest_path, 'r', encoding='utf-8') as f:
-            manifest_data = json.load(f)
-        return manifest_data
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="Manifest file not found")
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=500, detail="Invalid JSON format in manifest file")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_libs_manifest(request: Request):
+    """社区资源包列表，只读取后台刷新的快照，不在请求中下载；快照不变时返回缓存的字节或304"""
+    COMMUNITY_MANIFESTS.start_background_refresh()
+    version, manifest_data = COMMUNITY_MANIFESTS.versioned_snapshot()
+    if manifest_data is None:
+        raise HTTPException(status_code=503, detail="Manifest is not ready yet", headers={"Retry-After": "5"})
+    return RESPONSE_CACHE.respond(request, "libs_manifest", version, lambda: manifest_data)
+
+@app.get("/img/{name}")
+async def get_image(name: str, request: Request):
+    """按sha256获取图片，<hash>.<扩展名>为原图，<hash>_<尺寸>.webp为缩略图"""
+    return await image_server.respond(request, name)
 
 @app.post("/generate-cache")
 async def generate_cache(background_tasks: BackgroundTasks):
@@ -130,23 +255,38 @@ async def generate_cache(background_tasks: BackgroundTasks):
     return {"message": "Cache already exists"}
 
 @app.get("/config")
-async def get_config():
+async def get_config(request: Request):
     """获取当前配置"""
-    return {
+    current = {
         # "mode": search_engine.get_mode(),
         "model": search_engine.get_model_name(),
+        "loaded_models": search_engine.get_loaded_models(),
         "api_key": search_engine.embedding_service.api_key,
         "base_url": search_engine.embedding_service.base_url
     }
+    version = (current["model"], tuple(current["loaded_models"]), current["api_key"], current["base_url"])
+    return RESPONSE_CACHE.respond(request, "config", version, lambda: current)
+
+@app.get("/admin/index")
+async def get_index_status():
+    """获取资源包向量的加载状态"""
+    return search_engine.get_index_status()
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus格式的指标"""
+    return Response(METRICS.render(), media_type=METRICS.CONTENT_TYPE)
+
+@app.get("/admin/search")
+async def get_search_status():
+    """获取搜索线程池的排队和执行情况"""
+    return search_executor.status()
 
 @app.put("/api-config")
 async def update_config(update: ConfigUpdate):
     """更新API配置"""
     try:
-        if update.api_key:
-            search_engine.embedding_service.api_key = update.api_key
-        if update.base_url:
-            search_engine.embedding_service.base_url = update.base_url
+        search_engine.embedding_service.set_api(update.api_key, update.base_url)
         config.save()
         return {"message": "Config updated successfully"}
     except Exception as e:
@@ -178,9 +318,9 @@ async def update_config(update: ConfigUpdate):
 
 
 if __name__ == "__main__":
-    search_engine.embedding_service.api_key = api_config.api_mode_config.default_api_key
-    search_engine.embedding_service.base_url = api_config.api_mode_config.default_base_url
-    # search_engine.set_mode('api')
+    search_engine.embedding_service.set_api(api_config.api_mode_config.default_api_key,
+                                            api_config.api_mode_config.default_base_url)
+    search_engine.set_mode(api_config.model)
     if api_config.generate_cache:
         search_engine.generate_cache()
     print("Starting API server...")
@@ -20,4 +20,13 @@ def remove_invalid_filename_chars(filename):
     # 定义正则表达式，匹配Windows文件名中不支持的字符
     pattern = r'[\\/*?:"<>|]'
     # 使用空字符串替换匹配到的字符
-    return re.sub(pattern, ' ', filename)
\ No newline at end of file
+    return re.sub(pattern, ' ', filename)
+
+def safe_join(root, relpath):
+    # 拼接资源包内的相对路径，结果（解析符号链接后）不在root之内时返回None，防止../和绝对路径逃逸
+    path = os.path.join(root, relpath)
+    real_root = os.path.realpath(root)
+    real_path = os.path.realpath(path)
+    if real_path == real_root or os.path.commonpath([real_root, real_path]) != real_root:
+        return None
+    return path
@@ -0,0 +1,156 @@
+"""
+中间件开销基准测试：对比旧的BaseHTTPMiddleware实现和现在合并为一层的纯ASGI实现，
+以及不限流的路径（exempt_paths）和Redis计数（安装了fakeredis时）两个分支。
+直接调用ASGI应用，不经过网络，输出每个请求的平均耗时和相对于无中间件的额外开销。
+几种配置交替运行多轮，取每种配置的中位数，减少机器负载波动的影响；
+单轮的结果波动可达几十微秒，比较时请看多轮的中位数。
+
+    python benchmarks/bench_middleware.py [-n 每轮请求数] [-r 轮数]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from middleware.guard import RequestGuardMiddleware
+from middleware.rate_limiter import RateLimiter, RedisRateLimiter
+
+
+class LegacyProtectedModeMiddleware(BaseHTTPMiddleware):
+    """改写前的实现，每个请求重新生成白名单列表"""
+
+    def __init__(self, app, config):
+        super().__init__(app)
+        self.config = config
+
+    async def dispatch(self, request: Request, call_next):
+        if self.config.protected_mode:
+            path = request.url.path.rstrip('/')
+            allowed_paths = [p.rstrip('/') for p in self.config.allowed_endpoints]
+            if path in allowed_paths:
+                return await call_next(request)
+            return JSONResponse(status_code=403, content={"detail": f"Protected mode blocked request to {path}"})
+        return await call_next(request)
+
+
+class LegacyRateLimitMiddleware(BaseHTTPMiddleware):
+    """改写前的实现（计数器使用现在的RateLimiter，只比较中间件本身的开销）"""
+
+    def __init__(self, app, config):
+        super().__init__(app)
+        self.config = config
+        self.ratelimiter = RateLimiter()
+
+    async def dispatch(self, request: Request, call_next):
+        if not self.config.rate_limit.enabled:
+            return await call_next(request)
+        if not self.ratelimiter.check(request.client.host, self.config.rate_limit.requests,
+                                      self.config.rate_limit.window):
+            return JSONResponse(status_code=429, content={"detail": "Requests are too frequent"})
+        return await call_next(request)
+
+
+def make_config():
+    return SimpleNamespace(
+        protected_mode=True,
+        allowed_endpoints=["/search", "/libs_manifest", "/", "/img/*", "/metrics"],
+        rate_limit=SimpleNamespace(enabled=True, requests=10 ** 9, window=60, storage="memory",
+                                   exempt_paths=["/metrics"], redis=None),
+    )
+
+
+def make_app():
+    app = FastAPI()
+
+    @app.get("/search")
+    async def search():
+        return {"results": []}
+
+    @app.get("/metrics")
+    async def metrics():
+        return {}
+
+    return app
+
+
+def legacy_stack():
+    config = make_config()
+    return LegacyRateLimitMiddleware(LegacyProtectedModeMiddleware(make_app(), config=config), config=config)
+
+
+def guard_stack():
+    return RequestGuardMiddleware(make_app(), make_config())
+
+
+def redis_guard_stack():
+    """
+    Redis计数的分支，使用fakeredis代替真实的Redis执行Lua脚本。
+    只用于覆盖这个分支，耗时主要是fakeredis模拟Lua的开销，不代表真实Redis的延迟
+    """
+    import fakeredis
+    guard = guard_stack()
+    guard.limiter.ratelimiter = RedisRateLimiter(client=fakeredis.aioredis.FakeRedis())
+    guard.limiter._async = True
+    return guard
+
+
+async def run(factory, path: str, n: int) -> float:
+    app = factory()
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+             "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 50000), "server": ("bench", 80)}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    # 预热，包括构建中间件栈
+    for _ in range(200):
+        await app(dict(scope), receive, send)
+    started = time.perf_counter()
+    for _ in range(n):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - started) / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=10000, help="每轮每种配置的请求数")
+    parser.add_argument("-r", type=int, default=7, help="轮数")
+    args = parser.parse_args()
+
+    cases = [
+        ("无中间件", make_app, "/search"),
+        ("BaseHTTPMiddleware（改写前）", legacy_stack, "/search"),
+        ("纯ASGI（现在）", guard_stack, "/search"),
+        ("纯ASGI，exempt_paths", guard_stack, "/metrics"),
+    ]
+    try:
+        import fakeredis  # noqa: F401
+        cases.append(("纯ASGI，Redis计数（fakeredis）", redis_guard_stack, "/search"))
+    except ImportError:
+        print("未安装fakeredis，跳过Redis计数的测试")
+    samples = {name: [] for name, _, _ in cases}
+    for _ in range(args.r):
+        for name, factory, path in cases:
+            samples[name].append(asyncio.run(run(factory, path, args.n)))
+    baseline = statistics.median(samples[cases[0][0]])
+    for name, _, _ in cases:
+        us = statistics.median(samples[name])
+        print(f"{name:<32} {us:8.1f} us/请求  额外开销 {us - baseline:7.1f} us"
+              f"  (范围 {min(samples[name]):.1f}-{max(samples[name]):.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import yaml
 import os, shutil
 from pathlib import Path
+from typing import Dict
 from pydantic import BaseModel, validator
 
 CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -11,11 +12,19 @@ CONFIG_EXAMPLE_FILE = os.path.join(CONFIG_DIR, 'api_config.example.yaml')
 if not os.path.exists(CONFIG_FILE):
     shutil.copyfile(CONFIG_EXAMPLE_FILE, CONFIG_FILE)
 
+class RedisConfig(BaseModel):
+    url: str = "redis://localhost:6379/0"
+    max_connections: int = 50  # 连接池大小
+    socket_timeout: float = 0.5  # 连接和读写超时（秒）
+    retry_interval: float = 5  # Redis不可用时改用本地计数，经过这个时间后再尝试（秒）
+
 class RateLimitConfig(BaseModel):
     enabled: bool
     requests: int
     window: int
     storage: str
+    redis: RedisConfig = RedisConfig()
+    exempt_paths: list[str] = ["/metrics"]  # 不限流的路径
     @validator('requests')
     def validate_requests(cls, v):
         if v < 1:
@@ -32,6 +41,21 @@ class UrlsConfig(BaseModel):
     url_prefix: str = ""
     url_postfix: str = ""
 
+class SearchExecutorConfig(BaseModel):
+    max_workers: int = 8  # 执行搜索的线程数
+    max_concurrency: int = 8  # 同时执行的搜索数
+    max_queue: int = 64  # 最多排队的搜索数，超出时返回503
+    queue_timeout: float = 30  # 排队超过这个时间返回503（秒）
+
+class AdmissionConfig(BaseModel):
+    enabled: bool = True
+    capacity: int = 16  # 同时执行的请求代价之和
+    max_queue: int = 128  # 最多排队的请求数，超出时返回503
+    queue_timeout: float = 10  # 排队超过这个时间返回503（秒）
+    retry_after: int = 1  # 503响应的Retry-After（秒）
+    route_costs: Dict[str, int] = {"/search": 1, "/search/stream": 1, "/generate-cache": 4}  # 未列出的路径不受控制
+    ai_search_cost: int = 4  # ai_search=true的搜索的代价
+
 class APIConfig(BaseModel):
     protected_mode: bool
     allowed_endpoints: list[str]
@@ -41,6 +65,8 @@ class APIConfig(BaseModel):
     api_mode_config: APIModeConfig
     model: str
     urls: UrlsConfig
+    search_executor: SearchExecutorConfig = SearchExecutorConfig()
+    admission: AdmissionConfig = AdmissionConfig()
 
 
 
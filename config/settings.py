@@ -136,6 +136,36 @@ class ResourcePackConfig(BaseConfig):
     cache_file: Optional[str] = None
 class CommunityConfig(BaseConfig):
     manifest_urls: Dict[str, bool]
+    request_timeout: float = 10  # 下载单个社区manifest的超时时间（秒）
+    refresh_interval_seconds: int = 600  # 后台刷新社区manifest的间隔
+
+class SearchConfig(BaseConfig):
+    index_memory_budget_mb: int = 1024  # 已加载资源包向量的内存预算
+    index_idle_seconds: int = 1800  # 资源包超过这个时间未被搜索就从内存释放，0表示不释放
+    shared_index: bool = False  # 多个worker进程通过内存映射共享资源包向量（元数据仍是每个进程一份）
+    shared_index_check_seconds: int = 5  # 共享模式下检查新版本的间隔
+
+class PrefetchConfig(BaseConfig):
+    max_workers: int = 4  # 后台下载远程资源包图片的线程数
+    retries: int = 3  # 下载失败的重试次数
+    timeout: float = 15  # 单个请求的超时时间（秒）
+    search_wait_seconds: float = 2.0  # 搜索结果中的图片缺失时最多等待下载的时间
+    ignore_ssl: bool = True
+
+class ThumbnailConfig(BaseConfig):
+    sizes: List[int] = [64, 128, 256, 512]  # 缩略图的固定尺寸（最长边像素）
+    quality: int = 80  # WebP质量
+    max_workers: int = 0  # 生成缩略图的进程数，0表示CPU核数
+
+class IntegrityConfig(BaseConfig):
+    enabled: bool = True  # 后台定期校验资源包图片的hash
+    interval_seconds: int = 86400  # 两次校验的间隔
+    startup_delay_seconds: int = 300  # 启动后等待这么久再开始第一次校验
+    max_workers: int = 2  # 校验的线程数
+    max_mb_per_second: float = 20  # 校验读取速度上限，0表示不限制
+
+class StorageConfig(BaseConfig):
+    resource_pack_import_mode: str = "zip"  # zip: 直接保存zip并从中读取图片；extract: 解压到目录（图片可与其他资源包共享存储）
 
 def update_nested_dict(dictionary, keys, value):
     """
@@ -187,6 +217,11 @@ class Config(BaseConfig):
     misc: MiscConfig
     resource_packs: Dict[str, ResourcePackConfig] = {}
     community: CommunityConfig
+    search: SearchConfig = SearchConfig()
+    storage: StorageConfig = StorageConfig()
+    prefetch: PrefetchConfig = PrefetchConfig()
+    thumbnail: ThumbnailConfig = ThumbnailConfig()
+    integrity: IntegrityConfig = IntegrityConfig()
 
     # CONFIG_SOURCES = [
     #     FileSource(
@@ -271,6 +306,46 @@ class Config(BaseConfig):
         verify_folder(p)
         return p
 
+    @cached_property
+    def thumbnail_cache_dir(self) -> str:
+        """图片缩略图，按内容hash保存：pack_thumbnail_cache/ab/<hash>_<尺寸>.webp"""
+        return os.path.join(self.base_dir, 'data', 'pack_thumbnail_cache')
+
+    @cached_property
+    def shared_index_dir(self) -> str:
+        """多进程共享的资源包向量（内存映射文件）"""
+        return os.path.join(self.base_dir, 'data', 'shared_index')
+
+    @cached_property
+    def pack_discovery_cache_file(self) -> str:
+        """资源包发现快照（已解析的manifest）"""
+        return os.path.join(self.base_dir, 'data', 'pack_discovery_cache.pkl')
+
+    @cached_property
+    def blob_store_dir(self) -> str:
+        """内容寻址的图片存储目录"""
+        return os.path.join(self.base_dir, 'data', 'blobs')
+
+    @cached_property
+    def file_hash_cache_file(self) -> str:
+        """文件hash缓存，按(路径, 大小, mtime)记录已计算过的hash"""
+        return os.path.join(self.base_dir, 'data', 'file_hash_cache.pkl')
+
+    @cached_property
+    def prefetch_stats_file(self) -> str:
+        """图片被搜索返回的次数，用于后台预取的排序"""
+        return os.path.join(self.base_dir, 'data', 'prefetch_popularity.pkl')
+
+    @cached_property
+    def community_manifest_cache_file(self) -> str:
+        """社区manifest的ETag/Last-Modified和上次解析的结果"""
+        return os.path.join(self.base_dir, 'data', 'community_manifest_cache.pkl')
+
+    @cached_property
+    def integrity_results_file(self) -> str:
+        """完整性校验的结果和隔离列表"""
+        return os.path.join(self.base_dir, 'data', 'integrity_results.json')
+
     @cached_property
     def temp_dir(self) -> str:
         return os.path.join(self.base_dir, 'temp')
@@ -0,0 +1,191 @@
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from services.metrics import (ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTIONS_TOTAL,
+                              ADMISSION_WAIT_SECONDS)
+
+# 优先级，数值越小越先执行
+PRIORITY_HIGH = 0  # 缓存命中等廉价请求
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # ai_search等昂贵请求
+
+# 只读取这个大小以内的请求体用于分类
+_MAX_INSPECT_BODY = 64 * 1024
+
+
+class AdmissionRejected(Exception):
+    """排队已满、被更高优先级的请求挤出或者排队超时"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    按代价的准入控制。
+    同时执行的请求代价之和不超过capacity，超出的请求按(优先级, 到达顺序)排队；
+    队列已满时，新请求优先级更高则挤出队尾优先级最低的请求，否则直接拒绝。
+    """
+
+    def __init__(self, capacity: int = 16, max_queue: int = 128, queue_timeout: float = 10):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        # [(优先级, 序号, 代价, future), ...]
+        self._queue: List[Tuple[int, int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    async def acquire(self, cost: int, priority: int) -> None:
+        cost = max(1, min(cost, self.capacity))
+        started = time.perf_counter()
+        if not self._queue and self.in_flight + cost <= self.capacity:
+            self._grant(cost)
+            ADMISSION_WAIT_SECONDS.observe(0, priority)
+            return
+
+        if self.max_queue and len(self._queue) >= self.max_queue:
+            worst = max(self._queue)
+            if priority >= worst[0]:
+                ADMISSION_REJECTIONS_TOTAL.inc("queue_full")
+                raise AdmissionRejected("queue_full")
+            # 挤出优先级最低、到达最晚的请求
+            self._queue.remove(worst)
+            heapq.heapify(self._queue)
+            if not worst[3].done():
+                worst[3].set_exception(AdmissionRejected("shed"))
+            ADMISSION_REJECTIONS_TOTAL.inc("shed")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._counter), cost, future)
+        heapq.heappush(self._queue, entry)
+        ADMISSION_QUEUE_DEPTH.set(len(self._queue))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout or None)
+        except asyncio.TimeoutError:
+            if future.done() and not future.exception():
+                # 超时的同时已经获得名额
+                ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, priority)
+                return
+            self._remove(entry)
+            ADMISSION_REJECTIONS_TOTAL.inc("timeout")
+            raise AdmissionRejected("timeout")
+        except asyncio.CancelledError:
+            # 客户端断开
+            if future.done() and not future.exception():
+                self.release(cost)
+            else:
+                self._remove(entry)
+            raise
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, priority)
+
+    def release(self, cost: int) -> None:
+        self.in_flight -= max(1, min(cost, self.capacity))
+        self._wake()
+
+    def _grant(self, cost: int) -> None:
+        self.in_flight += cost
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+
+    def _wake(self) -> None:
+        """按顺序放行队首的请求，队首放不下时等待，避免代价大的请求一直被插队"""
+        while self._queue:
+            priority, _, cost, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+            if self.in_flight + cost > self.capacity:
+                break
+            heapq.heappop(self._queue)
+            self._grant(cost)
+            future.set_result(None)
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        ADMISSION_QUEUE_DEPTH.set(len(self._queue))
+
+    def _remove(self, entry) -> None:
+        try:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+        except ValueError:
+            pass
+        # 移除的可能是队首，后面的请求也许可以执行了
+        self._wake()
+
+    def status(self) -> dict:
+        return {"capacity": self.capacity, "in_flight": self.in_flight, "queued": len(self._queue)}
+
+
+class AdmissionControlMiddleware:
+    """
+    准入控制的ASGI中间件。
+    classifier根据路径和请求体返回(代价, 优先级)，代价为0的请求不受控制；
+    只有body_paths中的路径会读取请求体（之后原样交给应用）。
+    """
+
+    def __init__(self, app, config, classifier: Callable[[str, Optional[bytes]], Tuple[int, int]],
+                 body_paths: Iterable[str] = ()):
+        self.app = app
+        self.retry_after = str(config.admission.retry_after)
+        self.controller = AdmissionController(config.admission.capacity, config.admission.max_queue,
+                                              config.admission.queue_timeout)
+        self.classifier = classifier
+        self.body_paths = frozenset(body_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        body = None
+        if path in self.body_paths and scope["method"] == "POST":
+            body, receive = await _buffer_body(receive)
+        cost, priority = self.classifier(path, body)
+        if cost <= 0:
+            return await self.app(scope, receive, send)
+
+        try:
+            await self.controller.acquire(cost, priority)
+        except AdmissionRejected as e:
+            return await self._reject(send, e.reason)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(cost)
+
+    async def _reject(self, send, reason: str) -> None:
+        body = json.dumps({"detail": f"Server is busy ({reason}), please retry later"}).encode()
+        await send({"type": "http.response.start", "status": 503,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode()),
+                                (b"retry-after", self.retry_after.encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+async def _buffer_body(receive):
+    """读取完整的请求体，返回(请求体, 重放请求体的receive)；请求体过大时不用于分类"""
+    chunks = []
+    disconnect = None
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            # 客户端已经断开
+            disconnect = message
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    body = b"".join(chunks)
+    replayed = False
+
+    async def replay():
+        nonlocal replayed
+        if not replayed:
+            replayed = True
+            return disconnect or {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return (body if disconnect is None and len(body) <= _MAX_INSPECT_BODY else None), replay
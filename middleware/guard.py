@@ -0,0 +1,26 @@
+from middleware.protected_mode import ProtectedModeMiddleware
+from middleware.rate_limiter import RateLimitMiddleware
+
+
+class RequestGuardMiddleware:
+    """
+    限流和保护模式合并为一层ASGI中间件，每个请求只判断一次请求类型、去掉一次末尾斜杠。
+    顺序与分开注册时相同：先限流（exempt_paths除外），再检查保护模式的白名单；两者都未启用时直接交给应用。
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        self.limiter = RateLimitMiddleware(app, config) if config.rate_limit.enabled else None
+        self.protected = ProtectedModeMiddleware(app, config) if config.protected_mode else None
+        self.exempt_paths = self.limiter.exempt_paths if self.limiter is not None else frozenset()
+        self.passthrough = self.limiter is None and self.protected is None
+
+    async def __call__(self, scope, receive, send):
+        if self.passthrough or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"].rstrip('/')
+        if self.limiter is not None and path not in self.exempt_paths and not await self.limiter.allow(scope):
+            return await self.limiter.reject(send)
+        if self.protected is not None and not self.protected.is_allowed(path):
+            return await self.protected.reject(send, path)
+        await self.app(scope, receive, send)
@@ -1,30 +1,36 @@
-from fastapi import Request, HTTPException
-from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+import json
+
+
+class ProtectedModeMiddleware:
+    """
+    保护模式的ASGI中间件，只放行白名单中的端点。
+    白名单在初始化时整理为frozenset，以 /* 结尾的条目按前缀匹配（如 /img/*）。
+    """
 
-class ProtectedModeMiddleware(BaseHTTPMiddleware):
     def __init__(self, app, config):
-        super().__init__(app)
-        self.config = config
+        self.app = app
+        self.enabled = config.protected_mode
+        # 标准化路径：移除末尾斜杠
+        self.allowed_paths = frozenset(p.rstrip('/') for p in config.allowed_endpoints if not p.endswith('/*'))
+        self.allowed_prefixes = tuple(p[:-1] for p in config.allowed_endpoints if p.endswith('/*'))
+
+    def is_allowed(self, path: str) -> bool:
+        """path需要已经去掉末尾斜杠"""
+        return path in self.allowed_paths or (bool(self.allowed_prefixes) and path.startswith(self.allowed_prefixes))
 
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"].rstrip('/')
+        if self.is_allowed(path):
+            return await self.app(scope, receive, send)
+        await self.reject(send, path)
 
-        # 检查保护模式状态
-        if self.config.protected_mode:
-            # 标准化路径：移除末尾斜杠
-            path = request.url.path.rstrip('/')
-            allowed_paths = [p.rstrip('/') for p in self.config.allowed_endpoints]
-            
-            # 放行白名单端点
-            if path in allowed_paths:
-                return await call_next(request)
-                
-            # 拦截其他请求
-            return JSONResponse(
-                status_code=403,
-                content={
-                    "detail": f"Protected mode blocked request to {path}"
-                }
-            )
-            
-        return await call_next(request)
\ No newline at end of file
+    @staticmethod
+    async def reject(send, path: str) -> None:
+        """拦截不在白名单中的请求"""
+        body = json.dumps({"detail": f"Protected mode blocked request to {path}"}).encode()
+        await send({"type": "http.response.start", "status": 403,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
@@ -1,96 +1,200 @@
+import itertools
+import json
+import os
+import threading
 import time
-from collections import defaultdict
-from fastapi import Request
-from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+import uuid
 from threading import Lock
 import redis
+import redis.asyncio
 from redis.exceptions import RedisError
+from services.metrics import RATE_LIMIT_REJECTIONS_TOTAL
+from base import *
 
 class RateLimiter:
-    def __init__(self):
-        self.counts = defaultdict(list)
-        self.lock = Lock()
+    """
+    滑动窗口计数的限流器。
+    每个键只保存当前窗口的开始时间、上个窗口和当前窗口的计数，内存占用固定；
+    按上个窗口计数在滑动窗口中所占的比例估算请求数。
+    键按hash分散到多个分片，各分片单独加锁；后台线程定期删除长时间没有请求的键。
+    """
+
+    def __init__(self, shards: int = 64, sweep_interval: float = 60):
+        # 分片数取2的幂，用位运算选择分片
+        self._shard_mask = (1 << max(0, shards - 1).bit_length()) - 1
+        self._shards = [{} for _ in range(self._shard_mask + 1)]
+        self._locks = [Lock() for _ in range(self._shard_mask + 1)]
+        self.sweep_interval = sweep_interval
+        self._sweeper = None
+        self._sweeper_lock = Lock()
 
     def check(self, key: str, max_requests: int, window: int) -> bool:
-        with self.lock:
-            now = time.time()
-            # 清理过期记录并删除空键
-            if key in self.counts:
-                self.counts[key] = [t for t in self.counts[key] if (now - t) <= window]
-                if not self.counts[key]:
-                    del self.counts[key]
-            # 检查计数
-            current = self.counts.get(key, [])
-            if len(current) >= max_requests:
+        if self._sweeper is None:
+            self._start_sweeper()
+        now = time.monotonic()
+        index = hash(key) & self._shard_mask
+        shard = self._shards[index]
+        with self._locks[index]:
+            # [当前窗口开始时间, 上个窗口计数, 当前窗口计数, 窗口长度]
+            state = shard.get(key)
+            if state is None:
+                shard[key] = [now, 0, 1, window]
+                return max_requests >= 1
+            elapsed = now - state[0]
+            if elapsed >= window:
+                # 进入新的窗口，超过两个窗口没有请求时上个窗口计数为0
+                periods = int(elapsed // window)
+                state[1] = state[2] if periods == 1 else 0
+                state[2] = 0
+                state[0] += periods * window
+                elapsed -= periods * window
+            estimated = state[1] * (window - elapsed) / window + state[2]
+            if estimated >= max_requests:
                 return False
-            self.counts[key].append(now)
+            state[2] += 1
+            state[3] = window
             return True
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def sweep(self) -> int:
+        """删除超过两个窗口没有请求的键，返回删除的数量"""
+        now = time.monotonic()
+        removed = 0
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                idle = [k for k, state in shard.items() if now - state[0] >= 2 * state[3]]
+                for k in idle:
+                    del shard[k]
+            removed += len(idle)
+        return removed
+
+    def _start_sweeper(self) -> None:
+        with self._sweeper_lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="rate-limit-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_loop(self) -> None:
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"清理限流记录失败: {e}")
         
 class RedisRateLimiter:
-    def __init__(self, host='localhost', port=6379):
-        self.redis = redis.Redis(host=host, port=port)
-        self.script = """
-        local key = KEYS[1]
-        local now = tonumber(ARGV[1])
-        local window = tonumber(ARGV[2])
-        local max = tonumber(ARGV[3])
-        
-        -- 删除窗口之前的记录
-        redis.call('ZREMRANGEBYSCORE', key, 0, now - window)
-        -- 获取当前计数
-        local count = redis.call('ZCARD', key)
-        if count >= max then
-            return 0
-        end
-        -- 添加当前时间戳
-        redis.call('ZADD', key, now, now)
-        -- 设置过期时间
-        redis.call('EXPIRE', key, window)
-        return 1
+    """
+    基于Redis的异步限流器，多个进程、多台机器共享计数。
+    使用连接池和异步客户端，不阻塞事件循环；Lua脚本只注册一次，之后用EVALSHA执行；
+    有序集合的成员带有进程号和序号，同一毫秒内的请求不会合并。
+    Redis不可用时改用本地的RateLimiter计数，retry_interval秒后再尝试Redis。
+    """
+
+    SCRIPT = """
+    local key = KEYS[1]
+    local now = tonumber(ARGV[1])
+    local window = tonumber(ARGV[2])
+    local max = tonumber(ARGV[3])
+
+    -- 删除窗口之前的记录
+    redis.call('ZREMRANGEBYSCORE', key, 0, now - window)
+    -- 获取当前计数
+    local count = redis.call('ZCARD', key)
+    if count >= max then
+        return 0
+    end
+    -- 添加当前请求
+    redis.call('ZADD', key, now, ARGV[4])
+    -- 设置过期时间
+    redis.call('PEXPIRE', key, window)
+    return 1
+    """
+
+    def __init__(self, client=None, url: str = 'redis://localhost:6379/0', max_connections: int = 50,
+                 socket_timeout: float = 0.5, retry_interval: float = 5, key_prefix: str = 'ratelimit:'):
+        """
+        :param client: redis.asyncio.Redis或兼容的客户端，默认按url创建带连接池的客户端
         """
+        if client is None:
+            pool = redis.asyncio.ConnectionPool.from_url(url, max_connections=max_connections,
+                                                         socket_timeout=socket_timeout,
+                                                         socket_connect_timeout=socket_timeout)
+            client = redis.asyncio.Redis(connection_pool=pool)
+        self.redis = client
+        # 第一次调用时SCRIPT LOAD，之后EVALSHA，脚本缓存丢失时自动重新加载
+        self.script = client.register_script(self.SCRIPT)
+        self.fallback = RateLimiter()
+        self.retry_interval = retry_interval
+        self.key_prefix = key_prefix
+        self._member_prefix = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._sequence = itertools.count()
+        self._unavailable_until = 0.0
 
-    def check(self, key: str, max_requests: int, window: int) -> bool:
+    async def check(self, key: str, max_requests: int, window: int) -> bool:
+        if time.monotonic() < self._unavailable_until:
+            return self.fallback.check(key, max_requests, window)
+        now_ms = int(time.time() * 1000)
+        member = f"{now_ms}-{self._member_prefix}-{next(self._sequence)}"
         try:
-            now = int(time.time())
-            result = self.redis.eval(
-                self.script,
-                1,
-                key,
-                now,
-                window,
-                max_requests
-            )
+            result = await self.script(keys=[self.key_prefix + key], args=[now_ms, window * 1000, max_requests, member])
             return bool(result)
-        except RedisError:
-            return True  # 根据需求调整降级策略
+        except (RedisError, OSError) as e:
+            logger.warning(f"Redis限流不可用，{self.retry_interval}秒内改用本地计数: {e}")
+            self._unavailable_until = time.monotonic() + self.retry_interval
+            return self.fallback.check(key, max_requests, window)
+
+    async def close(self) -> None:
+        await self.redis.aclose()
+
+class RateLimitMiddleware:
+    """
+    限流的ASGI中间件。
+    不需要限流的请求（非HTTP、未启用、exempt_paths中的路径）只经过一次判断直接交给应用；
+    429响应在初始化时生成，内存计数同步检查，Redis计数异步检查。
+    """
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
     def __init__(self, app, config):
-        super().__init__(app)
-        self.config = config
-        if self.config.rate_limit.storage == 'redis':
-            self.ratelimiter = RedisRateLimiter()
+        self.app = app
+        rate_limit = config.rate_limit
+        self.enabled = rate_limit.enabled
+        self.max_requests = rate_limit.requests
+        self.window = rate_limit.window
+        self.exempt_paths = frozenset(p.rstrip('/') for p in rate_limit.exempt_paths)
+        if rate_limit.storage == 'redis':
+            redis_config = rate_limit.redis
+            self.ratelimiter = RedisRateLimiter(url=redis_config.url,
+                                                max_connections=redis_config.max_connections,
+                                                socket_timeout=redis_config.socket_timeout,
+                                                retry_interval=redis_config.retry_interval)
         else:
             self.ratelimiter = RateLimiter()
+        self._async = isinstance(self.ratelimiter, RedisRateLimiter)
+        body = json.dumps({"detail": f"Requests are too frequent. Rate limited to {self.max_requests} requests per {self.window} seconds"}).encode()
+        self._rejected_start = {"type": "http.response.start", "status": 429,
+                                "headers": [(b"content-type", b"application/json"),
+                                            (b"content-length", str(len(body)).encode()),
+                                            (b"retry-after", str(self.window).encode())]}
+        self._rejected_body = {"type": "http.response.body", "body": body}
 
-    async def dispatch(self, request: Request, call_next):
-        if not self.config.rate_limit.enabled:
-            return await call_next(request)
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http" or scope["path"].rstrip('/') in self.exempt_paths:
+            return await self.app(scope, receive, send)
+        if not await self.allow(scope):
+            return await self.reject(send)
+        await self.app(scope, receive, send)
 
-        # 获取客户端标识
-        client_ip = request.client.host
-        
-        # 检查速率限制
-        if not self.ratelimiter.check(
-            key=client_ip,
-            max_requests=self.config.rate_limit.requests,
-            window=self.config.rate_limit.window
-        ):
-            return JSONResponse(
-                status_code=429,
-                detail=f"Requests are too frequent. Rate limited to {self.config.rate_limit.requests} requests per {self.config.rate_limit.window} seconds",
-                headers={"Retry-After": str(self.config.rate_limit.window)}
-            )
-            
-        return await call_next(request)
\ No newline at end of file
+    async def allow(self, scope) -> bool:
+        """按客户端IP计数，未超出限制时返回True"""
+        client = scope.get("client")
+        client_ip = client[0] if client else "unknown"
+        if self._async:
+            return await self.ratelimiter.check(client_ip, self.max_requests, self.window)
+        return self.ratelimiter.check(client_ip, self.max_requests, self.window)
+
+    async def reject(self, send) -> None:
+        RATE_LIMIT_REJECTIONS_TOTAL.inc()
+        await send(self._rejected_start)
+        await send(self._rejected_body)
@@ -0,0 +1,207 @@
+import json
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional
+
+from config.settings import Config
+from services.hash_service import HASH_SERVICE
+from base import *
+
+
+class BlobStore:
+    """
+    内容寻址的图片存储。
+    每个图片按manifest中的sha256只保存一份（data/blobs/ab/abcdef...），
+    资源包目录中的图片是指向它的硬链接，所以读取图片的代码不需要任何改动，
+    多个资源包中相同的图片共享同一份磁盘空间和页缓存。
+    引用计数记录每个blob被哪些资源包使用，删除资源包时回收不再被引用的blob。
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or Config().blob_store_dir
+        # 只允许在资源包目录中创建或替换链接
+        self.packs_root = os.path.join(Config().base_dir, Config().paths.resource_packs_dir)
+        self.refs_file = os.path.join(self.root, 'refs.json')
+        self._lock = threading.Lock()
+        # hash -> 引用它的pack_id列表
+        self._refs: Dict[str, List[str]] = self._load_refs()
+
+    def blob_path(self, file_hash: str) -> str:
+        return os.path.join(self.root, file_hash[:2], file_hash)
+
+    def has(self, file_hash: str) -> bool:
+        return bool(file_hash) and os.path.exists(self.blob_path(file_hash))
+
+    def add_file(self, file_path: str, file_hash: str, pack_id: str) -> bool:
+        """
+        把资源包中的文件加入存储，并将其替换为指向blob的硬链接
+        :return: 是否成功加入（hash不匹配或链接失败时返回False，原文件保持不变）
+        """
+        if not self._in_packs_root(file_path):
+            return False
+        blob = self.blob_path(file_hash)
+        with self._lock:
+            if not os.path.exists(blob):
+                # 新内容需要校验，避免错误的manifest污染存储
+                if HASH_SERVICE.hash_file(file_path) != file_hash:
+                    logger.warning(f"文件内容与manifest中的hash不一致，不加入存储: {file_path}")
+                    return False
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                if not _link_or_copy(file_path, blob):
+                    return False
+            elif not os.path.samefile(blob, file_path):
+                # 替换前同样要校验，hash不一致的文件不能被存储中的内容覆盖
+                if HASH_SERVICE.hash_file(file_path) != file_hash:
+                    logger.warning(f"文件内容与manifest中的hash不一致，不加入存储: {file_path}")
+                    return False
+                if not _replace_with_link(blob, file_path):
+                    return False
+            self._add_ref(file_hash, pack_id)
+            self._save_refs()
+        return True
+
+    def link_to(self, file_hash: str, target_path: str, pack_id: str) -> bool:
+        """
+        已有相同内容时，直接在目标位置创建硬链接，不需要再解压或下载
+        :return: 存储中没有这个hash、目标不在资源包目录中或链接失败时返回False
+        """
+        if not self._in_packs_root(target_path):
+            return False
+        with self._lock:
+            blob = self.blob_path(file_hash)
+            if not os.path.exists(blob):
+                return False
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            if not _replace_with_link(blob, target_path):
+                return False
+            self._add_ref(file_hash, pack_id)
+            self._save_refs()
+        return True
+
+    def evict_if_corrupt(self, file_hash: str) -> bool:
+        """
+        重新计算blob的hash，与文件名不一致时删除blob（引用保留，之后加入的正确内容会重新建立blob），
+        避免损坏的内容再被链接到其他资源包
+        :return: 是否删除了blob
+        """
+        with self._lock:
+            blob = self.blob_path(file_hash)
+            if not os.path.exists(blob):
+                return False
+            HASH_SERVICE.invalidate(blob)
+            if HASH_SERVICE.hash_file(blob) == file_hash:
+                return False
+            os.remove(blob)
+        logger.warning(f"共享存储中的图片已损坏，已删除: {blob}")
+        return True
+
+    def add_pack(self, pack_id: str, pack_dir: str, manifest: Dict) -> int:
+        """把资源包中所有带hash的图片加入存储，返回加入的数量"""
+        count = 0
+        for file_info in manifest.get('contents', {}).get('images', {}).get('files', {}).values():
+            file_hash = file_info.get('hash')
+            file_path = safe_join(pack_dir, file_info['filepath'])
+            if file_path is None:
+                logger.warning(f"资源包 {pack_id} 中的路径超出资源包目录，已忽略: {file_info['filepath']}")
+                continue
+            if file_hash and os.path.exists(file_path) and self.add_file(file_path, file_hash, pack_id):
+                count += 1
+        return count
+
+    def release(self, file_hash: str, pack_id: str) -> bool:
+        """移除资源包对单个blob的引用，不再被引用时删除blob，返回是否删除了blob"""
+        with self._lock:
+            packs = self._refs.get(file_hash)
+            if not packs or pack_id not in packs:
+                return False
+            packs.remove(pack_id)
+            removed = False
+            if not packs:
+                del self._refs[file_hash]
+                try:
+                    os.remove(self.blob_path(file_hash))
+                    removed = True
+                except FileNotFoundError:
+                    pass
+            self._save_refs()
+        return removed
+
+    def release_pack(self, pack_id: str) -> int:
+        """移除资源包的所有引用，删除不再被任何资源包引用的blob，返回删除的数量"""
+        removed = 0
+        with self._lock:
+            for file_hash in list(self._refs):
+                packs = self._refs[file_hash]
+                if pack_id not in packs:
+                    continue
+                packs.remove(pack_id)
+                if not packs:
+                    del self._refs[file_hash]
+                    try:
+                        os.remove(self.blob_path(file_hash))
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+            self._save_refs()
+        return removed
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "blobs": len(self._refs),
+                "references": sum(len(v) for v in self._refs.values()),
+            }
+
+    def _in_packs_root(self, path: str) -> bool:
+        if safe_join(self.packs_root, os.path.abspath(path)) is None:
+            logger.warning(f"拒绝在资源包目录之外创建链接: {path}")
+            return False
+        return True
+
+    def _add_ref(self, file_hash: str, pack_id: str) -> None:
+        packs = self._refs.setdefault(file_hash, [])
+        if pack_id not in packs:
+            packs.append(pack_id)
+
+    def _load_refs(self) -> Dict[str, List[str]]:
+        if not os.path.exists(self.refs_file):
+            return {}
+        try:
+            with open(self.refs_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"读取blob引用计数失败: {e}")
+            return {}
+
+    def _save_refs(self) -> None:
+        verify_folder(self.refs_file)
+        tmp_file = f"{self.refs_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self._refs, f)
+        os.replace(tmp_file, self.refs_file)
+
+
+def _link_or_copy(src: str, dst: str) -> bool:
+    """创建硬链接，文件系统不支持时退化为复制"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            shutil.copy2(src, dst)
+        except OSError as e:
+            logger.error(f"复制文件失败 {src} -> {dst}: {e}")
+            return False
+    return True
+
+
+def _replace_with_link(blob: str, target: str) -> bool:
+    """用指向blob的硬链接替换目标文件，先写临时文件再替换，保证目标文件始终完整"""
+    tmp_target = f"{target}.blobtmp"
+    if not _link_or_copy(blob, tmp_target):
+        return False
+    os.replace(tmp_target, target)
+    return True
+
+
+BLOB_STORE = BlobStore()
@@ -22,21 +22,42 @@ class CacheService:
         self.embedding_service = emb_srv
         self.resource_pack_manager = rp_mgr
 
-    def generate_cache(self, progress_bar) -> None:
+    def generate_cache(self, progress_bar, model_name: Optional[str] = None) -> None:
+        """
+        为所有启用的资源包生成指定模型的缓存
+        :param model_name: 模型键，默认为当前选择的嵌入模型
+        """
         # 获取所有启用的资源包
         enabled_packs = self.resource_pack_manager.get_enabled_packs()
         if not enabled_packs:
             raise RuntimeError("没有启用的资源包")
+        self.embedding_service.refresh_config()
 
-        # 为每个资源包生成缓存
         total_packs = len(enabled_packs)
         success_count = 0
         failed_packs = []
 
+        # 第一阶段：规划每个资源包需要新生成的(文件, 标签)
+        plans = []
         for i, (pack_id, pack_info) in enumerate(enabled_packs.items()):
-            progress_bar.progress(i / total_packs, text=f"处理资源包 {i + 1}/{total_packs}: {pack_info['name']}")
+            _report_progress(progress_bar, i / total_packs * 0.1,
+                             f"规划资源包 {i + 1}/{total_packs}: {pack_info['name']}")
+            try:
+                plans.append(self._plan_pack_cache(pack_id, pack_info, model_name))
+            except Exception as e:
+                logger.error(f"规划资源包 {pack_info['name']} 的缓存失败: {e}")
+                failed_packs.append(f"{pack_info['name']}: {str(e)}")
+
+        # 第二阶段：跨资源包去重后批量嵌入，每个标签只请求一次
+        vectors = self._embed_plans(plans, progress_bar, model_name)
+
+        # 第三阶段：把向量分发回各个资源包的缓存
+        for i, plan in enumerate(plans):
+            pack_info = plan["pack_info"]
+            _report_progress(progress_bar, 0.9 + i / len(plans) * 0.1,
+                             f"写入资源包缓存 {i + 1}/{len(plans)}: {pack_info['name']}")
             try:
-                self._generate_pack_cache(pack_id, pack_info, progress_bar)
+                self._apply_pack_plan(plan, vectors)
                 success_count += 1
             except Exception as e:
                 logger.error(f"生成资源包 {pack_info['name']} 的缓存失败: {e}")
@@ -48,83 +69,112 @@ class CacheService:
                 failed_packs)
             raise RuntimeError(error_message)
 
-    def try_load_cache(self) -> t.List | None:
+    def try_load_cache(self, model_name: Optional[str] = None) -> t.List | None:
 
         """
-        尝试加载缓存
-        重新写入self.image_data
+        尝试加载所有启用的资源包在指定模型下的缓存
+        :param model_name: 模型键，默认为当前选择的嵌入模型
         """
-        # 获取所有启用的资源包的缓存文件
-        cache_files = self.resource_pack_manager.get_cache_files()
-
-        if not cache_files:
-            return None
-
         # 合并所有缓存文件的数据
         all_embeddings = []
-
-        for pack_id, cache_file in cache_files.items():
-            if os.path.exists(cache_file):
-                try:
-                    with open(cache_file, 'rb') as f:
-                        cached_data = pickle.load(f)
-                    valid_embeddings = []
-                    for item in cached_data:
-                        # 获取文件路径
-                        if 'pack_id' not in item:
-                            item['pack_id'] = pack_id
-                        valid_embeddings.append(item)
-
-                    if valid_embeddings:
-                        all_embeddings.extend(valid_embeddings)
-                        # 更新缓存文件
-                        if len(valid_embeddings) != len(cached_data):
-                            with open(cache_file, 'wb') as f:
-                                pickle.dump(valid_embeddings, f)
-                except (pickle.UnpicklingError, EOFError) as e:
-                    print(f"加载缓存文件 {cache_file} 失败: {str(e)}")
+        for pack_id in self.resource_pack_manager.get_enabled_packs():
+            cached_data = self.load_pack_cache(pack_id, model_name)
+            if cached_data:
+                all_embeddings.extend(cached_data)
 
         if all_embeddings:
             return all_embeddings
         else:
             return None
 
-    def _generate_pack_cache(self, pack_id: str, pack_info: Dict, progress_bar) -> None:
-        self.embedding_service.refresh_config()
+    def load_pack_cache(self, pack_id: str, model_name: Optional[str] = None) -> t.List | None:
+        """
+        读取单个资源包在指定模型下的缓存
+        :return: 缓存数据，缓存不存在或无法读取时返回None
+        """
+        cache_file = self.resource_pack_manager.get_pack_cache_file(pack_id, model_name)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file, 'rb') as f:
+                cached_data = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError) as e:
+            print(f"加载缓存文件 {cache_file} 失败: {str(e)}")
+            return None
+
+        for item in cached_data:
+            # 获取文件路径
+            if 'pack_id' not in item:
+                item['pack_id'] = pack_id
+        return cached_data
+
+    def has_pack_cache(self, pack_id: str, model_name: Optional[str] = None) -> bool:
+        """检查资源包在指定模型下是否已生成缓存，不读取缓存内容"""
+        return os.path.exists(self.resource_pack_manager.get_pack_cache_file(pack_id, model_name))
+
+    def _generate_pack_cache(self, pack_id: str, pack_info: Dict, progress_bar,
+                             model_name: Optional[str] = None) -> None:
         """为指定的资源包生成缓存"""
-        img_dir = pack_info["path"]
+        self.embedding_service.refresh_config()
+        plan = self._plan_pack_cache(pack_id, pack_info, model_name)
+        vectors = self._embed_plans([plan], progress_bar, model_name)
+        self._apply_pack_plan(plan, vectors)
 
-        cache_file = self.resource_pack_manager.get_pack_cache_file(pack_id)
+    def update_pack_cache(self, pack_id: str, pack_info: Dict, model_name: Optional[str] = None) -> int:
+        """
+        资源包更新后增量更新缓存：已有的嵌入保留，删除的文件从缓存中移除，只为新增的文件请求嵌入
+        :return: 新增的嵌入数量
+        """
+        self.embedding_service.refresh_config()
+        plan = self._plan_pack_cache(pack_id, pack_info, model_name)
+        if plan["pending"] or plan["pruned"]:
+            vectors = self._embed_plans([plan], None, model_name)
+            self._apply_pack_plan(plan, vectors)
+        return len(plan["pending"])
+
+    @staticmethod
+    def _load_pack_cache_file(cache_file: str) -> List[Dict]:
+        """读取资源包缓存文件，过滤掉无效的数据项"""
+        if not os.path.exists(cache_file):
+            return []
+        try:
+            with open(cache_file, 'rb') as f:
+                loaded_data = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError) as e:
+            logger.error(f"加载缓存文件 {cache_file} 失败: {str(e)}")
+            return []
+
+        # 验证加载的数据格式
+        if not isinstance(loaded_data, list):
+            logger.warning(f"警告: 缓存文件格式不正确，期望列表但得到 {type(loaded_data)}")
+            return []
+
+        # 过滤掉不是字典或缺少必要键的元素
+        valid_embeddings = []
+        for item in loaded_data:
+            if isinstance(item, dict) and 'filename' in item and 'embedding' in item:
+                valid_embeddings.append(item)
+            else:
+                logger.warning(f"警告: 缓存文件中发现无效的数据项: {type(item)}")
+        return valid_embeddings
+
+    @staticmethod
+    def _get_embedding_names(filename: str, replace_patterns_regex: Optional[Dict[str, str]]) -> List[str]:
+        """从文件名解析出需要嵌入的标签，多个标签用'-'分隔"""
+        raw_embedding_name = filename
+        if replace_patterns_regex is not None:
+            for pattern, replacement in replace_patterns_regex.items():
+                raw_embedding_name = re.sub(pattern, replacement, raw_embedding_name)
+        return [name for name in raw_embedding_name.split('-') if name != '']
+
+    def _plan_pack_cache(self, pack_id: str, pack_info: Dict, model_name: Optional[str] = None) -> Dict:
+        """
+        规划资源包的缓存生成：读取已有缓存，列出还没有生成嵌入的(文件名, 文件路径, 标签)。
+        规划阶段不会请求API。
+        """
+        cache_file = self.resource_pack_manager.get_pack_cache_file(pack_id, model_name)
         verify_folder(cache_file)
 
-        # 尝试加载现有缓存
-        existing_embeddings = []
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'rb') as f:
-                    loaded_data = pickle.load(f)
-
-                # 验证加载的数据格式
-                if isinstance(loaded_data, list):
-                    # 过滤掉不是字典或缺少必要键的元素
-                    valid_embeddings = []
-                    for item in loaded_data:
-                        if isinstance(item, dict) and 'filename' in item and 'embedding' in item:
-                            valid_embeddings.append(item)
-                        else:
-                            logger.warning(f"警告: 缓存文件中发现无效的数据项: {type(item)}")
-                    existing_embeddings = valid_embeddings
-                else:
-                    logger.warning(f"警告: 缓存文件格式不正确，期望列表但得到 {type(loaded_data)}")
-            except (pickle.UnpicklingError, EOFError) as e:
-                logger.error(f"加载缓存文件 {cache_file} 失败: {str(e)}")
-                existing_embeddings = []
-
-        # 确保所有缓存数据都有filepath字段
-        generated_files = []
-        for item in existing_embeddings:
-            generated_files.append(item['filepath'])
-
         # 获取所有图片文件路径
         all_files = []
         for k, v in pack_info['manifest']['contents']['images']['files'].items():
@@ -135,119 +185,89 @@ class CacheService:
             if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif'))
         ]
 
-        # 过滤掉已经生成过嵌入的文件
-        new_image_files = [f for f in image_files if f not in generated_files]
-
-        if not new_image_files and existing_embeddings:
-            # 如果没有新文件且已有缓存，直接返回
-            return
-
-        # 获取资源包类型
-        image_type = pack_info.get("type", "vv")
+        # 尝试加载现有缓存，丢弃manifest中已经不存在的文件（资源包更新后被删除或改名）
+        loaded_embeddings = self._load_pack_cache_file(cache_file)
+        image_file_set = set(image_files)
+        existing_embeddings = [item for item in loaded_embeddings if item['filepath'] in image_file_set]
+        generated_files = {item['filepath'] for item in existing_embeddings}
 
         # 获取替换规则
         replace_patterns_regex = None
         if "regex" in pack_info:
             replace_patterns_regex = {pack_info["regex"]["pattern"]: pack_info["regex"]["replacement"]}
 
-        # 生成新文件的嵌入
-        embeddings = existing_embeddings.copy()
-        errors = []
-
-        # 创建线程列表和线程锁
-        embedding_lock = threading.Lock()
-
-        total_files = len(new_image_files)
-
-        def save_embeddings():
-            if embeddings:
-                with embedding_lock:
-                    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-                    with open(cache_file, 'wb') as f:
-                        pickle.dump(embeddings, f)
-
-                    self.embedding_service.cache_lock.acquire()
-                    self.embedding_service.save_embedding_cache()
-                    self.embedding_service.cache_lock.release()
-        for index, filepath in enumerate(new_image_files):
-            try:
-                # if not os.path.isabs(filepath):
-                #     filepath = os.path.join(Config().base_dir, filepath)
-
-                filename = os.path.splitext(os.path.basename(filepath))[0]
-                full_filename = None
-
-                for ext in ENDWITH_IMAGE:
-                    # if os.path.exists(os.path.join(os.path.dirname(filepath), filename + ext)):
-                    #     full_filename = filename + ext
-                    #     break
-                    pass
-                full_filename = filepath
-
-
-                if full_filename:
-                    raw_embedding_name = filename
-                    if replace_patterns_regex is not None:
-                        for pattern, replacement in replace_patterns_regex.items():
-                            raw_embedding_name = re.sub(pattern, replacement, raw_embedding_name)
-
-                    embedding_names = raw_embedding_name.split('-')
-                    for embedding_name in embedding_names:
-                        if embedding_name == '':
-                            continue
-
-                        def add_embedding_thread(embedding_service: EmbeddingService, store_embedding_list: List,
-                                                 filename_: str, filepath_: str, embedding_name_: str,
-                                                 image_type_: str, pack_id_: str, lock: threading.Lock,
-                                                 errors_list: List):
-                            try:
-                                embedding = embedding_service.get_embedding(embedding_name_)
-                                with lock:
-                                    store_embedding_list.append({
-                                        "filename": filename_,
-                                        "filepath": filepath_,
-                                        "embedding": embedding,
-                                        "embedding_name": embedding_name_,
-                                        "type": image_type_ if image_type_ is not None else 'Normal',
-                                        "pack_id": pack_id_
-                                    })
-                            except Exception as e:
-                                error_msg = f"生成嵌入失败 {str(e)} in [{filepath_}]"
-                                print(error_msg)
-                                with lock:
-                                    errors_list.append(f"{str(e)} [{filepath_}]")
-
-
-
-                        while self.embedding_service.is_rpm_overload():
-                            print(f"RPM过载，等待1秒...")
-                            time.sleep(1)
-
-                        # 创建并启动线程
-                        thread = threading.Thread(
-                            target=add_embedding_thread,
-                            args=(self.embedding_service, embeddings, filename, filepath,
-                                  embedding_name, image_type, pack_id, embedding_lock, errors)
-                        )
-                        thread.start()
-
-                progress_bar.progress((index + 1) / total_files,
-                                      text=f"处理 {pack_info['name']} 图片 {index + 1}/{total_files}")
-
-                if (index % 151 == 0 and index > 0 and
-                        time.time() - self.embedding_service.get_last_request_time() < 30):
-                    # 保存中间缓存
-                    save_embeddings()
-
-            except Exception as e:
-                print(f"生成嵌入失败 [{filepath}]: {str(e)}")
-                errors.append(f"[{filepath}] {str(e)}")
+        # 过滤掉已经生成过嵌入的文件
+        pending = []
+        for filepath in image_files:
+            if filepath in generated_files:
+                continue
+            filename = os.path.splitext(os.path.basename(filepath))[0]
+            for embedding_name in self._get_embedding_names(filename, replace_patterns_regex):
+                pending.append((filename, filepath, embedding_name))
+
+        return {
+            "pack_id": pack_id,
+            "pack_info": pack_info,
+            "cache_file": cache_file,
+            "existing": existing_embeddings,
+            "pruned": len(existing_embeddings) != len(loaded_embeddings),
+            "pending": pending,
+            # 获取资源包类型
+            "image_type": pack_info.get("type", "vv"),
+        }
+
+    def _embed_plans(self, plans: List[Dict], progress_bar, model_name: Optional[str] = None) -> Dict[str, np.ndarray]:
+        """收集所有规划中的标签，去重后批量嵌入"""
+        labels = [embedding_name for plan in plans for _, _, embedding_name in plan["pending"]]
+        if not labels:
+            return {}
+
+        def on_progress(done: int, total: int):
+            _report_progress(progress_bar, 0.1 + done / total * 0.8, f"生成嵌入 {done}/{total}")
+
+        vectors = self.embedding_service.get_embeddings(labels, progress_callback=on_progress, model=model_name)
+        with self.embedding_service.cache_lock:
+            self.embedding_service.save_embedding_cache()
+        return vectors
+
+    def _apply_pack_plan(self, plan: Dict, vectors: Dict[str, np.ndarray]) -> None:
+        """把批量嵌入的结果写入资源包缓存"""
+        if not plan["pending"] and plan["existing"] and not plan.get("pruned"):
+            # 如果没有新文件且已有缓存，直接返回
+            return
 
-        # 保存最终缓存
-        save_embeddings()
+        image_type = plan["image_type"]
+        embeddings = plan["existing"].copy()
+        errors = []
+        for filename, filepath, embedding_name in plan["pending"]:
+            embedding = vectors.get(embedding_name)
+            if embedding is None:
+                errors.append(f"生成嵌入失败 [{embedding_name}] [{filepath}]")
+                continue
+            embeddings.append({
+                "filename": filename,
+                "filepath": filepath,
+                "embedding": embedding,
+                "embedding_name": embedding_name,
+                "type": image_type if image_type is not None else 'Normal',
+                "pack_id": plan["pack_id"]
+            })
+
+        # 保存缓存
+        if embeddings or plan.get("pruned"):
+            cache_file = plan["cache_file"]
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(cache_file, 'wb') as f:
+                pickle.dump(embeddings, f)
 
         # 提出错误
         if errors:
             error_summary = "\n".join(errors)
             print(error_summary)
-            raise RuntimeError(error_summary)
\ No newline at end of file
+            raise RuntimeError(error_summary)
+
+
+def _report_progress(progress_bar, value: float, text: str) -> None:
+    """更新进度条；API等场景下没有进度条时忽略"""
+    if progress_bar is not None:
+        progress_bar.progress(min(max(value, 0.0), 1.0), text=text)
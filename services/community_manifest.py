@@ -0,0 +1,179 @@
+import json
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from config.settings import Config
+from base import *
+
+
+class CommunityManifestAggregator:
+    """
+    社区资源包组manifest的聚合。
+    所有manifest_urls并发下载，每个URL单独设置超时；记录ETag/Last-Modified，
+    源没有变化时服务器返回304，直接使用上次解析的结果。
+    合并后的结果保存在内存中，由后台线程定期刷新，请求处理只读取最后一次成功的快照。
+    """
+
+    def __init__(self, cache_file: Optional[str] = None):
+        self.cache_file = cache_file or Config().community_manifest_cache_file
+        self.all_manifest_path = os.path.join(Config().temp_dir, "all_manifest.json")
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # url -> {"etag", "last_modified", "data"}
+        self._sources: Dict[str, Dict] = self._load_sources()
+        self._snapshot: Optional[Dict] = None
+        # 快照每次替换时加一，供响应缓存判断是否需要重新序列化
+        self.version = 0
+        self._refreshed_at = 0.0
+        self._refresher: Optional[threading.Thread] = None
+
+    def snapshot(self) -> Optional[Dict]:
+        """最后一次成功合并的manifest，还没有刷新过时读取上次保存的文件"""
+        return self.versioned_snapshot()[1]
+
+    def versioned_snapshot(self) -> Tuple[int, Optional[Dict]]:
+        """同时返回(版本, 快照)，两者在同一次加锁中读取，不会被刷新线程拆开"""
+        with self._lock:
+            if self._snapshot is None and os.path.exists(self.all_manifest_path):
+                try:
+                    with open(self.all_manifest_path, 'r', encoding='utf-8') as f:
+                        self._snapshot = json.load(f)
+                    self.version += 1
+                except Exception as e:
+                    logger.warning(f"读取社区manifest快照失败: {e}")
+            return self.version, self._snapshot
+
+    def refresh(self) -> Dict:
+        """并发下载所有启用的manifest并合并，同一时间只有一次刷新"""
+        with self._refresh_lock:
+            config = Config().community
+            urls = [url for url, enabled in config.manifest_urls.items() if enabled]
+            if urls:
+                with ThreadPoolExecutor(max_workers=min(8, len(urls)), thread_name_prefix="community") as executor:
+                    results = list(executor.map(lambda u: self._fetch(u, config.request_timeout), urls))
+            else:
+                results = []
+            composed_manifest = compose_manifests([data for data in results if data is not None])
+
+            with self._lock:
+                self._snapshot = composed_manifest
+                self.version += 1
+                self._refreshed_at = time.time()
+                # 删除已经不在配置中的源
+                self._sources = {u: v for u, v in self._sources.items() if u in config.manifest_urls}
+            self._save(composed_manifest)
+            return composed_manifest
+
+    def start_background_refresh(self) -> None:
+        """启动后台刷新线程，立即刷新一次，之后按配置的间隔刷新"""
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, name="community-manifest", daemon=True)
+            self._refresher.start()
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {"refreshed_at": self._refreshed_at, "sources": len(self._sources)}
+
+    def _refresh_loop(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"刷新社区manifest失败: {e}")
+            time.sleep(max(10, Config().community.refresh_interval_seconds))
+
+    def _fetch(self, url: str, timeout: float) -> Optional[Dict]:
+        """条件请求单个manifest，未变化或失败时返回上次成功解析的结果"""
+        with self._lock:
+            source = self._sources.get(url)
+        headers = {}
+        if source is not None:
+            if source.get("etag"):
+                headers["If-None-Match"] = source["etag"]
+            if source.get("last_modified"):
+                headers["If-Modified-Since"] = source["last_modified"]
+        try:
+            response = self.session.get(url, headers=headers, timeout=timeout)
+            if response.status_code == 304 and source is not None:
+                return source["data"]
+            if response.status_code != 200:
+                print(f"Failed to download manifest from {url}, status code: {response.status_code}")
+                return source["data"] if source else None
+            data = response.json()
+        except Exception as e:
+            print(f"Error processing manifest from {url}: {str(e)}")
+            return source["data"] if source else None
+
+        with self._lock:
+            self._sources[url] = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "data": data,
+            }
+        return data
+
+    def _save(self, composed_manifest: Dict) -> None:
+        """保存合并后的manifest和各个源的验证信息，先写临时文件再替换"""
+        try:
+            verify_folder(self.all_manifest_path)
+            tmp_file = f"{self.all_manifest_path}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(composed_manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.all_manifest_path)
+
+            with self._lock:
+                sources = dict(self._sources)
+            verify_folder(self.cache_file)
+            tmp_file = f"{self.cache_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(sources, f)
+            os.replace(tmp_file, self.cache_file)
+        except Exception as e:
+            print(f"Error saving composed manifest: {str(e)}")
+
+    def _load_sources(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as f:
+                sources = pickle.load(f)
+            return sources if isinstance(sources, dict) else {}
+        except Exception as e:
+            logger.warning(f"读取社区manifest缓存失败: {e}")
+            return {}
+
+
+def compose_manifests(manifests: List[Dict]) -> Dict:
+    """合并多个社区manifest，相同UUID的资源包保留timestamp较新的"""
+    composed_manifest = {}
+    latest_timestamp = 0
+    for manifest_data in manifests:
+        if 'community_info' in manifest_data:
+            community_info = manifest_data['community_info']
+            # 更新最新的timestamp
+            if community_info.get('timestamp', 0) > latest_timestamp:
+                latest_timestamp = community_info['timestamp']
+
+        # 处理meme_libs部分
+        for uuid, lib_info in manifest_data.get('meme_libs', {}).items():
+            meme_libs = composed_manifest.setdefault('meme_libs', {})
+            # UUID不存在或新条目timestamp更大时替换
+            if uuid not in meme_libs or lib_info.get('timestamp', 0) > meme_libs[uuid].get('timestamp', 0):
+                meme_libs[uuid] = lib_info
+
+    composed_manifest['community_info'] = {
+        "timestamp": latest_timestamp
+    }
+    return composed_manifest
+
+
+COMMUNITY_MANIFESTS = CommunityManifestAggregator()
@@ -7,31 +7,43 @@ import openai
 from openai import OpenAI
 import pickle
 from config.settings import Config
-from typing import List, Optional, Union
+from typing import Callable, Dict, List, Optional, Union
 import numpy as np
 
 from tqdm import tqdm
 from services.utils import verify_folder
+from services.metrics import EMBEDDING_CACHE_TOTAL, PROVIDER_ERRORS_TOTAL
 import threading
 
 
 class EmbeddingService:
     def __init__(self):
-        self.api_key = Config().api.embedding_models.api_key
-        self.base_url = Config().api.embedding_models.base_url
-        self.selected_embedding_model = Config().models.selected_embedding_model
         self.embedding_cache = {}
         self._get_embedding_cache()
         self.cache_lock = threading.Lock()
-        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-        self.rpm_monitor = [0]
+        self._config_lock = threading.Lock()
+        self._config_signature = None
+        self.refresh_config()
 
     def refresh_config(self):
-        self.api_key = Config().api.embedding_models.api_key
-        self.base_url = Config().api.embedding_models.base_url
-        self.selected_embedding_model = Config().models.selected_embedding_model
-        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-        self.rpm_monitor = [0]
+        """重新读取API配置；配置没有变化时不重建客户端，并发的搜索中调用也不会互相影响"""
+        config = Config()
+        signature = (config.api.embedding_models.api_key, config.api.embedding_models.base_url,
+                     config.models.selected_embedding_model)
+        with self._config_lock:
+            if signature == self._config_signature:
+                return
+            self.api_key, self.base_url, self.selected_embedding_model = signature
+            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+            self.rpm_monitor = [0]
+            self._config_signature = signature
+
+    def set_api(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        """覆盖配置中的api key和地址并重建客户端，配置文件再次变化前一直有效"""
+        with self._config_lock:
+            self.api_key = api_key or self.api_key
+            self.base_url = base_url or self.base_url
+            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
 
     def _get_embedding_cache(self):
         """获取嵌入缓存"""
@@ -76,10 +88,21 @@ class EmbeddingService:
             embedding = np.array(embedding)
         return embedding / np.linalg.norm(embedding)
 
-    def get_embedding(self, text: str, key: str = None) -> np.ndarray:
+    def get_model_name(self, model: Optional[str] = None) -> str:
+        """
+        将配置中的模型键（如bge-m3）解析为API使用的模型名称（如BAAI/bge-m3）
+        :param model: 模型键，默认为当前选择的嵌入模型
+        """
+        model = model or self.selected_embedding_model
+        embedding_models = Config().models.embedding_models
+        if model not in embedding_models:
+            raise ValueError(f"未知的嵌入模型: {model}")
+        return embedding_models[model].name
+
+    def get_embedding(self, text: str, key: str = None, model: Optional[str] = None) -> np.ndarray:
         """获取文本嵌入并归一化"""
         # API 模式
-        model_name = Config().models.embedding_models['bge-m3'].name
+        model_name = self.get_model_name(model)
         payload = {
             "input": text,
             "model": model_name,
@@ -92,15 +115,19 @@ class EmbeddingService:
                 print(f'using cache: {model_name} {text}')
             embedding = self.embedding_cache[model_name][text]
             self.cache_lock.release()
+            EMBEDDING_CACHE_TOTAL.inc("hit")
         else:
-            # 检查是否指定新的api key，如果指定则更新api key
-            if key is not None and key != self.api_key:
-                self.api_key = key
+            EMBEDDING_CACHE_TOTAL.inc("miss")
             self.cache_lock.release()
+            # 指定了其他api key时只用于这次请求，不修改共享的客户端
+            client = self.client
+            if key is not None and key != self.api_key:
+                client = client.with_options(api_key=key)
             try:
-                response = self.client.embeddings.create(**payload)
+                response = client.embeddings.create(**payload)
                 embedding = response.data[0].embedding
             except openai.OpenAIError as e:
+                PROVIDER_ERRORS_TOTAL.inc("embedding")
                 raise RuntimeError(f"API请求失败: {str(e)}\n请求参数: {payload}")
             self.cache_lock.acquire()
             if model_name not in self.embedding_cache.keys():
@@ -110,4 +137,58 @@ class EmbeddingService:
             self.cache_lock.release()
 
         # 确保返回新的归一化向量
-        return self.normalize_embedding(embedding.copy() if isinstance(embedding, np.ndarray) else embedding)
\ No newline at end of file
+        return self.normalize_embedding(embedding.copy() if isinstance(embedding, np.ndarray) else embedding)
+
+    def has_cached_embedding(self, text: str, model: Optional[str] = None) -> bool:
+        """查询文本的嵌入是否已经在缓存中（不请求API）"""
+        try:
+            model_name = self.get_model_name(model)
+        except ValueError:
+            return False
+        return text in self.embedding_cache.get(model_name, {})
+
+    def get_embeddings(self, texts: List[str], batch_size: int = 32,
+                       progress_callback: Optional[Callable[[int, int], None]] = None,
+                       model: Optional[str] = None) -> Dict[str, np.ndarray]:
+        """
+        批量获取文本嵌入并归一化。
+        输入先去重，已在embedding_cache中的直接复用，其余按batch_size分批请求API，每个文本只请求一次。
+        请求失败的批次会被记录并跳过，调用方可以通过返回结果中缺失的文本判断失败项。
+
+        :param texts: 待嵌入的文本列表，可以包含重复项
+        :param batch_size: 每次API请求包含的文本数量
+        :param progress_callback: 进度回调，参数为(已完成数量, 需要请求的总数量)
+        :param model: 模型键，默认为当前选择的嵌入模型
+        :return: 文本到归一化向量的映射
+        """
+        model_name = self.get_model_name(model)
+        unique_texts = list(dict.fromkeys(t for t in texts if t))
+
+        with self.cache_lock:
+            model_cache = self.embedding_cache.setdefault(model_name, {})
+            missing_texts = [t for t in unique_texts if t not in model_cache]
+
+        total = len(missing_texts)
+        for batch_index, start in enumerate(range(0, total, batch_size)):
+            batch = missing_texts[start:start + batch_size]
+            while self.is_rpm_overload():
+                print(f"RPM过载，等待1秒...")
+                time.sleep(1)
+            try:
+                response = self.client.embeddings.create(input=batch, model=model_name, encoding_format="float")
+            except openai.OpenAIError as e:
+                PROVIDER_ERRORS_TOTAL.inc("embedding")
+                print(f"批量嵌入请求失败: {str(e)}\n请求文本: {batch}")
+                continue
+            with self.cache_lock:
+                for item in response.data:
+                    model_cache[batch[item.index]] = item.embedding
+                self.rpm_monitor.append(time.time())
+                # 定期落盘，避免长时间构建中途失败丢失结果
+                if (batch_index + 1) % 20 == 0:
+                    self.save_embedding_cache()
+            if progress_callback is not None:
+                progress_callback(min(start + batch_size, total), total)
+
+        with self.cache_lock:
+            return {t: self.normalize_embedding(model_cache[t]) for t in unique_texts if t in model_cache}
@@ -0,0 +1,102 @@
+import atexit
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config.settings import Config
+from services.utils import get_file_hash
+from base import *
+
+# 累计这么多条新结果后自动落盘
+_SAVE_EVERY = 256
+
+
+class HashService:
+    """
+    文件hash服务。
+    结果按(绝对路径, 文件大小, mtime)缓存并持久化，文件没有变化时不会重新读取；
+    多个文件在线程池中并行计算。
+    """
+
+    def __init__(self, cache_file: Optional[str] = None, max_workers: Optional[int] = None):
+        self.cache_file = cache_file or Config().file_hash_cache_file
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or min(8, (os.cpu_count() or 1) + 4),
+                                           thread_name_prefix="hash")
+        self._lock = threading.Lock()
+        # (绝对路径, 算法) -> (大小, mtime_ns, hash)
+        self._cache: Dict[Tuple[str, str], Tuple[int, int, str]] = self._load_cache()
+        self._dirty = 0
+        atexit.register(self.save)
+
+    def hash_file(self, file_path: str, algorithm: str = 'sha256') -> Optional[str]:
+        """计算单个文件的hash，文件未变化时直接返回缓存的结果；文件不存在时返回None"""
+        key = (os.path.abspath(file_path), algorithm)
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            print(f"文件 {file_path} 未找到。")
+            return None
+
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+
+        digest = get_file_hash(file_path, algorithm)
+        if digest is None:
+            return None
+        with self._lock:
+            self._cache[key] = (st.st_size, st.st_mtime_ns, digest)
+            self._dirty += 1
+            if self._dirty >= _SAVE_EVERY:
+                self._save_locked()
+        return digest
+
+    def iter_hashes(self, file_paths: Iterable[str], algorithm: str = 'sha256') -> Iterator[Optional[str]]:
+        """并行计算多个文件的hash，按输入顺序逐个返回，调用方可以边计算边处理"""
+        return self.executor.map(lambda p: self.hash_file(p, algorithm), file_paths)
+
+    def hash_files(self, file_paths: Iterable[str], algorithm: str = 'sha256') -> List[Optional[str]]:
+        """并行计算多个文件的hash，按输入顺序返回"""
+        result = list(self.iter_hashes(file_paths, algorithm))
+        self.save()
+        return result
+
+    def invalidate(self, file_path: str) -> None:
+        """丢弃文件的缓存结果，下次重新计算"""
+        path = os.path.abspath(file_path)
+        with self._lock:
+            for key in [k for k in self._cache if k[0] == path]:
+                del self._cache[key]
+
+    def save(self) -> None:
+        with self._lock:
+            if self._dirty:
+                self._save_locked()
+
+    def _save_locked(self) -> None:
+        """写入临时文件后替换，调用时需持有self._lock"""
+        verify_folder(self.cache_file)
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(self._cache, f)
+            os.replace(tmp_file, self.cache_file)
+            self._dirty = 0
+        except Exception as e:
+            logger.warning(f"保存文件hash缓存失败: {e}")
+
+    def _load_cache(self) -> Dict[Tuple[str, str], Tuple[int, int, str]]:
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cache = pickle.load(f)
+            return cache if isinstance(cache, dict) else {}
+        except Exception as e:
+            logger.warning(f"读取文件hash缓存失败: {e}")
+            return {}
+
+
+HASH_SERVICE = HashService()
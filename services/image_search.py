@@ -12,22 +12,22 @@ from stpages.utils import ENDWITH_IMAGE
 
 from services.embedding_service import EmbeddingService
 from services.resource_pack_manager import ResourcePackManager
+from services.resource_pack import RESOURCE_PACK_SERVICE
 from services.utils import *
 from services.llm_enhance import LLMEnhance
 from services.cache_service import CacheService
-import functools
+from services.pack_index import PackIndexStore
+from services.shared_index import SharedIndex
+from services.zip_pack import pack_file_exists
+from services.prefetch import PREFETCH_MANAGER, join_url
+from services.thumbnail import THUMBNAIL_SERVICE
+from services.integrity import INTEGRITY_VERIFIER
+from services.metrics import METRICS, SEARCH_STAGE_SECONDS
 
-def timeit(func):
-    """装饰器：监视函数运行时间"""
 
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        print(f"[timeit] {func.__name__} executed in {end_time - start_time:.4f} seconds")
-        return result
-    return wrapper
+class InvalidSearchRequest(ValueError):
+    """搜索参数错误（如未知的模型），API返回400；其他异常都是服务端错误"""
+
 
 class ImageSearch:
     def __init__(self):
@@ -38,185 +38,352 @@ class ImageSearch:
             self.llm_enhance = LLMEnhance()
         except:
             self.llm_enhance = None
-        self.image_data = None
-        self._try_load_cache()
+        # 按需加载的资源包向量，按(模型, 资源包)分段保存
+        search_config = Config().search
+        shared_index = None
+        if search_config.shared_index:
+            # 多个worker进程共享同一份内存映射的向量
+            shared_index = SharedIndex(Config().shared_index_dir,
+                                       lambda pack_id, model: self.resource_pack_manager.get_pack_cache_file(pack_id, model))
+        self.index_store = PackIndexStore(self._load_pack_items,
+                                          memory_budget_mb=search_config.index_memory_budget_mb,
+                                          idle_seconds=search_config.index_idle_seconds,
+                                          shared_index=shared_index,
+                                          shared_check_seconds=search_config.shared_index_check_seconds)
+        # set_mode指定的模型，为None时跟随配置中的selected_embedding_model
+        self.model_name: Optional[str] = None
+        # 已启用的远程资源包在后台预取缺失的图片
+        for pack_id, pack_info in self.resource_pack_manager.get_enabled_packs().items():
+            PREFETCH_MANAGER.prefetch_pack(pack_id, pack_info)
+        # 后台定期校验已启用资源包的图片
+        INTEGRITY_VERIFIER.start(lambda: self.resource_pack_manager.get_enabled_packs())
 
     # def __reload_class_cache(self):
     #     self.embedding_service = EmbeddingService()
 
-    def _try_load_cache(self) -> None:
+    def _load_pack_items(self, pack_id: str, model_name: str) -> t.List | None:
+        """从磁盘读取资源包缓存，供PackIndexStore按需调用"""
+        items = self.cache_service.load_pack_cache(pack_id, model_name)
+        if not items:
+            return items
+        pack_info = self.resource_pack_manager.get_available_packs().get(pack_id)
+        if Config().misc.adapt_for_old_version:
+            for img in items:
+                if 'filepath' not in img and pack_info:
+                    # 使用资源包的路径
+                    pack_path = pack_info["path"]
+                    if not os.path.isabs(pack_path):
+                        pack_path = os.path.join(Config().base_dir, pack_path)
+                    img['filepath'] = os.path.join(pack_path, img["filename"])
+        items = [img for img in items if 'filepath' in img]
+        # 图片的sha256在加载时从manifest中取出，搜索时不再逐条查找
+        files = pack_info["manifest"].get("contents", {}).get("images", {}).get("files", {}) if pack_info else {}
+        for img in items:
+            img['hash'] = files.get(os.path.basename(img['filepath']), {}).get('hash')
+        return items
+
+    def set_result_formatter(self, formatter: Optional[t.Callable[[str, Optional[str]], str]]) -> None:
+        """
+        设置搜索结果对外返回的URL/标识的计算方式，参数为(图片路径, sha256)。
+        每行的结果在加载资源包向量时计算一次，return_type='public'时直接返回。
+        """
+        if formatter is None:
+            self.index_store.set_row_formatter(None)
+        else:
+            self.index_store.set_row_formatter(lambda img: formatter(img['filepath'], img.get('hash')))
+
+    def _try_load_cache(self, model_name: Optional[str] = None) -> None:
+        """丢弃已加载的向量（默认全部模型），下次搜索时重新从磁盘加载"""
         self.embedding_service.refresh_config()
-        self.image_data = CacheService(self.embedding_service, self.resource_pack_manager).try_load_cache()
+        self.cache_service = CacheService(self.embedding_service, self.resource_pack_manager)
+        self.index_store.evict(model_name=model_name)
 
     def set_mode(self, model_name) -> None:
-        """切换搜索模式和模型"""
-        #TODO: set mode
-        # 清空当前缓存
-        self.image_data = None
-        # 尝试加载新模式/模型的缓存
-        self._try_load_cache()
+        """切换嵌入模型，已加载过的模型可以立即切换"""
+        if model_name not in Config().models.embedding_models:
+            raise ValueError(f"未知的嵌入模型: {model_name}")
+        self.model_name = model_name
 
     def get_model_name(self) -> str:
         """获取当前模型名称"""
-        return self.embedding_service.selected_embedding_model
-
-    def has_cache(self) -> bool:
-        """检查是否有可用的缓存"""
-        return self.image_data is not None
-
-    def generate_cache(self, progress_bar = None) -> None:
+        return self.model_name or self.embedding_service.selected_embedding_model
+
+    def get_loaded_models(self) -> List[str]:
+        """获取已经加载了向量的模型"""
+        return self.index_store.loaded_models()
+
+    def get_index_status(self) -> Dict:
+        """获取资源包向量的加载状态"""
+        status = self.index_store.status()
+        model_name = self.get_model_name()
+        status["model"] = model_name
+        status["integrity"] = INTEGRITY_VERIFIER.status()
+        status["packs"] = [
+            {
+                "pack_id": pack_id,
+                "name": pack_info["name"],
+                "uuid": pack_info["manifest"].get("uuid"),
+                "cache_generated": self.cache_service.has_pack_cache(pack_id, model_name),
+                "loaded": self.index_store.is_loaded(model_name, pack_id),
+            }
+            for pack_id, pack_info in self.resource_pack_manager.get_enabled_packs().items()
+        ]
+        return status
+
+    def has_cache(self, model_name: Optional[str] = None) -> bool:
+        """检查是否有可用的缓存（只检查缓存文件，不加载）"""
+        model_name = model_name or self.get_model_name()
+        return any(self.cache_service.has_pack_cache(pack_id, model_name)
+                   for pack_id in self.resource_pack_manager.get_enabled_packs())
+
+    def generate_cache(self, progress_bar = None, model_name: Optional[str] = None) -> None:
         self.embedding_service.refresh_config()
-        CacheService(self.embedding_service, self.resource_pack_manager).generate_cache(progress_bar)
+        model_name = model_name or self.get_model_name()
+        CacheService(self.embedding_service, self.resource_pack_manager).generate_cache(progress_bar, model_name)
+        # 在进程池中生成缩略图
+        if progress_bar is not None:
+            progress_bar.progress(1.0, text="生成缩略图...")
+        THUMBNAIL_SERVICE.generate_for_packs(self.resource_pack_manager.get_enabled_packs())
         # 重新加载所有缓存
-        progress_bar.progress(1.0, text="重新加载缓存...")
-        self._try_load_cache()
+        if progress_bar is not None:
+            progress_bar.progress(1.0, text="重新加载缓存...")
+        self._try_load_cache(model_name)
         self.embedding_service.refresh_config()
 
+    def _get_target_packs(self, resource_pack_uuids: Optional[List[str]]) -> List[str]:
+        """根据resource_pack_uuids筛选需要搜索的已启用资源包，没有UUID的资源包总是参与搜索"""
+        pack_ids = []
+        for pack_id, pack_info in self.resource_pack_manager.get_enabled_packs().items():
+            if resource_pack_uuids is not None:
+                pack_uuid = pack_info["manifest"].get("uuid", None)
+                if pack_uuid is not None:
+                    if pack_uuid not in resource_pack_uuids:
+                        continue
+                else:
+                    logger.debug(f"资源包 {pack_id} 没有对应的 UUID，不按UUID过滤。")
+            pack_ids.append(pack_id)
+        return pack_ids
+
     def _cosine_similarity(self, a: np.ndarray, b: np.ndarray) -> float:
         """余弦相似度计算"""
         return np.dot(a, b)
 
-    @timeit
     def search(self,
                query: str,
                top_k: int = 5,
                resource_pack_uuids: Optional[List[str]]|None = None,
                api_key: Optional[str] = None,
                use_llm: bool = False,
-               return_type = 'default') -> List[str]:
+               return_type = 'default',
+               model_name: Optional[str] = None) -> List[str]:
+        """语义搜索最匹配的图片"""
+        model_name = self._check_model(model_name)
+        # 等待需要下载的图片，结果按相似度顺序返回
+        events = self._search_events(query, top_k, resource_pack_uuids, api_key, use_llm, return_type, model_name,
+                                     defer=False)
+        return [event['result'] for event in events if event['event'] == 'result']
+
+    def search_stream(self,
+                      query: str,
+                      top_k: int = 5,
+                      resource_pack_uuids: Optional[List[str]]|None = None,
+                      api_key: Optional[str] = None,
+                      use_llm: bool = False,
+                      return_type = 'default',
+                      model_name: Optional[str] = None) -> t.Iterator[Dict]:
+        """
+        流式搜索，参数与search相同，返回的迭代器依次产生事件：
+        {"event": "stage", "stage": 阶段, "seconds": 耗时}
+        {"event": "result", "rank": 序号, "result": 结果}，本地已有的图片先返回，需要下载的图片下载完成后返回
+        {"event": "error", "detail": 错误信息}
+        {"event": "done", "count": 结果数量, "seconds": 总耗时}
+        参数错误时立即抛出InvalidSearchRequest
+        """
+        model_name = self._check_model(model_name)
+        return self._search_events(query, top_k, resource_pack_uuids, api_key, use_llm, return_type, model_name)
+
+    def _check_model(self, model_name: Optional[str]) -> str:
+        """返回实际使用的模型，未知的模型抛出InvalidSearchRequest"""
         self.embedding_service.refresh_config()
+        model_name = model_name or self.get_model_name()
+        if model_name not in Config().models.embedding_models:
+            raise InvalidSearchRequest(f"未知的嵌入模型: {model_name}")
+        return model_name
+
+    def _search_events(self, query, top_k, resource_pack_uuids, api_key, use_llm, return_type,
+                       model_name, defer: bool = True) -> t.Iterator[Dict]:
+        """
+        :param defer: 为True时需要下载的组延后返回，本地已有的结果先返回（rank为返回顺序）；
+                      为False时先等待下载，所有结果按相似度顺序返回
+        """
+        started = time.perf_counter()
+        stage_started = started
+
+        def stage(name: str) -> Dict:
+            nonlocal stage_started
+            now = time.perf_counter()
+            event = {"event": "stage", "stage": name, "seconds": round(now - stage_started, 4)}
+            stage_started = now
+            return event
+
         if use_llm:
             if self.llm_enhance is None:
                 self.llm_enhance = LLMEnhance()
             query = self.llm_enhance.search(query)
-
-        """语义搜索最匹配的图片"""
-        if not self.has_cache():
-            return []
+            yield stage("llm")
+
+        # 只加载本次搜索涉及的资源包
+        segments = []
+        for pack_id in self._get_target_packs(resource_pack_uuids):
+            segment = self.index_store.get(model_name, pack_id)
+            if segment is not None and len(segment) > 0:
+                segments.append(segment)
+        yield stage("load")
+        if not segments:
+            yield {"event": "done", "count": 0, "seconds": round(time.perf_counter() - started, 4)}
+            return
 
         try:
-            query_embedding = self.embedding_service.get_embedding(query, api_key)
+            with SEARCH_STAGE_SECONDS.time("embedding"):
+                query_embedding = self.embedding_service.get_embedding(query, api_key, model=model_name)
         except Exception as e:
             print(f"查询嵌入生成失败: {str(e)}")
-            return []
-
-        similarities = []
-        for img in self.image_data:
-
-            # 排除不在resource_pack_uuids的图片。#TODO：预加载，避免每次都循环
-            if resource_pack_uuids is not None:
-                pack_uuid = self.resource_pack_manager.get_available_packs().get(img['pack_id']).get("manifest").get("uuid", None)
-                if pack_uuid is not None:
-                    if pack_uuid not in resource_pack_uuids:
-                        continue
-                else:
-                    logger.warning(f"图片 {img['filename']} 的 pack_id {img['pack_id']} 没有对应的 UUID，跳过该图片。")
-
-
-
-            if 'filepath' not in img and Config().misc.adapt_for_old_version:
-                # 使用资源包的路径
-                pack_id = img.get('pack_id', 'default_pack')
-                pack_info = self.resource_pack_manager.get_enabled_packs().get(pack_id)
-                if not pack_info:
-                    continue
-                    
-                pack_path = pack_info["path"]
-                if not os.path.isabs(pack_path):
-                    pack_path = os.path.join(Config().base_dir, pack_path)
-
-                img['filepath'] = os.path.join(pack_path, img["filename"])
-                
-            # if os.path.exists(img['filepath']):
-                # similarity = self._cosine_similarity(query_embedding, img['embedding'])
-            similarities.append(({
-                                     'path': img['filepath'],
-                                     'embedding_name': img['embedding_name'],
-                                 "obj": img},
-                                 self._cosine_similarity(query_embedding, img["embedding"])))
-
-        if not similarities:
-            return []
-
-        exists_imgs_path = []
-        # 按相似度降序排序并返回前top_k个结果
-        sorted_items = sorted(similarities, key=lambda x: x[1], reverse=True)
+            yield {"event": "error", "detail": f"查询嵌入生成失败: {str(e)}"}
+            yield {"event": "done", "count": 0, "seconds": round(time.perf_counter() - started, 4)}
+            return
+        yield stage("embedding")
+
+        # 按资源包批量计算相似度，合并后统一排序
+        with SEARCH_STAGE_SECONDS.time("scoring"):
+            all_scores = np.concatenate([segment.scores(query_embedding) for segment in segments])
+            segment_offsets = np.cumsum([0] + [len(segment) for segment in segments])
+
+        def iter_sorted_items():
+            for flat_index in np.argsort(-all_scores, kind='stable'):
+                segment_index = int(np.searchsorted(segment_offsets, flat_index, side='right')) - 1
+                segment = segments[segment_index]
+                row = flat_index - segment_offsets[segment_index]
+                img = segment.items[row]
+                yield ({'path': img['filepath'],
+                        'embedding_name': img['embedding_name'],
+                        'public': segment.public_ids[row] if segment.public_ids is not None else None,
+                        "obj": img},
+                       float(all_scores[flat_index]))
+
+        exists_imgs_path = set()
+        # 按相似度降序取top_k*5个候选
         return_list = []
-        count = 0
         download_list = []
-        for i in sorted_items:
-            if count >= top_k * 5:
+        topk_started = time.perf_counter()
+        exists_seconds = 0.0
+        for i in iter_sorted_items():
+            if len(return_list) >= top_k * 5:
                 break
             if i[0]['path'] not in exists_imgs_path:
-                if not os.path.exists(i[0]['path']):
-                    # 联网检查
-                    url = self.resource_pack_manager.enabled_packs[i[0]['obj']['pack_id']]['url']
+                if INTEGRITY_VERIFIER.is_quarantined(i[0]['path']):
+                    # 与manifest中的hash不一致，等待重新下载
+                    continue
+                exists_started = time.perf_counter()
+                exists = pack_file_exists(i[0]['path'])
+                exists_seconds += time.perf_counter() - exists_started
+                if not exists:
+                    # 联网检查，zip资源包不能写入，不下载
+                    pack_info = self.resource_pack_manager.enabled_packs[i[0]['obj']['pack_id']]
+                    url = pack_info['url'] if pack_info.get('storage') != 'zip' else ''
                     if url:
-                        if os.name == 'nt':  # Windows
-                            rel_path = re.sub(r'^.*?resource_packs\\[^\\]+\\', '', i[0]['path'])
-                        else:  # Unix-like systems (Linux, macOS)
-                            rel_path = re.sub(r'^.*?resource_packs/[^/]+/', '', i[0]['path'])
-                        # rel_path = re.sub(r'^.*?resource_packs\\[^\\]+\\', '', i[0]['path'])
-                        download_list.append([os.path.join(url, rel_path), i[0]['path']])
-                        # if not download_file(os.path.join(url, rel_path), i[0]['path']):
-                        #     continue
+                        rel_path = os.path.relpath(i[0]['path'], pack_info['pack_dir'])
+                        download_list.append((i[0]['obj']['pack_id'], join_url(url, rel_path), i[0]['path'],
+                                              i[0]['obj'].get('hash')))
                     else:
                         logger.error(f"图片不存在: {i[0]['path']}")
                         continue
                 return_list.append(i[0])
-                exists_imgs_path.append(i[0]['path'])
-                count += 1
-        # 联网下载不存在的图片
-        download_files(download_list)
-
-        # 随机化输出 去除重复图片
-
-        skip_indexes = []
-        return_list_2 = []
-        for index, i in enumerate(return_list):
+                exists_imgs_path.add(i[0]['path'])
+        # 排序和取候选（不含文件存在检查）
+        SEARCH_STAGE_SECONDS.observe(time.perf_counter() - topk_started - exists_seconds, "topk")
+        SEARCH_STAGE_SECONDS.observe(exists_seconds, "file_exists")
+        # 不存在的图片插队到后台下载队列的最前面，本地已有的结果先返回
+        pending = {item[2] for item in download_list}
+        landed = PREFETCH_MANAGER.fetch_iter(download_list, timeout=Config().prefetch.search_wait_seconds) \
+            if download_list else iter(())
+
+        # 相同embedding_name的图片为一组，组内随机排序并去除相似的图片
+        groups: Dict[str, List[Dict]] = {}
+        for i in return_list:
+            groups.setdefault(i['embedding_name'], []).append(i)
+        groups = list(groups.values())
+        yield stage("ranking")
+
+        returned_paths = []
+        dedupe_seconds = 0.0
+
+        def finish_group(group: List[Dict]) -> t.Iterator[Dict]:
+            nonlocal dedupe_seconds
+            dedupe_started = time.perf_counter()
             # 验证图片是否存在
-            if not os.path.exists(i['path']):
-                continue
-            if len(return_list_2) >= top_k:
-                break
-            if index in skip_indexes:
-                continue
-            randomize_list = [i]
-            for jndex, j in enumerate(return_list[index + 1:]):
-                if i['embedding_name'] == j['embedding_name']:
-                    randomize_list.append(j)
-                    skip_indexes.append(index + jndex + 1)
-            if len(randomize_list) >= 2:
-                random.shuffle(randomize_list)
-                if 'hash' in return_type:
-                    popped_rand_list = pop_similar_images(randomize_list)
-                    for rand_i in popped_rand_list:
-                        pack_id = rand_i['obj']['pack_id']
-                        hash_id = self.resource_pack_manager.available_packs.get(pack_id).get('manifest').get('contents').get('images').get('files').get(os.path.basename(rand_i['path'])).get('hash')
-                        return_list_2.append([rand_i['path'], hash_id])
-                else:
-                    return_list_2 += [i['path'] for i in pop_similar_images(randomize_list)]
+            group = [i for i in group if pack_file_exists(i['path'])]
+            if len(group) >= 2:
+                random.shuffle(group)
+                group = pop_similar_images(group)
+            dedupe_seconds += time.perf_counter() - dedupe_started
+            for i in group:
+                returned_paths.append(i['path'])
+                yield {"event": "result", "rank": len(returned_paths) - 1,
+                       "result": self._result_value(i, return_type)}
+
+        if not defer and pending:
+            download_started = time.perf_counter()
+            for _ in landed:
+                pass
+            # 超时或下载失败的图片在finish_group中被过滤，由排名靠后的组补足
+            pending.clear()
+            SEARCH_STAGE_SECONDS.observe(time.perf_counter() - download_started, "download")
+            yield stage("download")
+
+        # 按排名依次处理，需要下载的组先按一个结果计入，下载完成后再返回
+        deferred = []
+        next_group = 0
+        while next_group < len(groups) and len(returned_paths) + len(deferred) < top_k:
+            group = groups[next_group]
+            next_group += 1
+            if any(i['path'] in pending for i in group):
+                deferred.append(group)
             else:
-                if 'hash' in return_type:
-                    pack_id = i['obj']['pack_id']
-                    hash_id = self.resource_pack_manager.available_packs.get(pack_id).get('manifest').get('contents').get('images').get('files').get(os.path.basename(i['path'])).get('hash')
-                    # print(123)
-                    # print(pack_id, hash_id)
-                    return_list_2.append([i['path'], hash_id])
-                else:
-                    return_list_2.append(i['path'])
-
-
-
-
-        return return_list_2
-        # # 按相似度排序
-        # similarities.sort(reverse=True)
-        #
-        # # 返回前top_k个结果
-        # return [item[1] for item in similarities[:top_k]]
-
-
+                yield from finish_group(group)
+        yield stage("local")
+
+        if deferred:
+            download_started = time.perf_counter()
+            for path in landed:
+                pending.discard(path)
+                for group in [g for g in deferred if not any(i['path'] in pending for i in g)]:
+                    deferred.remove(group)
+                    yield from finish_group(group)
+                if not deferred:
+                    break
+            SEARCH_STAGE_SECONDS.observe(time.perf_counter() - download_started, "download")
+            # 超时或下载失败的图片这次不返回
+            for group in deferred:
+                yield from finish_group(group)
+            # 下载失败导致结果不足时用排名靠后的组补足
+            while next_group < len(groups) and len(returned_paths) < top_k:
+                yield from finish_group(groups[next_group])
+                next_group += 1
+            yield stage("download")
+
+        PREFETCH_MANAGER.record_hits(returned_paths)
+        SEARCH_STAGE_SECONDS.observe(dedupe_seconds, "dedupe")
+        SEARCH_STAGE_SECONDS.observe(time.perf_counter() - started, "total")
+        yield {"event": "done", "count": len(returned_paths), "seconds": round(time.perf_counter() - started, 4)}
+
+    @staticmethod
+    def _result_value(item: Dict, return_type: str):
+        """按return_type取出结果：图片路径、[路径, sha256]、或预先计算的对外URL"""
+        if return_type == 'public' and item['public'] is not None:
+            return item['public']
+        if 'hash' in return_type:
+            return [item['path'], item['obj'].get('hash')]
+        return item['path']
 
     def reload_resource_packs(self) -> None:
         """重新加载资源包"""
@@ -224,19 +391,58 @@ class ImageSearch:
         self._try_load_cache()
         
     def enable_resource_pack(self, pack_id: str) -> bool:
-        """启用资源包"""
+        """启用资源包，只加载这一个资源包的向量"""
+        pack_info = self.resource_pack_manager.get_available_packs().get(pack_id)
+        if pack_info is None or pack_info["enabled"]:
+            return False
+        # 先加载向量再标记为启用，搜索不会看到已启用但没有向量的资源包
+        self.index_store.attach(self.get_model_name(), pack_id)
         result = self.resource_pack_manager.enable_pack(pack_id)
         if result:
-            self._try_load_cache()
+            # 远程资源包在后台按热度预取图片
+            PREFETCH_MANAGER.prefetch_pack(pack_id, pack_info)
         return result
         
     def disable_resource_pack(self, pack_id: str) -> bool:
-        """禁用资源包"""
+        """禁用资源包，只释放这一个资源包的向量"""
         result = self.resource_pack_manager.disable_pack(pack_id)
         if result:
-            self._try_load_cache()
+            # 先标记为禁用，新的搜索不再使用这个资源包，再释放向量
+            self.index_store.detach(pack_id)
+            PREFETCH_MANAGER.cancel_pack(pack_id)
         return result
         
+    def delete_resource_pack(self, pack_id: str) -> bool:
+        """删除资源包及其所有模型的缓存"""
+        pack_info = self.resource_pack_manager.remove_pack(pack_id)
+        if pack_info is None:
+            return False
+        self.index_store.detach(pack_id)
+        for model_name in Config().models.embedding_models:
+            cache_file = self.resource_pack_manager.get_pack_cache_file(pack_id, model_name)
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+        RESOURCE_PACK_SERVICE.delete_resource_pack(pack_id, pack_info["pack_dir"])
+        return True
+        
+    def refresh_resource_pack(self, pack_id: str) -> Optional[Dict]:
+        """资源包更新后重新读取manifest，增量更新已生成的缓存，并重新加载这个资源包的向量"""
+        pack_info = self.resource_pack_manager.reload_pack(pack_id)
+        if pack_info is None:
+            return None
+        for model_name in Config().models.embedding_models:
+            if not self.cache_service.has_pack_cache(pack_id, model_name):
+                continue
+            try:
+                added = self.cache_service.update_pack_cache(pack_id, pack_info, model_name)
+                logger.info(f"已增量更新资源包 {pack_id} 的缓存 ({model_name})，新增 {added} 条")
+            except Exception as e:
+                logger.error(f"增量更新资源包 {pack_id} 的缓存失败 ({model_name}): {e}")
+        self.index_store.detach(pack_id)
+        if pack_info["enabled"]:
+            self.index_store.attach(self.get_model_name(), pack_id)
+        return pack_info
+
     def get_resource_packs(self) -> Dict[str, Dict]:
         """获取所有资源包"""
         return self.resource_pack_manager.get_available_packs()
@@ -268,4 +474,12 @@ def pop_similar_images(input_image_list, threshold=0.9):
 
     return return_images
 
-IMAGE_SEARCH_SERVICE = ImageSearch()
\ No newline at end of file
+IMAGE_SEARCH_SERVICE = ImageSearch()
+
+# 已加载资源包的向量规模，输出指标时读取
+METRICS.gauge("mememeow_index_rows", "已加载资源包的向量行数", ["model", "pack_id"],
+              collector=lambda: {(s["model"], s["pack_id"]): s["rows"]
+                                 for s in IMAGE_SEARCH_SERVICE.index_store.status()["segments"]})
+METRICS.gauge("mememeow_index_bytes", "已加载资源包的向量内存占用", ["model", "pack_id"],
+              collector=lambda: {(s["model"], s["pack_id"]): s["bytes"]
+                                 for s in IMAGE_SEARCH_SERVICE.index_store.status()["segments"]})
@@ -0,0 +1,140 @@
+import mimetypes
+import os
+import re
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+
+from config.settings import Config
+from services.integrity import INTEGRITY_VERIFIER
+from services.response_cache import etag_matches
+from services.prefetch import PREFETCH_MANAGER, join_url
+from services.thumbnail import THUMBNAIL_SERVICE
+from services.zip_pack import pack_file_exists, read_pack_file, split_zip_path
+from base import *
+
+# <sha256>[_<缩略图尺寸>][.<扩展名>]
+_NAME_PATTERN = re.compile(r'^([0-9a-f]{64})(?:_(\d+))?(?:\.[0-9A-Za-z]+)?$')
+_RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+# 内容按hash寻址，永远不会变化
+_IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+class ImageServer:
+    """
+    按sha256提供图片，/img/<hash>.<扩展名> 返回原图，/img/<hash>_<尺寸>.webp 返回缩略图。
+    hash到文件的索引由已启用资源包的manifest生成，资源包变化后（字典被整体替换）自动重建。
+    普通文件交给FileResponse（支持Range，服务器支持时零拷贝发送），zip资源包中的图片直接切片内存映射。
+    """
+
+    def __init__(self, packs_getter: Callable[[], Dict[str, Dict]]):
+        self.packs_getter = packs_getter
+        self._lock = threading.Lock()
+        self._packs: Optional[Dict[str, Dict]] = None
+        # sha256 -> (pack_id, 图片路径)
+        self._index: Dict[str, Tuple[str, str]] = {}
+
+    def resolve(self, file_hash: str) -> Optional[Tuple[str, str]]:
+        """返回(pack_id, 图片路径)，未知的hash返回None"""
+        packs = self.packs_getter()
+        if packs is not self._packs:
+            self._rebuild(packs)
+        return self._index.get(file_hash)
+
+    def status(self) -> Dict:
+        return {"images": len(self._index)}
+
+    async def respond(self, request: Request, name: str) -> Response:
+        match = _NAME_PATTERN.match(name.lower())
+        if match is None:
+            return Response(status_code=404)
+        file_hash, size = match.group(1), match.group(2)
+        entry = self.resolve(file_hash)
+        if entry is None:
+            # 不属于任何已启用资源包的hash，不能用304确认它存在
+            return Response(status_code=404)
+        if size is not None:
+            size = THUMBNAIL_SERVICE.pick_size(int(size))
+            etag = f'"{file_hash}_{size}"'
+        else:
+            etag = f'"{file_hash}"'
+        headers = {"ETag": etag, "Cache-Control": _IMMUTABLE}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+
+        if size is not None:
+            path = THUMBNAIL_SERVICE.thumbnail_path(file_hash, size)
+            if not os.path.exists(path):
+                if not await run_in_threadpool(self._ensure_local, file_hash, entry):
+                    return Response(status_code=404)
+                path = await run_in_threadpool(THUMBNAIL_SERVICE.get_thumbnail, entry[1], size, file_hash)
+                if path == entry[1]:
+                    # 生成失败时返回原图，之后可能生成成功，不能让客户端永久缓存
+                    return self._send(request, path, {"ETag": f'"{file_hash}"', "Cache-Control": "no-cache"})
+            return self._send(request, path, headers)
+
+        if not await run_in_threadpool(self._ensure_local, file_hash, entry):
+            return Response(status_code=404)
+        return self._send(request, entry[1], headers)
+
+    def _rebuild(self, packs: Dict[str, Dict]) -> None:
+        index = {}
+        for pack_id, pack_info in packs.items():
+            for file_info in pack_info["manifest"].get("contents", {}).get("images", {}).get("files", {}).values():
+                if not file_info.get("hash"):
+                    continue
+                path = safe_join(pack_info["pack_dir"], file_info["filepath"])
+                if path is None:
+                    logger.warning(f"资源包 {pack_id} 中的路径超出资源包目录，不提供访问: {file_info['filepath']}")
+                    continue
+                index[file_info["hash"]] = (pack_id, path)
+        with self._lock:
+            self._index = index
+            self._packs = packs
+        logger.debug(f"图片hash索引已重建: {len(index)} 个图片")
+
+    def _ensure_local(self, file_hash: str, entry: Tuple[str, str]) -> bool:
+        """图片存在且未被隔离；远程资源包中缺失的图片插队下载，只等待有限的时间"""
+        pack_id, path = entry
+        if INTEGRITY_VERIFIER.is_quarantined(path):
+            return False
+        if pack_file_exists(path):
+            return True
+        pack_info = self.packs_getter().get(pack_id)
+        if not pack_info or not pack_info.get("url") or pack_info.get("storage") == "zip":
+            return False
+        url = join_url(pack_info["url"], os.path.relpath(path, pack_info["pack_dir"]))
+        return PREFETCH_MANAGER.fetch([(pack_id, url, path, file_hash)],
+                                      timeout=Config().prefetch.search_wait_seconds) > 0
+
+    @staticmethod
+    def _send(request: Request, path: str, headers: Dict[str, str]) -> Response:
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if split_zip_path(path) is None:
+            return FileResponse(path, media_type=media_type, headers=headers)
+        return _bytes_response(request, read_pack_file(path), media_type, headers)
+
+
+def _bytes_response(request: Request, data, media_type: str, headers: Dict[str, str]) -> Response:
+    """zip资源包中的图片，支持单个Range"""
+    total = len(data)
+    headers = {**headers, "Accept-Ranges": "bytes"}
+    range_header = request.headers.get("range")
+    match = _RANGE_PATTERN.match(range_header.strip()) if range_header else None
+    if match is None or not (match.group(1) or match.group(2)):
+        # 没有Range或者是多个区间，返回完整内容
+        return Response(bytes(data), media_type=media_type, headers=headers)
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+    else:
+        start = max(0, total - int(match.group(2)))
+        end = total - 1
+    if start >= total or start > end:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{total}"})
+    headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    return Response(bytes(data[start:end + 1]), status_code=206, media_type=media_type, headers=headers)
+
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from config.settings import Config
+from services.blob_store import BLOB_STORE
+from services.hash_service import HASH_SERVICE
+from services.utils import get_file_hash
+from services.prefetch import PREFETCH_MANAGER, PRIORITY_PREFETCH, join_url
+from services.zip_pack import pack_file_exists, read_pack_file, split_zip_path
+from base import *
+
+
+class IntegrityVerifier:
+    """
+    资源包完整性校验。
+    后台定期按manifest中的hash重新计算图片的hash，
+    不一致的图片加入隔离列表，搜索时跳过；远程资源包的图片会删除后重新下载。
+    校验限制了读取速度和线程数，不影响前台的读写。
+    """
+
+    def __init__(self, results_file: Optional[str] = None):
+        config = Config().integrity
+        self.results_file = results_file or Config().integrity_results_file
+        self.max_workers = config.max_workers
+        self.max_bytes_per_second = config.max_mb_per_second * 1024 * 1024
+        self._lock = threading.Lock()
+        # 图片路径 -> {"pack_id", "expected", "actual", "checked_at"}
+        self._quarantine: Dict[str, Dict] = {}
+        self._last_run: Dict = {}
+        self._load_results()
+        # 搜索时无锁读取，每次变化时整体替换
+        self.quarantined: FrozenSet[str] = frozenset(self._quarantine)
+        self._budget_lock = threading.Lock()
+        self._budget_started = time.monotonic()
+        self._budget_bytes = 0
+        self._scheduler: Optional[threading.Thread] = None
+
+    def is_quarantined(self, path: str) -> bool:
+        return path in self.quarantined
+
+    def start(self, packs_getter) -> None:
+        """启动定期校验的后台线程，packs_getter返回需要校验的资源包"""
+        config = Config().integrity
+        if not config.enabled:
+            return
+        with self._lock:
+            if self._scheduler is not None:
+                return
+            self._scheduler = threading.Thread(target=self._schedule_loop, args=(packs_getter, config),
+                                               name="integrity-verifier", daemon=True)
+            self._scheduler.start()
+
+    def verify_packs(self, packs: Dict[str, Dict]) -> Dict:
+        """校验资源包中所有带hash的图片，返回本次校验的统计"""
+        started = time.time()
+        jobs = []
+        for pack_id, pack_info in packs.items():
+            for file_info in pack_info["manifest"].get("contents", {}).get("images", {}).get("files", {}).values():
+                if file_info.get("hash"):
+                    jobs.append((pack_id, pack_info, file_info))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="integrity") as executor:
+            results = list(executor.map(lambda job: self._verify_file(*job), jobs))
+
+        bad = [r for r in results if r is not None and not r[1]]
+        redownload = []
+        with self._lock:
+            for result in results:
+                if result is None:
+                    continue
+                path, ok, pack_id, pack_info, file_info, actual = result
+                if ok:
+                    self._quarantine.pop(path, None)
+                    continue
+                self._quarantine[path] = {"pack_id": pack_id, "expected": file_info["hash"],
+                                          "actual": actual, "checked_at": time.time()}
+                if pack_info.get("url") and pack_info.get("storage") != "zip":
+                    redownload.append((pack_id, join_url(pack_info["url"], file_info["filepath"]), path,
+                                       file_info["hash"]))
+            self._last_run = {
+                "started_at": started,
+                "finished_at": time.time(),
+                "checked": sum(1 for r in results if r is not None),
+                "missing": sum(1 for r in results if r is None),
+                "mismatched": len(bad),
+            }
+            self.quarantined = frozenset(self._quarantine)
+        self._save_results()
+        if bad:
+            logger.warning(f"完整性校验发现 {len(bad)} 个图片与manifest中的hash不一致，已隔离")
+            # 资源包中的图片是共享存储的硬链接，损坏的通常是blob本身，删除后重新下载或导入时才会重建
+            for file_hash in {r[4]["hash"] for r in bad}:
+                BLOB_STORE.evict_if_corrupt(file_hash)
+        if redownload:
+            self._redownload(redownload)
+        return self.status()
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {"last_run": dict(self._last_run), "quarantined": len(self._quarantine)}
+
+    def _verify_file(self, pack_id: str, pack_info: Dict, file_info: Dict):
+        """返回(路径, 是否一致, pack_id, pack_info, file_info, 实际hash)，文件不存在或路径无效时返回None"""
+        path = safe_join(pack_info["pack_dir"], file_info["filepath"])
+        if path is None or not pack_file_exists(path):
+            return None
+        if split_zip_path(path) is None:
+            self._throttle(os.path.getsize(path))
+            # 不使用HashService的缓存，大小和修改时间不变的损坏也要能发现
+            actual = get_file_hash(path)
+        else:
+            data = read_pack_file(path)
+            self._throttle(len(data))
+            actual = hashlib.sha256(data).hexdigest()
+        return path, actual == file_info["hash"], pack_id, pack_info, file_info, actual
+
+    def _throttle(self, nbytes: int) -> None:
+        """限制校验的读取速度，超出预算时等待"""
+        if not self.max_bytes_per_second:
+            return
+        with self._budget_lock:
+            now = time.monotonic()
+            if now - self._budget_started >= 1:
+                self._budget_started = now
+                self._budget_bytes = 0
+            self._budget_bytes += nbytes
+            wait = self._budget_bytes / self.max_bytes_per_second - (now - self._budget_started)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _redownload(self, items: List[Tuple[str, str, str, str]]) -> None:
+        """
+        删除损坏的图片后重新下载，下载完成并校验通过的移出隔离列表。
+        损坏的blob已经在校验时删除，下载不会再链接到它，校验通过的下载会重新加入共享存储
+        """
+        for _, _, path, _ in items:
+            HASH_SERVICE.invalidate(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        PREFETCH_MANAGER.fetch(items, timeout=None, priority=PRIORITY_PREFETCH)
+        with self._lock:
+            for _, _, path, file_hash in items:
+                if os.path.exists(path) and HASH_SERVICE.hash_file(path) == file_hash:
+                    self._quarantine.pop(path, None)
+            self.quarantined = frozenset(self._quarantine)
+        self._save_results()
+
+    def _schedule_loop(self, packs_getter, config) -> None:
+        time.sleep(config.startup_delay_seconds)
+        while True:
+            try:
+                self.verify_packs(packs_getter())
+            except Exception as e:
+                logger.error(f"完整性校验失败: {e}")
+            time.sleep(max(60, config.interval_seconds))
+
+    def _load_results(self) -> None:
+        if not os.path.exists(self.results_file):
+            return
+        try:
+            with open(self.results_file, 'r', encoding='utf-8') as f:
+                results = json.load(f)
+            self._quarantine = results.get("quarantine", {})
+            self._last_run = results.get("last_run", {})
+        except Exception as e:
+            logger.warning(f"读取完整性校验结果失败: {e}")
+
+    def _save_results(self) -> None:
+        with self._lock:
+            results = {"quarantine": dict(self._quarantine), "last_run": dict(self._last_run)}
+        verify_folder(self.results_file)
+        tmp_file = f"{self.results_file}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.results_file)
+        except Exception as e:
+            logger.warning(f"保存完整性校验结果失败: {e}")
+
+
+INTEGRITY_VERIFIER = IntegrityVerifier()
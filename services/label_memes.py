@@ -1,6 +1,7 @@
 import base64
 
 from services.utils import *
+from services.hash_service import HASH_SERVICE
 from config.settings import Config
 import cv2
 from PIL import Image, ImageEnhance
@@ -110,8 +111,9 @@ class LabelMemes():
         if not model_name in self.cache.keys():
             self.cache[model_name] = {}
 
-        if get_file_hash(image_path) in self.cache[model_name] and self.use_cache:
-            return self._analyze_result_text(self.cache[model_name][get_file_hash(image_path)]['description'])
+        file_hash = HASH_SERVICE.hash_file(image_path)
+        if file_hash in self.cache[model_name] and self.use_cache:
+            return self._analyze_result_text(self.cache[model_name][file_hash]['description'])
 
 
         # 读取图像
@@ -197,7 +199,7 @@ class LabelMemes():
             description = response.choices[0].message.content
             
             # 缓存结果
-            self.cache[model_name][get_file_hash(image_path)] = {
+            self.cache[model_name][file_hash] = {
                 'description': description,
                 'raw': response.json()
             }
@@ -0,0 +1,127 @@
+import json
+import os
+import pickle
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from config.settings import Config
+from services.zip_pack import get_zip_reader
+from base import *
+
+
+class PackDiscovery:
+    """
+    资源包发现：扫描resource_packs目录并解析每个资源包的manifest.json。
+    解析结果按manifest的(mtime, size)缓存，并持久化到磁盘，
+    重新扫描时只有发生变化的manifest才会被重新解析。
+    同一进程内的所有ResourcePackManager共用一个实例。
+
+    返回的manifest字典在多个组件之间共享，应当视为只读。
+    """
+
+    def __init__(self, snapshot_file: Optional[str] = None):
+        self.snapshot_file = snapshot_file or Config().pack_discovery_cache_file
+        # manifest路径 -> {"mtime_ns", "size", "manifest"}
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._snapshot_loaded = False
+
+    def scan(self, resource_packs_dir: str) -> List[Tuple[str, str, Dict]]:
+        """
+        扫描资源包目录
+        :return: [(名称, 资源包目录或zip路径, manifest), ...]，按名称排序
+        """
+        if not os.path.exists(resource_packs_dir):
+            return []
+
+        with self._lock:
+            self._load_snapshot()
+            changed = False
+            seen = set()
+            result = []
+            items = sorted(os.listdir(resource_packs_dir))
+            names = set(items)
+            for item in items:
+                pack_dir = os.path.join(resource_packs_dir, item)
+                if item.lower().endswith('.zip'):
+                    # zip资源包不解压，直接读取zip中的manifest，按zip文件本身的变化判断
+                    name = item[:-4]
+                    if name in names:
+                        # 同名的目录资源包优先
+                        continue
+                    manifest_path = pack_dir
+                else:
+                    name = item
+                    manifest_path = os.path.join(pack_dir, "manifest.json")
+                try:
+                    st = os.stat(manifest_path)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                seen.add(manifest_path)
+
+                entry = self._entries.get(manifest_path)
+                if entry is None or entry["mtime_ns"] != st.st_mtime_ns or entry["size"] != st.st_size:
+                    try:
+                        manifest = _read_manifest(manifest_path)
+                    except Exception as e:
+                        logger.error(f"加载资源包 {item} 失败: {e}")
+                        continue
+                    entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "manifest": manifest}
+                    self._entries[manifest_path] = entry
+                    changed = True
+                result.append((name, pack_dir, entry["manifest"]))
+
+            # 只清理这个目录下已经不存在的资源包
+            prefix = os.path.join(resource_packs_dir, "")
+            for manifest_path in [p for p in self._entries if p.startswith(prefix) and p not in seen]:
+                del self._entries[manifest_path]
+                changed = True
+
+            if changed:
+                self._save_snapshot()
+        return result
+
+    def invalidate(self, manifest_path: Optional[str] = None) -> None:
+        """丢弃缓存的解析结果，参数为None时全部丢弃"""
+        with self._lock:
+            if manifest_path is None:
+                self._entries = {}
+            else:
+                self._entries.pop(manifest_path, None)
+
+    def _load_snapshot(self) -> None:
+        """第一次扫描时读取持久化的快照，调用时需持有self._lock"""
+        if self._snapshot_loaded:
+            return
+        self._snapshot_loaded = True
+        if not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                entries = pickle.load(f)
+            if isinstance(entries, dict):
+                self._entries = entries
+        except Exception as e:
+            logger.warning(f"读取资源包发现快照失败，将重新扫描: {e}")
+
+    def _save_snapshot(self) -> None:
+        """写入临时文件后替换，避免并发读到不完整的快照，调用时需持有self._lock"""
+        verify_folder(self.snapshot_file)
+        tmp_file = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(self._entries, f)
+            os.replace(tmp_file, self.snapshot_file)
+        except Exception as e:
+            logger.warning(f"保存资源包发现快照失败: {e}")
+
+
+def _read_manifest(manifest_path: str) -> Dict:
+    """读取manifest，参数为zip文件时读取其中的manifest.json"""
+    if manifest_path.lower().endswith('.zip'):
+        return get_zip_reader(manifest_path).read_json("manifest.json")
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+PACK_DISCOVERY = PackDiscovery()
@@ -0,0 +1,242 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from base import *
+
+# 估算每条元数据（文件名、路径、标签等字典）占用的内存
+_ITEM_OVERHEAD_BYTES = 512
+
+
+class PackSegment:
+    """单个资源包在某个嵌入模型下的向量数据"""
+
+    def __init__(self, pack_id: str, model_name: str, items: List[Dict],
+                 embeddings: Optional[np.ndarray] = None, version: Optional[str] = None):
+        """
+        :param items: 缓存数据；同时传入embeddings时为不含向量的元数据
+        :param embeddings: 已经合并好的向量矩阵（如共享索引的内存映射）
+        :param version: 共享索引的版本，非共享模式为None
+        """
+        self.pack_id = pack_id
+        self.model_name = model_name
+        self.version = version
+        if embeddings is not None:
+            self.embeddings = embeddings
+        elif items:
+            self.embeddings = np.vstack([np.asarray(i['embedding'], dtype=np.float32) for i in items])
+        else:
+            self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        # 向量已经合并到矩阵中，元数据里不再保留一份
+        self.items = [{k: v for k, v in i.items() if k != 'embedding'} for i in items]
+        # 每行对外返回的URL/标识，由PackIndexStore的row_formatter在加载时计算一次
+        self.public_ids: Optional[List[str]] = None
+        self.nbytes = self.embeddings.nbytes + len(self.items) * _ITEM_OVERHEAD_BYTES
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.checked_at = self.loaded_at
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def touch(self) -> None:
+        self.last_used = time.time()
+        self.hits += 1
+
+    def scores(self, query_embedding: np.ndarray) -> np.ndarray:
+        """计算查询向量与所有图片向量的余弦相似度（向量均已归一化）"""
+        if not self.items:
+            return np.zeros(0, dtype=np.float32)
+        return self.embeddings @ query_embedding.astype(np.float32)
+
+    def status(self) -> Dict:
+        return {
+            "pack_id": self.pack_id,
+            "model": self.model_name,
+            "rows": len(self.items),
+            "bytes": self.nbytes,
+            "loaded_at": self.loaded_at,
+            "last_used": self.last_used,
+            "hits": self.hits,
+            "shared": isinstance(self.embeddings, np.memmap),
+            "version": self.version,
+        }
+
+
+class PackIndexStore:
+    """
+    按需加载资源包向量。
+    每个(模型, 资源包)第一次被搜索时才从磁盘读取，之后常驻内存；
+    超出内存预算时按LRU淘汰，长时间未使用的资源包由后台线程释放。
+    """
+
+    def __init__(self,
+                 loader: Callable[[str, str], Optional[List[Dict]]],
+                 memory_budget_mb: int = 1024,
+                 idle_seconds: int = 1800,
+                 shared_index=None,
+                 shared_check_seconds: int = 5,
+                 row_formatter: Optional[Callable[[Dict], str]] = None):
+        """
+        :param loader: 读取资源包缓存的函数，参数为(pack_id, model_name)，缓存不存在时返回None
+        :param memory_budget_mb: 已加载向量的内存预算
+        :param idle_seconds: 超过这个时间未被使用的资源包会被释放，0表示不释放
+        :param shared_index: SharedIndex，设置后向量从多个进程共享的内存映射文件加载
+        :param shared_check_seconds: 共享模式下检查新版本的间隔
+        :param row_formatter: 根据元数据计算每行对外返回的URL/标识，加载时预先计算
+        """
+        self.loader = loader
+        self.shared_index = shared_index
+        self.shared_check_seconds = shared_check_seconds
+        self.row_formatter = row_formatter
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.idle_seconds = idle_seconds
+        self._segments: "OrderedDict[Tuple[str, str], PackSegment]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 每个(模型, 资源包)一把加载锁，避免并发请求重复读盘
+        self._loading_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._sweeper: Optional[threading.Thread] = None
+
+    def get(self, model_name: str, pack_id: str, touch: bool = True) -> Optional[PackSegment]:
+        """获取资源包的向量数据，未加载时从磁盘加载；没有缓存时返回None"""
+        key = (model_name, pack_id)
+        with self._lock:
+            segment = self._segments.get(key)
+            if segment is not None and not self._needs_check(segment):
+                self._segments.move_to_end(key)
+                if touch:
+                    segment.touch()
+                return segment
+            loading_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+        with loading_lock:
+            # 等待期间可能已经被其他线程加载
+            with self._lock:
+                segment = self._segments.get(key)
+            if segment is not None and self._needs_check(segment):
+                segment.checked_at = time.time()
+                if self.shared_index.is_stale(segment):
+                    # 有新版本发布，重新映射
+                    segment = None
+            if segment is None:
+                segment = self._load_segment(model_name, pack_id)
+                if segment is None:
+                    return None
+                logger.info(f"已加载资源包 {pack_id} ({model_name}): {len(segment)} 条, {segment.nbytes / 1024 / 1024:.1f} MB")
+                with self._lock:
+                    self._segments[key] = segment
+                    self._enforce_budget(keep=key)
+            if touch:
+                segment.touch()
+
+        self._ensure_sweeper()
+        return segment
+
+    def set_row_formatter(self, row_formatter: Optional[Callable[[Dict], str]]) -> None:
+        """更换row_formatter，已加载的资源包全部释放，下次使用时重新计算"""
+        self.row_formatter = row_formatter
+        self.clear()
+
+    def _load_segment(self, model_name: str, pack_id: str) -> Optional[PackSegment]:
+        if self.shared_index is not None:
+            segment = self.shared_index.load(model_name, pack_id, self.loader)
+        else:
+            items = self.loader(pack_id, model_name)
+            segment = PackSegment(pack_id, model_name, items) if items is not None else None
+        if segment is not None and self.row_formatter is not None:
+            segment.public_ids = [self.row_formatter(item) for item in segment.items]
+        return segment
+
+    def _needs_check(self, segment: PackSegment) -> bool:
+        """共享模式下每隔一段时间检查一次是否有新版本"""
+        return (self.shared_index is not None
+                and time.time() - segment.checked_at >= self.shared_check_seconds)
+
+    def attach(self, model_name: str, pack_id: str) -> Optional[PackSegment]:
+        """
+        加载单个资源包的向量并加入索引，其他已加载的资源包不受影响。
+        读盘在锁外进行，加入索引只是一次字典赋值，正在进行的搜索不会被阻塞。
+        """
+        return self.get(model_name, pack_id, touch=False)
+
+    def detach(self, pack_id: str) -> int:
+        """从索引中移除单个资源包（所有模型），返回移除的数量"""
+        return self.evict(pack_id=pack_id)
+
+    def is_loaded(self, model_name: str, pack_id: str) -> bool:
+        return (model_name, pack_id) in self._segments
+
+    def evict(self, model_name: Optional[str] = None, pack_id: Optional[str] = None) -> int:
+        """释放匹配的资源包，参数为None表示匹配全部，返回释放的数量"""
+        with self._lock:
+            keys = [k for k in self._segments
+                    if (model_name is None or k[0] == model_name) and (pack_id is None or k[1] == pack_id)]
+            for k in keys:
+                del self._segments[k]
+        return len(keys)
+
+    def clear(self) -> None:
+        self.evict()
+
+    def evict_idle(self) -> int:
+        """释放长时间未使用的资源包"""
+        if not self.idle_seconds:
+            return 0
+        deadline = time.time() - self.idle_seconds
+        with self._lock:
+            keys = [k for k, v in self._segments.items() if v.last_used < deadline]
+            for k in keys:
+                logger.info(f"资源包 {k[1]} ({k[0]}) 长时间未使用，已释放")
+                del self._segments[k]
+        return len(keys)
+
+    def memory_used(self) -> int:
+        with self._lock:
+            return sum(s.nbytes for s in self._segments.values())
+
+    def loaded_models(self) -> List[str]:
+        with self._lock:
+            return list(dict.fromkeys(k[0] for k in self._segments))
+
+    def status(self) -> Dict:
+        with self._lock:
+            segments = list(self._segments.values())
+        return {
+            "memory_budget_bytes": self.memory_budget,
+            "memory_used_bytes": sum(s.nbytes for s in segments),
+            "idle_seconds": self.idle_seconds,
+            "segments": [s.status() for s in segments],
+        }
+
+    def _enforce_budget(self, keep: Tuple[str, str]) -> None:
+        """超出内存预算时从最久未使用的开始淘汰，调用时需持有self._lock"""
+        used = sum(s.nbytes for s in self._segments.values())
+        for k in list(self._segments):
+            if used <= self.memory_budget:
+                break
+            if k == keep:
+                continue
+            used -= self._segments.pop(k).nbytes
+            logger.info(f"超出内存预算，已释放资源包 {k[1]} ({k[0]})")
+
+    def _ensure_sweeper(self) -> None:
+        if not self.idle_seconds or self._sweeper is not None:
+            return
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="pack-index-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_loop(self) -> None:
+        interval = max(1, min(60, self.idle_seconds // 2))
+        while True:
+            time.sleep(interval)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error(f"释放空闲资源包失败: {e}")
@@ -0,0 +1,123 @@
+import json
+import os
+import posixpath
+from typing import Dict, List, Optional
+
+from config.settings import Config
+from services.blob_store import BLOB_STORE
+from services.image_search import IMAGE_SEARCH_SERVICE, ImageSearch
+from services.prefetch import PREFETCH_MANAGER, PRIORITY_PREFETCH, join_url
+from base import *
+
+
+class PackDiff:
+    """本地与远程manifest之间按文件hash比较的差异"""
+
+    def __init__(self):
+        self.added: List[Dict] = []
+        self.changed: List[Dict] = []
+        self.removed: List[Dict] = []
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    def summary(self) -> Dict[str, int]:
+        return {"added": len(self.added), "changed": len(self.changed), "removed": len(self.removed)}
+
+
+def diff_manifests(local_manifest: Dict, remote_manifest: Dict) -> PackDiff:
+    """按filepath对齐两个manifest中的图片，hash不同的视为内容变化"""
+    local_files = _files_by_path(local_manifest)
+    remote_files = _files_by_path(remote_manifest)
+    diff = PackDiff()
+    for path, file_info in remote_files.items():
+        old_info = local_files.get(path)
+        if old_info is None:
+            diff.added.append(file_info)
+        elif old_info.get("hash") != file_info.get("hash"):
+            diff.changed.append(file_info)
+    diff.removed = [file_info for path, file_info in local_files.items() if path not in remote_files]
+    return diff
+
+
+def _files_by_path(manifest: Dict) -> Dict[str, Dict]:
+    files = manifest.get("contents", {}).get("images", {}).get("files", {}).values()
+    return {_normalize_path(v["filepath"]): v for v in files if v.get("filepath")}
+
+
+def _normalize_path(filepath: str) -> str:
+    return posixpath.normpath(filepath.replace("\\", "/"))
+
+
+class PackSyncService:
+    """
+    社区资源包的增量同步。
+    下载远程manifest后与本地manifest按文件hash比较，只下载新增或内容变化的图片、删除已移除的图片，
+    嵌入缓存也只为新增的文件生成，更新的开销与变化的大小成正比。
+    """
+
+    def __init__(self, search_service: Optional[ImageSearch] = None):
+        self.search_service = search_service or IMAGE_SEARCH_SERVICE
+
+    def sync_pack(self, uuid: str, update_url: str) -> PackDiff:
+        """同步单个社区资源包，本地还没有时相当于首次下载"""
+        pack_id = f"pack_{uuid}"
+        pack_dir = os.path.join(self.search_service.resource_pack_manager.resource_packs_dir, uuid)
+        manifest_path = os.path.join(pack_dir, "manifest.json")
+        if os.path.isfile(f"{pack_dir}.zip") and not os.path.isdir(pack_dir):
+            raise RuntimeError(f"资源包 {pack_id} 以zip保存，不能增量同步")
+
+        response = PREFETCH_MANAGER.session.get(update_url, timeout=Config().prefetch.timeout)
+        response.raise_for_status()
+        remote_manifest = response.json()
+
+        local_manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                local_manifest = json.load(f)
+        if remote_manifest == local_manifest:
+            return PackDiff()
+
+        diff = diff_manifests(local_manifest, remote_manifest)
+        url = remote_manifest.get("url")
+        if not url and (diff.added or diff.changed):
+            # 没有下载地址时删除的旧图片无法补回，不修改本地资源包
+            raise RuntimeError(f"资源包 {pack_id} 的manifest没有url，无法下载新增或变化的图片")
+        # 内容变化的图片先删除旧文件，之后按新的hash下载；旧hash不再被这个资源包使用时释放共享存储中的引用
+        local_files = _files_by_path(local_manifest)
+        remote_hashes = {v.get("hash") for v in _files_by_path(remote_manifest).values()}
+        for file_info in diff.removed + [local_files[_normalize_path(v["filepath"])] for v in diff.changed]:
+            file_path = safe_join(pack_dir, file_info["filepath"])
+            if file_path is None:
+                continue
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            if file_info.get("hash") and file_info["hash"] not in remote_hashes:
+                BLOB_STORE.release(file_info["hash"], pack_id)
+
+        verify_folder(manifest_path)
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(remote_manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+        # 重新读取manifest，已有的嵌入缓存只为新增的文件请求API
+        self.search_service.refresh_resource_pack(pack_id)
+
+        if url:
+            items = []
+            for v in diff.added + diff.changed:
+                file_path = safe_join(pack_dir, v["filepath"])
+                if file_path is None:
+                    logger.warning(f"资源包 {pack_id} 中的路径超出资源包目录，已忽略: {v['filepath']}")
+                    continue
+                items.append((pack_id, join_url(url, v["filepath"]), file_path, v.get("hash")))
+            downloaded = PREFETCH_MANAGER.fetch(items, timeout=None, priority=PRIORITY_PREFETCH)
+            if downloaded < len(items):
+                logger.warning(f"资源包 {pack_id} 有 {len(items) - downloaded} 个图片下载失败，将在使用时重试")
+        logger.info(f"已同步资源包 {pack_id}: {diff.summary()}")
+        return diff
+
+
+PACK_SYNC_SERVICE = PackSyncService()
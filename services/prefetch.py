@@ -0,0 +1,261 @@
+import atexit
+import hashlib
+import itertools
+import os
+import pickle
+import queue
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config.settings import Config
+from services.blob_store import BLOB_STORE
+from services.zip_pack import pack_file_exists
+from base import *
+
+# 优先级：搜索时缺失的图片最先下载，其次是按热度排序的预取
+PRIORITY_SEARCH = 0
+PRIORITY_PREFETCH = 1
+
+
+class _Task:
+    """一个待下载的文件，多个等待者共用同一个任务"""
+
+    def __init__(self, pack_id: str, url: str, path: str, file_hash: Optional[str], generation: int):
+        self.pack_id = pack_id
+        self.url = url
+        self.path = path
+        self.file_hash = file_hash
+        self.generation = generation
+        self.started = False
+        self.done = threading.Event()
+        self.ok = False
+
+
+class PrefetchManager:
+    """
+    远程资源包图片的后台预取。
+    启用带url的资源包后，按预测的热度（历史搜索命中次数，其次是标签数量）在后台下载缺失的图片；
+    搜索遇到缺失的图片时以最高优先级插队，只等待有限的时间，不会阻塞在下载上。
+    所有下载共用一个带连接池和重试的Session，工作线程数固定，文件先写临时文件再替换。
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, stats_file: Optional[str] = None):
+        config = Config().prefetch
+        self.max_workers = max_workers or config.max_workers
+        self.timeout = config.timeout
+        self.stats_file = stats_file or Config().prefetch_stats_file
+        # 下载的文件只能保存到资源包目录中
+        self.packs_root = os.path.join(Config().base_dir, Config().paths.resource_packs_dir)
+        self.session = self._create_session(config.retries)
+        # 与download_file一致，默认不校验SSL证书
+        self.session.verify = not config.ignore_ssl
+        self._queue: "queue.PriorityQueue[Tuple[int, int, _Task]]" = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        # 目标路径 -> 正在排队或下载的任务，避免重复下载
+        self._pending: Dict[str, _Task] = {}
+        # 禁用资源包后递增，旧的任务不再执行
+        self._generations: Counter = Counter()
+        # 图片路径 -> 被搜索返回的次数
+        self._popularity: Counter = self._load_stats()
+        self._stats_dirty = False
+        self._workers: List[threading.Thread] = []
+        atexit.register(self.save_stats)
+
+    def prefetch_pack(self, pack_id: str, pack_info: Dict) -> None:
+        """在后台预取资源包中缺失的图片，检查文件是否存在也在后台进行"""
+        if not pack_info.get("url") or pack_info.get("storage") == "zip":
+            return
+        threading.Thread(target=self._plan_pack, args=(pack_id, pack_info),
+                         name=f"prefetch-plan-{pack_id}", daemon=True).start()
+
+    def cancel_pack(self, pack_id: str) -> None:
+        """取消资源包还没有开始的预取任务"""
+        with self._lock:
+            self._generations[pack_id] += 1
+
+    def fetch(self, items: Iterable[Tuple[str, str, str, Optional[str]]], timeout: Optional[float],
+              priority: int = PRIORITY_SEARCH) -> int:
+        """
+        下载指定的文件，默认以最高优先级插队（搜索结果中缺失的图片），最多等待timeout秒
+        :param items: [(pack_id, url, 保存路径, hash), ...]
+        :param timeout: 为None时等待全部完成
+        :return: 等待期间下载完成的数量
+        """
+        return sum(1 for _ in self.fetch_iter(items, timeout, priority))
+
+    def fetch_iter(self, items: Iterable[Tuple[str, str, str, Optional[str]]], timeout: Optional[float],
+                   priority: int = PRIORITY_SEARCH) -> Iterator[str]:
+        """与fetch相同，但立即提交下载，返回的迭代器按完成顺序产生下载成功的保存路径，超时后结束"""
+        tasks = [self._submit(pack_id, url, path, file_hash, priority)
+                 for pack_id, url, path, file_hash in items]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        return self._iter_finished(tasks, deadline)
+
+    @staticmethod
+    def _iter_finished(tasks: List[_Task], deadline: Optional[float]) -> Iterator[str]:
+        remaining = list(tasks)
+        while remaining:
+            for task in [t for t in remaining if t.done.is_set()]:
+                remaining.remove(task)
+                if task.ok:
+                    yield task.path
+            if not remaining:
+                break
+            wait = 0.05 if deadline is None else min(0.05, deadline - time.monotonic())
+            if wait <= 0:
+                break
+            remaining[0].done.wait(wait)
+
+    def record_hits(self, paths: Iterable[str]) -> None:
+        """记录搜索返回的图片，作为之后预取排序的依据"""
+        with self._lock:
+            self._popularity.update(paths)
+            self._stats_dirty = True
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {"queued": self._queue.qsize(), "pending": len(self._pending), "workers": len(self._workers)}
+
+    def save_stats(self) -> None:
+        with self._lock:
+            if not self._stats_dirty:
+                return
+            popularity = dict(self._popularity)
+            self._stats_dirty = False
+        verify_folder(self.stats_file)
+        tmp_file = f"{self.stats_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(popularity, f)
+            os.replace(tmp_file, self.stats_file)
+        except Exception as e:
+            logger.warning(f"保存预取统计失败: {e}")
+
+    def _plan_pack(self, pack_id: str, pack_info: Dict) -> None:
+        files = pack_info["manifest"].get("contents", {}).get("images", {}).get("files", {}).values()
+        missing = []
+        for file_info in files:
+            path = safe_join(pack_info["pack_dir"], file_info["filepath"])
+            if path is None:
+                logger.warning(f"资源包 {pack_id} 中的路径超出资源包目录，已忽略: {file_info['filepath']}")
+                continue
+            if not pack_file_exists(path):
+                missing.append((path, file_info))
+        with self._lock:
+            popularity = self._popularity
+            missing.sort(key=lambda x: (-popularity.get(x[0], 0), -len(x[1].get("labels") or [])))
+        for path, file_info in missing:
+            self._submit(pack_id, join_url(pack_info["url"], file_info["filepath"]), path,
+                         file_info.get("hash"), PRIORITY_PREFETCH)
+        if missing:
+            logger.info(f"资源包 {pack_id} 有 {len(missing)} 个图片等待后台下载")
+        self.save_stats()
+
+    def _submit(self, pack_id: str, url: str, path: str, file_hash: Optional[str], priority: int) -> _Task:
+        with self._lock:
+            task = self._pending.get(path)
+            if task is None:
+                task = _Task(pack_id, url, path, file_hash, self._generations[pack_id])
+                self._pending[path] = task
+            elif priority == PRIORITY_SEARCH:
+                # 已经在预取队列中，搜索需要时以高优先级再排一次，先到的工作线程执行
+                task.generation = self._generations[pack_id]
+            else:
+                return task
+            self._queue.put((priority, next(self._seq), task))
+            self._ensure_workers()
+        return task
+
+    def _ensure_workers(self) -> None:
+        """按需启动工作线程，调用时需持有self._lock"""
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker_loop, name=f"prefetch-{len(self._workers)}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _worker_loop(self) -> None:
+        while True:
+            _, _, task = self._queue.get()
+            with self._lock:
+                # 同一个任务可能以不同优先级排了两次
+                if task.started:
+                    continue
+                task.started = True
+                cancelled = task.generation != self._generations[task.pack_id]
+            try:
+                if not cancelled:
+                    # 已有相同内容的图片时直接链接，不需要下载
+                    task.ok = (pack_file_exists(task.path)
+                               or bool(task.file_hash and BLOB_STORE.link_to(task.file_hash, task.path, task.pack_id))
+                               or self._download(task))
+            except Exception as e:
+                # 工作线程不能退出，否则等待这个任务的调用方会一直阻塞
+                logger.error(f"处理下载任务失败 {task.path}: {e}")
+                task.ok = False
+            finally:
+                with self._lock:
+                    if self._pending.get(task.path) is task:
+                        del self._pending[task.path]
+                task.done.set()
+
+    def _download(self, task: _Task) -> bool:
+        """下载到临时文件，校验hash后替换，读取方不会看到不完整的文件"""
+        if safe_join(self.packs_root, os.path.abspath(task.path)) is None:
+            logger.warning(f"拒绝下载到资源包目录之外: {task.path}")
+            return False
+        tmp_path = f"{task.path}.{threading.get_ident()}.part"
+        try:
+            verify_folder(task.path)
+            response = self.session.get(task.url, timeout=self.timeout, stream=True)
+            response.raise_for_status()
+            digest = hashlib.sha256()
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    digest.update(chunk)
+                    f.write(chunk)
+            if task.file_hash and digest.hexdigest() != task.file_hash:
+                logger.warning(f"下载的文件与manifest中的hash不一致: {task.url}")
+                os.remove(tmp_path)
+                return False
+            os.replace(tmp_path, task.path)
+            if task.file_hash:
+                BLOB_STORE.add_file(task.path, task.file_hash, task.pack_id)
+            return True
+        except Exception as e:
+            logger.warning(f"下载文件失败 {task.url}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    def _create_session(self, retries: int) -> requests.Session:
+        session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=self.max_workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _load_stats(self) -> Counter:
+        if not os.path.exists(self.stats_file):
+            return Counter()
+        try:
+            with open(self.stats_file, 'rb') as f:
+                return Counter(pickle.load(f))
+        except Exception as e:
+            logger.warning(f"读取预取统计失败: {e}")
+            return Counter()
+
+
+def join_url(base_url: str, rel_path: str) -> str:
+    return f"{base_url.rstrip('/')}/{rel_path.replace(os.sep, '/').lstrip('/')}"
+
+
+PREFETCH_MANAGER = PrefetchManager()
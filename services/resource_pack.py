@@ -1,12 +1,28 @@
 import os
 import json
+import posixpath
 import shutil
 import zipfile
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional
 
+from base import safe_join
 from config.settings import Config
 from .utils import verify_folder, get_file_hash, download_file
+from .blob_store import BLOB_STORE
+from .hash_service import HASH_SERVICE
+from .zip_pack import close_zip_reader
+
+
+# 已经压缩过的格式，再用deflate压缩只会浪费CPU
+COMPRESSED_IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+
+def _zip_compress_type(filename: str) -> int:
+    """已压缩的图片直接存储，其他文件（如manifest）使用deflate"""
+    if filename.lower().endswith(COMPRESSED_IMAGE_EXTS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
 
 
 class ResourcePackError(Exception):
@@ -69,7 +85,7 @@ class ResourcePackService:
                 name_without_ext, ext = os.path.splitext(cover_name)
                 ext = ext.lower()
                 
-                file_hash = get_file_hash(cover_image)
+                file_hash = HASH_SERVICE.hash_file(cover_image)
                 if file_hash:
                     new_cover_name = f"cover{ext}"
                     new_cover_path = os.path.join(pack_dir, new_cover_name)
@@ -85,13 +101,12 @@ class ResourcePackService:
         
         copied_files = []
         file_mapping = {} 
-        for img_path in valid_images:
+        for img_path, file_hash in zip(valid_images, HASH_SERVICE.iter_hashes(valid_images)):
             try:
                 original_name = os.path.basename(img_path)
                 name_without_ext, ext = os.path.splitext(original_name)
                 ext = ext.lower()
                 
-                file_hash = get_file_hash(img_path)
                 if not file_hash:
                     print(f"获取文件hash失败: {img_path}")
                     continue
@@ -171,8 +186,7 @@ class ResourcePackService:
                         # 使用绝对路径
                         file_path = os.path.join(root, file)
                         arcname = os.path.relpath(file_path, pack_dir)
-                        print(f"Adding to zip: {arcname}")
-                        zf.write(file_path, arcname)
+                        zf.write(file_path, arcname, compress_type=_zip_compress_type(file))
         except Exception as e:
             if os.path.exists(zip_path):
                 os.remove(zip_path)
@@ -180,17 +194,207 @@ class ResourcePackService:
     
         return zip_path
 
+    def build_resource_pack_zip(self,
+                                name: str,
+                                version: str,
+                                author: str,
+                                description: str,
+                                image_paths: List[str],
+                                cover_image: Optional[str] = None,
+                                tags: Optional[List[str]] = None,
+                                progress_callback: Optional[Callable[[Dict], None]] = None) -> str:
+        """
+        直接生成资源包zip，不经过中间的导出目录。
+        图片由HASH_SERVICE并行计算hash（未变化的文件直接使用缓存），按原顺序依次写入zip；
+        已压缩的图片格式直接存储，manifest使用deflate。
+
+        :param progress_callback: 进度回调，参数为事件字典 {"stage": "hash"|"write"|"done", "done": int, "total": int, "path": str}
+        :return: zip文件路径
+        """
+        if not name or not version or not author:
+            raise ResourcePackError("资源包名称、版本号和作者不能为空")
+
+        if not image_paths:
+            raise ResourcePackError("图片列表不能为空")
+
+        valid_images = [p for p in image_paths if os.path.exists(p) and os.access(p, os.R_OK)]
+        if not valid_images:
+            raise ResourcePackError("没有有效的图片文件可以打包")
+
+        def report(stage: str, done: int, total: int, path: str = ""):
+            if progress_callback is not None:
+                progress_callback({"stage": stage, "done": done, "total": total, "path": path})
+
+        zip_path = os.path.join(self.export_dir, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip")
+        tmp_zip_path = f"{zip_path}.tmp"
+        total = len(valid_images)
+        file_mapping = {}
+        cover_info = None
+
+        try:
+            with zipfile.ZipFile(tmp_zip_path, "w") as zf:
+                # 处理封面图片
+                if cover_image and os.path.exists(cover_image):
+                    cover_hash = HASH_SERVICE.hash_file(cover_image)
+                    if cover_hash:
+                        ext = os.path.splitext(cover_image)[1].lower()
+                        new_cover_name = f"cover{ext}"
+                        zf.write(cover_image, new_cover_name, compress_type=_zip_compress_type(new_cover_name))
+                        cover_info = {
+                            "filename": new_cover_name,
+                            "original_name": os.path.basename(cover_image),
+                            "hash": cover_hash
+                        }
+
+                # hash在后台并行计算并按输入顺序返回，写入与计算重叠
+                for index, (img_path, file_hash) in enumerate(
+                        zip(valid_images, HASH_SERVICE.iter_hashes(valid_images))):
+                    report("hash", index + 1, total, img_path)
+                    if not file_hash:
+                        print(f"获取文件hash失败: {img_path}")
+                        continue
+
+                    original_name = os.path.basename(img_path)
+                    name_without_ext, ext = os.path.splitext(original_name)
+                    # 处理文件名重复问题
+                    new_name = original_name
+                    if new_name in file_mapping:
+                        new_name = f"{name_without_ext}_{file_hash[:8]}{ext.lower()}"
+                        if new_name in file_mapping:
+                            # 同名且内容相同，只保留一份
+                            continue
+
+                    arcname = f"images/{new_name}"
+                    try:
+                        zf.write(img_path, arcname, compress_type=_zip_compress_type(new_name))
+                    except Exception as e:
+                        print(f"写入文件 {img_path} 失败: {str(e)}")
+                        continue
+                    file_mapping[new_name] = {
+                        "filepath": os.path.join("images/", new_name),
+                        "hash": file_hash
+                    }
+                    report("write", len(file_mapping), total, img_path)
+
+                if not file_mapping:
+                    raise ResourcePackError("没有成功打包任何图片文件")
+
+                manifest = {
+                    "name": name,
+                    "version": version,
+                    "author": author,
+                    "description": description,
+                    "created_at": datetime.now().strftime("%Y-%m-%d"),
+                    "tags": tags or [],
+                    "cover": cover_info,
+                    "contents": {
+                        "images": {
+                            "description": "图像资源目录",
+                            "files": file_mapping
+                        }
+                    }
+                }
+                zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=4),
+                            compress_type=zipfile.ZIP_DEFLATED)
+            os.replace(tmp_zip_path, zip_path)
+        except ResourcePackError:
+            if os.path.exists(tmp_zip_path):
+                os.remove(tmp_zip_path)
+            raise
+        except Exception as e:
+            if os.path.exists(tmp_zip_path):
+                os.remove(tmp_zip_path)
+            raise ResourcePackError(f"创建zip文件失败: {str(e)}")
+
+        report("done", len(file_mapping), total, zip_path)
+        return zip_path
+
     def import_resource_pack(self, zip_file):
+        """
+        导入资源包。默认直接把zip保存到资源包目录，图片在使用时从zip中读取，不需要解压；
+        配置 storage.resource_pack_import_mode 为 extract 时解压到目录。
+        """
+        if Config().storage.resource_pack_import_mode == "extract":
+            self._extract_resource_pack(zip_file)
+        else:
+            self._save_zip_resource_pack(zip_file)
+
+    def _save_zip_resource_pack(self, zip_file):
+        """检查zip中有manifest后原样保存，先写临时文件再替换，正在读取旧zip的搜索不受影响"""
+        target_dir = Config().paths.resource_packs_dir
+        verify_folder(target_dir)
+        target_file = os.path.join(target_dir, os.path.basename(zip_file.name))
+        if not target_file.lower().endswith(".zip"):
+            target_file += ".zip"
+        tmp_file = f"{target_file}.tmp"
+        try:
+            zip_file.seek(0)
+            with open(tmp_file, "wb") as f:
+                shutil.copyfileobj(zip_file, f)
+            with zipfile.ZipFile(tmp_file) as zip_ref:
+                if "manifest.json" not in zip_ref.namelist():
+                    raise ResourcePackError("资源包中缺少manifest.json")
+            close_zip_reader(target_file)
+            os.replace(tmp_file, target_file)
+            print(f"成功导入 {zip_file.name} 到 {target_file}")
+        except Exception as e:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise ResourcePackError(f"导入ZIP文件失败: {str(e)}")
+
+    def _extract_resource_pack(self, zip_file):
+        """
+        解压资源包。manifest中带hash的图片如果已经存在于内容寻址存储中，直接创建硬链接而不解压；
+        新解压的图片会加入存储，供之后导入的资源包复用。
+        """
         target_dir = Config().paths.resource_packs_dir
         verify_folder(target_dir)
         target_dir = os.path.join(target_dir, os.path.splitext(os.path.basename(zip_file.name))[0])
+        pack_id = f"pack_{os.path.basename(target_dir)}"
         try:
             with zipfile.ZipFile(zip_file) as zip_ref:
-                zip_ref.extractall(target_dir)
-            print(f"成功解压 {zip_file.name} 到 {target_dir}")
+                manifest = {}
+                if "manifest.json" in zip_ref.namelist():
+                    manifest = json.loads(zip_ref.read("manifest.json").decode("utf-8"))
+                member_hashes = {
+                    posixpath.normpath(v["filepath"].replace("\\", "/")): v.get("hash")
+                    for v in manifest.get("contents", {}).get("images", {}).get("files", {}).values()
+                    if v.get("filepath")
+                }
+                linked_count = 0
+                for member in zip_ref.infolist():
+                    target_path = safe_join(target_dir, member.filename)
+                    if target_path is None:
+                        print(f"资源包中的路径超出解压目录，已跳过: {member.filename}")
+                        continue
+                    file_hash = member_hashes.get(posixpath.normpath(member.filename))
+                    if (file_hash and not member.is_dir()
+                            and BLOB_STORE.link_to(file_hash, target_path, pack_id)):
+                        linked_count += 1
+                        continue
+                    zip_ref.extract(member, target_dir)
+            BLOB_STORE.add_pack(pack_id, target_dir, manifest)
+            print(f"成功解压 {zip_file.name} 到 {target_dir}，其中 {linked_count} 个图片复用已有文件")
         except Exception as e:
             raise ResourcePackError(f"解压ZIP文件失败: {str(e)}")
 
+    def delete_resource_pack(self, pack_id: str, pack_dir: str) -> None:
+        """删除资源包目录或zip，并回收不再被其他资源包引用的图片"""
+        if os.path.isfile(pack_dir):
+            close_zip_reader(pack_dir)
+            os.remove(pack_dir)
+        elif os.path.exists(pack_dir):
+            shutil.rmtree(pack_dir)
+        removed = BLOB_STORE.release_pack(pack_id)
+        print(f"已删除资源包 {pack_dir}，回收 {removed} 个图片")
+
+    def deduplicate_resource_packs(self, packs: Dict[str, Dict]) -> int:
+        """把已有资源包的图片加入内容寻址存储，相同的图片只保留一份，返回处理的图片数量"""
+        count = 0
+        for pack_id, pack_info in packs.items():
+            count += BLOB_STORE.add_pack(pack_id, pack_info["pack_dir"], pack_info["manifest"])
+        return count
+
     def import_resource_pack_from_url(self, url, uuid=None):
         if uuid is None:
             target_file  = url.replace("https://", "").replace("http://", "").replace("/", "_").replace("\\", "_")
@@ -8,8 +8,13 @@ import numpy as np
 
 from config.settings import Config, ResourcePackConfig
 from services.utils import verify_folder, get_file_hash
+from services.pack_discovery import PACK_DISCOVERY
+from services.zip_pack import is_zip_pack, pack_file_exists, read_pack_file, split_zip_path
 from base import *
 
+# 旧版本的资源包缓存没有按模型区分，实际使用的模型是bge-m3
+LEGACY_CACHE_MODEL = 'bge-m3'
+
 class ResourcePackManager:
     """资源包管理器，负责加载、解析和缓存资源包"""
     
@@ -31,56 +36,73 @@ class ResourcePackManager:
         # 清空当前资源包信息
         self.available_packs = {}
 
-        # 遍历resource_packs目录，加载所有资源包
-        if os.path.exists(self.resource_packs_dir):
-            for item in os.listdir(self.resource_packs_dir):
-                pack_dir = os.path.join(self.resource_packs_dir, item)
-                if os.path.isdir(pack_dir):
-                    manifest_path = os.path.join(pack_dir, "manifest.json")
-                    if os.path.exists(manifest_path):
-                        try:
-                            with open(manifest_path, "r", encoding="utf-8") as f:
-                                manifest = json.load(f)
-                                
-                            # 检查资源包是否有效
-                            if not self._validate_resource_pack(pack_dir, manifest):
-                                continue
+        # 遍历resource_packs目录，加载所有资源包；未变化的manifest直接使用缓存的解析结果
+        config = Config()
+        for item, pack_dir, manifest in PACK_DISCOVERY.scan(self.resource_packs_dir):
+            try:
+                pack_info = self._build_pack_info(item, pack_dir, manifest, config)
+                if pack_info is None:
+                    continue
+                pack_id = f"pack_{item}"
+                self.available_packs[pack_id] = pack_info
+                if pack_info["enabled"]:
+                    self.enabled_packs[pack_id] = pack_info
+            except Exception as e:
+                logger.error(f"加载资源包 {item} 失败: {e}")
+
+    def reload_pack(self, pack_id: str) -> Optional[Dict]:
+        """重新读取单个资源包的manifest（如同步更新之后），其他资源包不受影响"""
+        config = Config()
+        for item, pack_dir, manifest in PACK_DISCOVERY.scan(self.resource_packs_dir):
+            if f"pack_{item}" != pack_id:
+                continue
+            pack_info = self._build_pack_info(item, pack_dir, manifest, config)
+            if pack_info is None:
+                return None
+            # 替换整个字典而不是原地修改，正在遍历的搜索不受影响
+            self.available_packs = {**self.available_packs, pack_id: pack_info}
+            if pack_info["enabled"]:
+                self.enabled_packs = {**self.enabled_packs, pack_id: pack_info}
+            return pack_info
+        return None
 
-                            resource_config = Config().resource_packs.get(f'pack_{item}', ResourcePackConfig())
+    def _build_pack_info(self, item: str, pack_dir: str, manifest: Dict, config: Config) -> Optional[Dict]:
+        """根据manifest构建资源包信息，资源包无效时返回None"""
+        # 检查资源包是否有效
+        if not self._validate_resource_pack(pack_dir, manifest):
+            return None
 
+        pack_id = f"pack_{item}"
+        resource_config = config.resource_packs.get(pack_id, ResourcePackConfig())
 
-                            # 获取封面图片路径
-                            cover_path = None
-                            if manifest.get("cover") and manifest["cover"].get("filename"):
-                                cover_file = manifest["cover"]["filename"]
-                                cover_path = os.path.join(pack_dir, cover_file)
-                                if not os.path.exists(cover_path):
-                                    cover_path = None
-                            
-                            # 构建资源包信息
-                            pack_id = f"pack_{item}"
+        # 获取封面图片路径
+        cover_path = None
+        if manifest.get("cover") and manifest["cover"].get("filename"):
+            cover_file = manifest["cover"]["filename"]
+            cover_path = os.path.join(pack_dir, cover_file)
+            if not pack_file_exists(cover_path):
+                cover_path = None
 
-                            self.available_packs[pack_id] = {
-                                "name": manifest.get("name", item),
-                                "version": manifest.get("version", "1.0.0"),
-                                "author": manifest.get("author", "Unknown"),
-                                "description": manifest.get("description", ""),
-                                "path": pack_dir,
-                                "type": "vv",  # 默认类型
-                                "cache_file": self.get_pack_cache_file(pack_id),
-                                "enabled": resource_config.enabled,  # 默认不启用
-                                "is_default": False,
-                                "cover": cover_path,
-                                "manifest": manifest,
-                                "pack_dir": pack_dir,
-                                "url": manifest.get("url", ""),
-                            }
-                            if manifest.get('regex') is not None:
-                                self.available_packs[pack_id]['regex'] = manifest.get('regex')
-                            if resource_config.enabled:
-                                self.enabled_packs[pack_id] = self.available_packs[pack_id]
-                        except Exception as e:
-                            logger.error(f"加载资源包 {item} 失败: {e}")
+        # 构建资源包信息
+        pack_info = {
+            "name": manifest.get("name", item),
+            "version": manifest.get("version", "1.0.0"),
+            "author": manifest.get("author", "Unknown"),
+            "description": manifest.get("description", ""),
+            "path": pack_dir,
+            "type": "vv",  # 默认类型
+            "cache_file": self.get_pack_cache_file(pack_id),
+            "enabled": resource_config.enabled,  # 默认不启用
+            "is_default": False,
+            "cover": cover_path,
+            "manifest": manifest,
+            "pack_dir": pack_dir,
+            "storage": "zip" if is_zip_pack(pack_dir) else "dir",
+            "url": manifest.get("url", ""),
+        }
+        if manifest.get('regex') is not None:
+            pack_info['regex'] = manifest.get('regex')
+        return pack_info
     
     def _validate_resource_pack(self, pack_dir: str, manifest: Dict) -> bool:
         """验证资源包是否有效"""
@@ -123,7 +145,8 @@ class ResourcePackManager:
         """启用指定的资源包"""
         if pack_id in self.available_packs and not self.available_packs[pack_id]["enabled"]:
             self.available_packs[pack_id]["enabled"] = True
-            self.enabled_packs[pack_id] = self.available_packs[pack_id]
+            # 替换整个字典而不是原地修改，正在遍历enabled_packs的搜索不受影响
+            self.enabled_packs = {**self.enabled_packs, pack_id: self.available_packs[pack_id]}
             
             # 更新配置文件
             with Config() as config:
@@ -141,8 +164,8 @@ class ResourcePackManager:
         """禁用指定的资源包"""
         if pack_id in self.available_packs and self.available_packs[pack_id]["enabled"]:
             self.available_packs[pack_id]["enabled"] = False
-            if pack_id in self.enabled_packs:
-                del self.enabled_packs[pack_id]
+            # 替换整个字典而不是原地修改，正在遍历enabled_packs的搜索不受影响
+            self.enabled_packs = {k: v for k, v in self.enabled_packs.items() if k != pack_id}
             
             # 更新配置文件
             with Config() as config:
@@ -152,6 +175,17 @@ class ResourcePackManager:
             return True
         return False
     
+    def remove_pack(self, pack_id: str) -> Optional[Dict]:
+        """从管理器和配置中移除资源包（不删除文件），返回被移除的资源包信息"""
+        pack_info = self.available_packs.get(pack_id)
+        if pack_info is None:
+            return None
+        self.enabled_packs = {k: v for k, v in self.enabled_packs.items() if k != pack_id}
+        self.available_packs = {k: v for k, v in self.available_packs.items() if k != pack_id}
+        with Config() as config:
+            config.resource_packs.pop(pack_id, None)
+        return pack_info
+
     def get_pack_cover(self, pack_id: str, size: Tuple[int, int] = (512, 512)) -> Optional[str]:
         """获取资源包的封面图片路径，如果没有封面则生成一个默认封面"""
         if pack_id not in self.available_packs:
@@ -159,13 +193,16 @@ class ResourcePackManager:
             
         pack_info = self.available_packs[pack_id]
         
+        cover_cache_dir = Config().get_abs_cover_cache_file()
+        verify_folder(cover_cache_dir)
+
         # 如果有封面，直接返回
-        if pack_info.get("cover") and os.path.exists(pack_info["cover"]):
-            return pack_info["cover"]
+        if pack_info.get("cover") and pack_file_exists(pack_info["cover"]):
+            if split_zip_path(pack_info["cover"]) is None:
+                return pack_info["cover"]
+            return self._extract_zip_cover(pack_id, pack_info, cover_cache_dir)
             
         # 生成默认封面
-        cover_cache_dir = Config().get_abs_cover_cache_file()
-        verify_folder(cover_cache_dir)
         
         default_cover_path = os.path.join(cover_cache_dir, f"{pack_id}_cover.png")
         
@@ -187,34 +224,60 @@ class ResourcePackManager:
         img.save(default_cover_path)
         
         return default_cover_path
+
+    @staticmethod
+    def _extract_zip_cover(pack_id: str, pack_info: Dict, cover_cache_dir: str) -> str:
+        """zip资源包的封面复制到封面缓存目录，zip更新后重新复制"""
+        cover = pack_info["cover"]
+        cover_path = os.path.join(cover_cache_dir, f"{pack_id}_cover{os.path.splitext(cover)[1]}")
+        zip_path = split_zip_path(cover)[0]
+        if not os.path.exists(cover_path) or os.path.getmtime(cover_path) < os.path.getmtime(zip_path):
+            tmp_path = f"{cover_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(read_pack_file(cover))
+            os.replace(tmp_path, cover_path)
+        return cover_path
     
-    def get_cache_files(self) -> Dict[str, str]:
-        """获取所有启用的资源包的缓存文件路径"""
+    def get_cache_files(self, model_name: Optional[str] = None) -> Dict[str, str]:
+        """获取所有启用的资源包在指定模型下的缓存文件路径"""
         cache_files = {}
-        for pack_id, pack_info in self.enabled_packs.items():
-            cache_file = pack_info["cache_file"]
-            cache_files[pack_id] = cache_file
+        for pack_id in self.enabled_packs:
+            cache_files[pack_id] = self.get_pack_cache_file(pack_id, model_name)
         return cache_files
     
     def is_pack_cache_generated(self, pack_id: str, model_name) -> bool:
         """检查指定资源包的缓存是否已生成"""
         if pack_id not in self.available_packs:
-            print(f"资源包 {pack_id} 不存在")
+            logger.warning(f"资源包 {pack_id} 不存在")
             return False
             
-        pack_info = self.available_packs[pack_id]
-        cache_file = pack_info["cache_file"]
+        cache_file = self.get_pack_cache_file(pack_id, model_name)
             
-        # 打印调试信息
         exists = os.path.exists(cache_file)
-        print(f"检查缓存文件: {cache_file}, 模型: {model_name}, 存在: {exists}")
+        logger.debug(f"检查缓存文件: {cache_file}, 模型: {model_name}, 存在: {exists}")
             
         return exists
         
     def get_pack_cache_file(self, pack_id: str, model_name: Optional[str] = None) -> Optional[str]:
-        """获取指定资源包的缓存文件路径"""
-        fp = os.path.join(Config().pack_embedding_cache_folder_path, f"{pack_id}.pkl")
+        """
+        获取指定资源包的缓存文件路径。
+        不同嵌入模型的向量不能混用，因此缓存按模型分目录存放：pack_embedding_cache/<模型>/<pack_id>.pkl
+        :param model_name: 模型键（如bge-m3），默认为当前选择的嵌入模型
+        """
+        model_name = model_name or Config().models.selected_embedding_model
+        fp = os.path.join(Config().pack_embedding_cache_folder_path, model_name.replace('/', '_'), f"{pack_id}.pkl")
+        if model_name == LEGACY_CACHE_MODEL and not os.path.exists(fp):
+            self._migrate_legacy_pack_cache(pack_id, fp)
         verify_folder(fp)
         return fp
 
+    @staticmethod
+    def _migrate_legacy_pack_cache(pack_id: str, target_file: str) -> None:
+        """旧版本的缓存不区分模型（实际全部由bge-m3生成），移动到bge-m3的目录下"""
+        legacy_file = os.path.join(Config().pack_embedding_cache_folder_path, f"{pack_id}.pkl")
+        if os.path.exists(legacy_file):
+            verify_folder(target_file)
+            os.replace(legacy_file, target_file)
+            logger.info(f"已迁移旧版本缓存 {legacy_file} -> {target_file}")
+
 RESOURCE_PACK_MANAGER = ResourcePackManager()
\ No newline at end of file
@@ -0,0 +1,122 @@
+import gzip
+import hashlib
+import json
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from services.metrics import RESPONSE_CACHE_TOTAL
+
+
+class CachedBody:
+    """预先序列化、压缩好的响应体"""
+
+    __slots__ = ("version", "body", "gzip_body", "etag")
+
+    def __init__(self, version: Hashable, body: bytes, gzip_body: Optional[bytes]):
+        self.version = version
+        self.body = body
+        self.gzip_body = gzip_body
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+class ResponseCache:
+    """
+    读多写少的JSON接口的响应缓存。
+    数据版本不变时直接返回上次序列化、gzip压缩好的字节，ETag由内容计算，
+    客户端带If-None-Match轮询且内容没变时只返回304。
+    """
+
+    def __init__(self, min_gzip_size: int = 1024):
+        """
+        :param min_gzip_size: 小于这个大小的响应不压缩
+        """
+        self.min_gzip_size = min_gzip_size
+        self._lock = threading.Lock()
+        self._entries: Dict[str, CachedBody] = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key: str, version: Hashable, builder: Callable[[], Any]) -> CachedBody:
+        """版本相同时返回缓存，否则调用builder生成数据并序列化"""
+        entry = self._entries.get(key)
+        if entry is not None and entry.version == version:
+            with self._lock:
+                self.hits += 1
+            RESPONSE_CACHE_TOTAL.inc(key, "hit")
+            return entry
+        body = json.dumps(builder(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        gzip_body = gzip.compress(body, compresslevel=6) if len(body) >= self.min_gzip_size else None
+        entry = CachedBody(version, body, gzip_body)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = entry
+        RESPONSE_CACHE_TOTAL.inc(key, "miss")
+        return entry
+
+    def respond(self, request: Request, key: str, version: Hashable, builder: Callable[[], Any]) -> Response:
+        """生成响应，处理If-None-Match和Accept-Encoding"""
+        entry = self.get(key, version, builder)
+        headers = {"ETag": entry.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if etag_matches(request.headers.get("if-none-match"), entry.etag):
+            with self._lock:
+                self.not_modified += 1
+            RESPONSE_CACHE_TOTAL.inc(key, "not_modified")
+            return Response(status_code=304, headers=headers)
+        if entry.gzip_body is not None and accepts_gzip(request.headers.get("accept-encoding")):
+            headers["Content-Encoding"] = "gzip"
+            return Response(entry.gzip_body, media_type="application/json", headers=headers)
+        return Response(entry.body, media_type="application/json", headers=headers)
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": {k: len(v.body) for k, v in self._entries.items()},
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+            }
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # 弱比较，忽略W/前缀
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """按q值判断客户端是否接受gzip，gzip;q=0表示拒绝；没有列出gzip时看*"""
+    qualities = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    if "gzip" in qualities:
+        return qualities["gzip"] > 0
+    return qualities.get("*", 0) > 0
+
+
+RESPONSE_CACHE = ResponseCache()
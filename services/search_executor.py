@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, Optional
+
+from base import *
+
+
+_DONE = object()
+
+
+class SearchQueueFull(Exception):
+    """等待执行的搜索太多，或者排队超时"""
+
+
+class SearchExecutor:
+    """
+    在专用线程池中执行阻塞的搜索（嵌入请求、图片解码、下载等），不占用事件循环。
+    同时执行的搜索数由信号量限制，超出的请求在事件循环中排队等待，排队太多时直接拒绝；
+    记录排队时间和执行时间，供/admin/search查看。
+    """
+
+    def __init__(self, max_workers: int = 8, max_concurrency: int = 8,
+                 max_queue: int = 64, queue_timeout: float = 30):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search")
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        # 最近的排队时间和执行时间（秒），用于计算分位数
+        self._queue_times = deque(maxlen=1024)
+        self._run_times = deque(maxlen=1024)
+
+    async def acquire(self) -> float:
+        """排队等待执行的名额，返回开始执行的时间；排队已满或排队超时时抛出SearchQueueFull"""
+        with self._lock:
+            if self.max_queue and self._waiting >= self.max_queue:
+                self._rejected += 1
+                raise SearchQueueFull("Too many pending searches")
+            self._waiting += 1
+        enqueued = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout or None)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._rejected += 1
+            raise SearchQueueFull("Timed out waiting for a search slot")
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+        started = time.perf_counter()
+        with self._lock:
+            self._running += 1
+            self._queue_times.append(started - enqueued)
+        return started
+
+    def release(self, started: float, ok: bool) -> None:
+        """释放acquire得到的名额"""
+        self._semaphore.release()
+        with self._lock:
+            self._running -= 1
+            if ok:
+                self._completed += 1
+            else:
+                self._failed += 1
+            self._run_times.append(time.perf_counter() - started)
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """排队后在线程池中执行func，排队已满或排队超时时抛出SearchQueueFull"""
+        started = await self.acquire()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # 客户端断开时线程仍在执行，执行结束后才释放名额，同时执行的搜索不会超过max_concurrency
+            future.add_done_callback(lambda f: self.release(started, _succeeded(f)))
+            raise
+        except BaseException:
+            self.release(started, False)
+            raise
+        self.release(started, True)
+        return result
+
+    async def stream(self, func: Callable[..., Iterator], *args, **kwargs) -> "SearchStream":
+        """
+        排队后在线程池中调用func得到迭代器，每次取下一个元素也在线程池中执行。
+        整个迭代期间占用一个名额，func抛出的异常（如参数错误）在返回前抛出。
+        """
+        started = await self.acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            iterator = await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        except Exception:
+            self.release(started, False)
+            raise
+        return SearchStream(self, iterator, started)
+
+    def status(self) -> Dict:
+        with self._lock:
+            queue_times = sorted(self._queue_times)
+            run_times = sorted(self._run_times)
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "waiting": self._waiting,
+                "running": self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "queue_seconds": _percentiles(queue_times),
+                "run_seconds": _percentiles(run_times),
+            }
+
+
+class SearchStream:
+    """
+    stream()返回的异步迭代器。
+    迭代结束、出错、被取消、调用aclose()，或者还没开始迭代就被回收（如响应没有发出）时释放名额，只释放一次。
+    """
+
+    def __init__(self, owner: SearchExecutor, iterator: Iterator, started: float):
+        self._owner = owner
+        self._iterator = iterator
+        self._started = started
+        self._released = False
+        # 线程中正在执行的next()
+        self._running = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._released:
+            raise StopAsyncIteration
+        loop = asyncio.get_running_loop()
+        future = self._running = loop.run_in_executor(self._owner.executor, next, self._iterator, _DONE)
+        try:
+            item = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # 与run()相同，线程中的next()返回后才释放名额
+            future.add_done_callback(self._finish_after)
+            raise
+        except BaseException:
+            self._finish(False)
+            raise
+        self._running = None
+        if item is _DONE:
+            self._finish(True)
+            raise StopAsyncIteration
+        return item
+
+    async def aclose(self) -> None:
+        if self._running is not None and not self._running.done():
+            # next()被取消但仍在执行，由_finish_after释放
+            return
+        self._finish(False)
+
+    def _finish_after(self, future) -> None:
+        _succeeded(future)
+        self._finish(False)
+
+    def _finish(self, ok: bool) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._owner.release(self._started, ok)
+        try:
+            # 客户端断开时结束生成器
+            self._iterator.close()
+        except (AttributeError, ValueError):
+            pass
+
+    def __del__(self):
+        self._finish(False)
+
+
+def _succeeded(future) -> bool:
+    """已完成的future是否成功，同时取出异常，避免asyncio报告未处理的异常"""
+    return not future.cancelled() and future.exception() is None
+
+
+def _percentiles(values) -> Optional[Dict[str, float]]:
+    """已排序数据的p50/p95/max"""
+    if not values:
+        return None
+    return {
+        "p50": values[int(len(values) * 0.5)],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
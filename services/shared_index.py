@@ -0,0 +1,131 @@
+import os
+import pickle
+import shutil
+import threading
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from services.pack_index import PackSegment
+from base import *
+
+VERSION_FILE = "VERSION"
+# 保留的旧版本数量，其他进程可能还在使用
+_KEEP_VERSIONS = 2
+
+
+class SharedIndex:
+    """
+    多个进程共享的资源包向量。
+    每个(模型, 资源包)的向量矩阵保存为只读的.npy文件，各进程用内存映射加载，
+    操作系统的页缓存只保存一份，uvicorn开多个worker时向量占用的内存不会成倍增加。
+    每行的元数据（路径、hash、标签等）仍然保存在items.pkl中，每个进程各自反序列化一份，
+    这部分内存随worker数量增加，大小与图片数量成正比，通常远小于向量。
+
+    目录结构：<root>/<模型>/<pack_id>/<版本>/{embeddings.npy, items.pkl}，
+    版本由资源包缓存文件的(mtime, size)决定，<root>/<模型>/<pack_id>/VERSION 记录最新发布的版本。
+    缓存更新后第一个发现的进程负责生成新版本并更新VERSION，其他进程检查到VERSION变化后重新映射，不需要重启。
+    """
+
+    def __init__(self, root: str, cache_file_getter: Callable[[str, str], str]):
+        """
+        :param cache_file_getter: 获取资源包缓存文件路径的函数，参数为(pack_id, model_name)
+        """
+        self.root = root
+        self.cache_file_getter = cache_file_getter
+        self._lock = threading.Lock()
+
+    def load(self, model_name: str, pack_id: str,
+             loader: Callable[[str, str], Optional[List[Dict]]]) -> Optional[PackSegment]:
+        """映射最新版本的向量，缓存更新后还没有发布时先发布"""
+        version = self.source_version(model_name, pack_id)
+        if version is None:
+            return None
+        version_dir = os.path.join(self._pack_dir(model_name, pack_id), version)
+        with self._lock:
+            if not os.path.exists(version_dir) and not self._publish(model_name, pack_id, version, loader):
+                return None
+            if self.published_version(model_name, pack_id) != version:
+                self._write_version(model_name, pack_id, version)
+        return self._map(model_name, pack_id, version)
+
+    def is_stale(self, segment: PackSegment) -> bool:
+        """其他进程发布了新版本，或者缓存文件已经更新"""
+        return (self.published_version(segment.model_name, segment.pack_id) != segment.version
+                or self.source_version(segment.model_name, segment.pack_id) != segment.version)
+
+    def source_version(self, model_name: str, pack_id: str) -> Optional[str]:
+        cache_file = self.cache_file_getter(pack_id, model_name)
+        if not cache_file:
+            return None
+        try:
+            st = os.stat(cache_file)
+        except FileNotFoundError:
+            return None
+        return f"{st.st_mtime_ns}-{st.st_size}"
+
+    def published_version(self, model_name: str, pack_id: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self._pack_dir(model_name, pack_id), VERSION_FILE), 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _pack_dir(self, model_name: str, pack_id: str) -> str:
+        return os.path.join(self.root, model_name.replace('/', '_'), pack_id)
+
+    def _publish(self, model_name: str, pack_id: str, version: str,
+                 loader: Callable[[str, str], Optional[List[Dict]]]) -> bool:
+        """把缓存转换为.npy文件，写入临时目录后重命名，多个进程同时发布时只保留一份"""
+        items = loader(pack_id, model_name)
+        if items is None:
+            return False
+        segment = PackSegment(pack_id, model_name, items)
+        pack_dir = self._pack_dir(model_name, pack_id)
+        tmp_dir = os.path.join(pack_dir, f".tmp-{os.getpid()}-{threading.get_ident()}")
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            np.save(os.path.join(tmp_dir, "embeddings.npy"), np.ascontiguousarray(segment.embeddings))
+            with open(os.path.join(tmp_dir, "items.pkl"), 'wb') as f:
+                pickle.dump(segment.items, f)
+            try:
+                os.rename(tmp_dir, os.path.join(pack_dir, version))
+            except OSError:
+                # 其他进程已经发布了同一个版本
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self._write_version(model_name, pack_id, version)
+        self._remove_old_versions(pack_dir, version)
+        logger.info(f"已发布共享索引 {pack_id} ({model_name}) 版本 {version}")
+        return True
+
+    def _write_version(self, model_name: str, pack_id: str, version: str) -> None:
+        version_file = os.path.join(self._pack_dir(model_name, pack_id), VERSION_FILE)
+        tmp_file = f"{version_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(version)
+        os.replace(tmp_file, version_file)
+
+    def _map(self, model_name: str, pack_id: str, version: str) -> PackSegment:
+        version_dir = os.path.join(self._pack_dir(model_name, pack_id), version)
+        # 只有向量是共享的，元数据在每个进程中各有一份
+        with open(os.path.join(version_dir, "items.pkl"), 'rb') as f:
+            items = pickle.load(f)
+        if items:
+            embeddings = np.load(os.path.join(version_dir, "embeddings.npy"), mmap_mode='r')
+        else:
+            # 空文件不能映射
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+        return PackSegment(pack_id, model_name, items, embeddings=embeddings, version=version)
+
+    @staticmethod
+    def _remove_old_versions(pack_dir: str, current: str) -> None:
+        versions = sorted((d for d in os.listdir(pack_dir)
+                           if d != current and not d.startswith('.') and d != VERSION_FILE
+                           and os.path.isdir(os.path.join(pack_dir, d))),
+                          key=lambda d: os.path.getmtime(os.path.join(pack_dir, d)))
+        for d in versions[:max(0, len(versions) - (_KEEP_VERSIONS - 1))]:
+            # 已经映射的文件在Linux上删除后仍然可用；Windows上删除失败时留到下次
+            shutil.rmtree(os.path.join(pack_dir, d), ignore_errors=True)
@@ -0,0 +1,128 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageSequence
+
+from config.settings import Config
+from services.hash_service import HASH_SERVICE
+from services.zip_pack import open_pack_file, read_pack_file, split_zip_path
+from base import *
+
+
+def _render_thumbnails(image_path: str, targets: List[Tuple[int, str]], quality: int) -> int:
+    """
+    在子进程中运行：读取一次原图，按从大到小的顺序生成各个尺寸的WebP缩略图。
+    动图保留动画，每一帧单独缩放。
+    :param targets: [(尺寸, 输出路径), ...]
+    :return: 生成的数量
+    """
+    count = 0
+    with open_pack_file(image_path) as f, Image.open(f) as img:
+        animated = getattr(img, "is_animated", False)
+        if animated:
+            frames = [frame.convert("RGBA") for frame in ImageSequence.Iterator(img)]
+            duration = img.info.get("duration", 100)
+        else:
+            frames = [img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")]
+        for size, output_path in sorted(targets, reverse=True):
+            resized = []
+            for frame in frames:
+                frame = frame.copy()
+                frame.thumbnail((size, size), Image.Resampling.LANCZOS)
+                resized.append(frame)
+            # 缩小后的帧可以作为更小尺寸的输入，减少计算量
+            frames = resized
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            tmp_path = f"{output_path}.{os.getpid()}.tmp"
+            if animated:
+                resized[0].save(tmp_path, format="WEBP", quality=quality, save_all=True,
+                                append_images=resized[1:], duration=duration, loop=0)
+            else:
+                resized[0].save(tmp_path, format="WEBP", quality=quality)
+            os.replace(tmp_path, output_path)
+            count += 1
+    return count
+
+
+class ThumbnailService:
+    """
+    图片缩略图。
+    每个图片按内容hash生成几个固定尺寸的WebP缩略图，保存在资源包缓存旁边的目录中，
+    内容变化后hash不同，旧的缩略图自然失效。
+    生成缓存时在进程池中批量生成，搜索结果和页面中缺少的缩略图按需生成。
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        config = Config().thumbnail
+        self.root = root or Config().thumbnail_cache_dir
+        self.sizes = sorted(config.sizes)
+        self.quality = config.quality
+        self.max_workers = config.max_workers or os.cpu_count() or 1
+
+    def pick_size(self, size: int) -> int:
+        """选择不小于请求尺寸的最小固定尺寸，请求的尺寸超过所有固定尺寸时使用最大的"""
+        for s in self.sizes:
+            if s >= size:
+                return s
+        return self.sizes[-1]
+
+    def thumbnail_path(self, file_hash: str, size: int) -> str:
+        return os.path.join(self.root, file_hash[:2], f"{file_hash}_{size}.webp")
+
+    def get_thumbnail(self, image_path: str, size: int, file_hash: Optional[str] = None) -> str:
+        """获取图片的缩略图路径，不存在时立即生成；生成失败时返回原图路径"""
+        try:
+            file_hash = file_hash or self._hash_image(image_path)
+            if not file_hash:
+                return image_path
+            size = self.pick_size(size)
+            thumbnail_path = self.thumbnail_path(file_hash, size)
+            if not os.path.exists(thumbnail_path):
+                _render_thumbnails(image_path, [(size, thumbnail_path)], self.quality)
+            return thumbnail_path
+        except Exception as e:
+            logger.warning(f"生成缩略图失败 {image_path}: {e}")
+            return image_path
+
+    def generate_for_packs(self, packs: Dict[str, Dict],
+                           progress_callback: Optional[Callable[[int, int], None]] = None) -> int:
+        """在进程池中为资源包中所有带hash的图片生成缺少的缩略图，返回处理的图片数量"""
+        jobs = []
+        for pack_info in packs.values():
+            for file_info in pack_info["manifest"].get("contents", {}).get("images", {}).get("files", {}).values():
+                file_hash = file_info.get("hash")
+                if not file_hash:
+                    continue
+                targets = [(s, self.thumbnail_path(file_hash, s)) for s in self.sizes]
+                targets = [t for t in targets if not os.path.exists(t[1])]
+                if targets:
+                    jobs.append((os.path.join(pack_info["pack_dir"], file_info["filepath"]), targets))
+        if not jobs:
+            return 0
+
+        done = 0
+        with ProcessPoolExecutor(max_workers=min(self.max_workers, len(jobs))) as executor:
+            futures = {executor.submit(_render_thumbnails, path, targets, self.quality): path
+                       for path, targets in jobs}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # 远程资源包中还没有下载的图片等，之后按需生成
+                    logger.debug(f"生成缩略图失败 {futures[future]}: {e}")
+                done += 1
+                if progress_callback is not None:
+                    progress_callback(done, len(jobs))
+        logger.info(f"已为 {len(jobs)} 个图片生成缩略图")
+        return len(jobs)
+
+    @staticmethod
+    def _hash_image(image_path: str) -> Optional[str]:
+        if split_zip_path(image_path) is None:
+            return HASH_SERVICE.hash_file(image_path)
+        return hashlib.sha256(read_pack_file(image_path)).hexdigest()
+
+
+THUMBNAIL_SERVICE = ThumbnailService()
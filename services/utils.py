@@ -1,4 +1,5 @@
 import hashlib
+import mmap
 import os
 import sys
 import threading
@@ -9,14 +10,19 @@ import random
 from typing import List, Optional, Union
 import numpy as np
 import cv2
+from services.zip_pack import open_pack_file
 from base import *
 
 
 
 
+# 小于这个大小的文件一次性读入，更大的文件使用mmap，避免大量小块读取的系统调用开销
+_HASH_MMAP_THRESHOLD = 1024 * 1024
+
+
 def get_file_hash(file_path, algorithm='sha256'):
     """
-    该函数用于计算文件的哈希值
+    该函数用于计算文件的哈希值。需要缓存结果时使用services.hash_service.HASH_SERVICE
     :param file_path: 文件的路径
     :param algorithm: 哈希算法，默认为 sha256
     :return: 文件的哈希值
@@ -26,10 +32,13 @@ def get_file_hash(file_path, algorithm='sha256'):
     try:
         # 以二进制模式打开文件
         with open(file_path, 'rb') as file:
-            # 分块读取文件内容，避免大文件占用过多内存
-            for chunk in iter(lambda: file.read(4096), b""):
-                # 更新哈希对象的内容
-                hash_object.update(chunk)
+            size = os.fstat(file.fileno()).st_size
+            if size < _HASH_MMAP_THRESHOLD:
+                hash_object.update(file.read())
+            else:
+                # hashlib在处理大块数据时会释放GIL，多线程计算不同文件的hash可以并行
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    hash_object.update(mm)
         # 获取最终的哈希值
         return hash_object.hexdigest()
     except FileNotFoundError:
@@ -41,8 +50,8 @@ import base64
 from io import BytesIO
 def image_to_base64_jpg(image_path):
     try:
-        # 打开图像文件
-        with Image.open(image_path) as img:
+        # 打开图像文件，支持zip资源包中的图片
+        with open_pack_file(image_path) as f, Image.open(f) as img:
             img = img.convert('RGB')
             # 创建一个内存缓冲区
             buffer = BytesIO()
@@ -60,8 +69,8 @@ def image_to_base64_jpg(image_path):
 def load_image(image_path) -> np.ndarray:
     # opencv不能打开含有中文路径的图片和gif图，一定要用PIL
     try:
-        # 打开图像文件
-        with Image.open(image_path) as img:
+        # 打开图像文件，支持zip资源包中的图片
+        with open_pack_file(image_path) as f, Image.open(f) as img:
             img = img.convert('RGB')
             npimg = np.array(img)
             img.close()
@@ -124,9 +133,11 @@ def download_file(url, save_path, ignore_ssl=True):
         response = requests.get(url, verify=not ignore_ssl)
         # 检查响应状态码
         response.raise_for_status()
-        # 将文件内容写入指定路径
-        with open(save_path, 'wb') as file:
+        # 先写入临时文件再替换，读取方不会看到不完整的文件
+        tmp_path = f"{save_path}.{threading.get_ident()}.part"
+        with open(tmp_path, 'wb') as file:
             file.write(response.content)
+        os.replace(tmp_path, save_path)
         return True
     except requests.RequestException as e:
         print(f"下载文件时发生错误: {e}")
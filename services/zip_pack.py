@@ -0,0 +1,169 @@
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+import zipfile
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+
+from base import *
+
+# zip本地文件头：固定30字节，文件名长度和扩展字段长度位于第26、28字节
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+
+class ZipPackReader:
+    """
+    直接从zip读取资源包内容，不需要解压。
+    打开时只读取一次中央目录建立索引；STORED成员通过mmap按偏移返回，不复制数据，
+    压缩过的成员（如manifest）才需要解压。
+    """
+
+    def __init__(self, zip_path: str):
+        self.zip_path = zip_path
+        st = os.stat(zip_path)
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self._zf = zipfile.ZipFile(zip_path)
+        self._members: Dict[str, zipfile.ZipInfo] = {
+            info.filename: info for info in self._zf.infolist() if not info.is_dir()
+        }
+        self._data_offsets: Dict[str, int] = {}
+        self._file = open(zip_path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self._lock = threading.Lock()
+
+    def namelist(self):
+        return list(self._members)
+
+    def exists(self, member: str) -> bool:
+        return _normalize_member(member) in self._members
+
+    def getinfo(self, member: str) -> zipfile.ZipInfo:
+        return self._members[_normalize_member(member)]
+
+    def read(self, member: str) -> Union[bytes, memoryview]:
+        """读取成员内容；STORED成员返回指向mmap的memoryview（零拷贝）"""
+        info = self.getinfo(member)
+        if info.compress_type == zipfile.ZIP_STORED and self._mm is not None:
+            offset = self._data_offset(info)
+            return memoryview(self._mm)[offset:offset + info.file_size]
+        # zipfile的读取不是线程安全的
+        with self._lock:
+            return self._zf.read(info)
+
+    def open(self, member: str) -> BinaryIO:
+        """以文件对象的形式读取成员，供PIL等需要文件对象的库使用"""
+        return io.BytesIO(self.read(member))
+
+    def read_json(self, member: str):
+        return json.loads(bytes(self.read(member)).decode('utf-8'))
+
+    def close(self) -> None:
+        mm, self._mm = self._mm, None
+        if mm is not None:
+            try:
+                mm.close()
+            except BufferError:
+                # read()返回的memoryview还在使用，最后一个视图释放后由垃圾回收解除映射
+                pass
+        self._file.close()
+        self._zf.close()
+
+    def _data_offset(self, info: zipfile.ZipInfo) -> int:
+        """根据本地文件头计算成员数据的起始位置"""
+        offset = self._data_offsets.get(info.filename)
+        if offset is None:
+            header = self._mm[info.header_offset:info.header_offset + _LOCAL_HEADER_SIZE]
+            if header[:4] != _LOCAL_HEADER_SIGNATURE:
+                raise zipfile.BadZipFile(f"无效的本地文件头: {info.filename}")
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            offset = info.header_offset + _LOCAL_HEADER_SIZE + name_len + extra_len
+            self._data_offsets[info.filename] = offset
+        return offset
+
+
+_readers: Dict[str, ZipPackReader] = {}
+_readers_lock = threading.Lock()
+
+
+def get_zip_reader(zip_path: str) -> ZipPackReader:
+    """获取zip的读取器，同一个zip只建立一次索引；文件变化后重新建立"""
+    zip_path = os.path.abspath(zip_path)
+    with _readers_lock:
+        reader = _readers.get(zip_path)
+        st = os.stat(zip_path)
+        if reader is None or reader.mtime_ns != st.st_mtime_ns or reader.size != st.st_size:
+            if reader is not None:
+                reader.close()
+            reader = ZipPackReader(zip_path)
+            _readers[zip_path] = reader
+        return reader
+
+
+def close_zip_reader(zip_path: str) -> None:
+    """关闭zip的读取器（删除或替换zip之前调用）"""
+    with _readers_lock:
+        reader = _readers.pop(os.path.abspath(zip_path), None)
+    if reader is not None:
+        reader.close()
+
+
+def is_zip_pack(pack_dir: str) -> bool:
+    return pack_dir.lower().endswith('.zip') and os.path.isfile(pack_dir)
+
+
+def split_zip_path(path: str) -> Optional[Tuple[str, str]]:
+    """
+    zip资源包中的图片使用虚拟路径 <zip路径>/<成员名>，例如 resource_packs/foo.zip/images/a.png
+    :return: (zip路径, 成员名)，普通文件路径返回None
+    """
+    normalized = path.replace('\\', '/')
+    index = normalized.lower().find('.zip/')
+    if index < 0:
+        return None
+    zip_path = path[:index + 4]
+    if not os.path.isfile(zip_path):
+        return None
+    return zip_path, normalized[index + 5:]
+
+
+def pack_file_exists(path: str) -> bool:
+    """检查资源包中的文件是否存在，支持普通路径和zip虚拟路径"""
+    parts = split_zip_path(path)
+    if parts is None:
+        return os.path.exists(path)
+    try:
+        return get_zip_reader(parts[0]).exists(parts[1])
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+def read_pack_file(path: str) -> Union[bytes, memoryview]:
+    """读取资源包中的文件内容，支持普通路径和zip虚拟路径"""
+    parts = split_zip_path(path)
+    if parts is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    return get_zip_reader(parts[0]).read(parts[1])
+
+
+def open_pack_file(path: str) -> BinaryIO:
+    """以文件对象的形式打开资源包中的文件，支持普通路径和zip虚拟路径"""
+    parts = split_zip_path(path)
+    if parts is None:
+        return open(path, 'rb')
+    return get_zip_reader(parts[0]).open(parts[1])
+
+
+def pack_file_source(path: str) -> Union[str, bytes]:
+    """给st.image等接受路径或字节的接口使用：普通文件返回路径，zip中的文件返回字节"""
+    if split_zip_path(path) is None:
+        return path
+    return bytes(read_pack_file(path))
+
+
+def _normalize_member(member: str) -> str:
+    return member.replace('\\', '/').lstrip('/')
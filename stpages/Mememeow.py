@@ -4,6 +4,8 @@ import streamlit as st
 import random
 import yaml
 from services.image_search import IMAGE_SEARCH_SERVICE
+from services.thumbnail import THUMBNAIL_SERVICE
+from services.zip_pack import pack_file_source
 from config.settings import Config
 
 # 页面配置
@@ -194,7 +196,7 @@ if 'results' in st.session_state and st.session_state.results:
     cols = st.columns(3)
     for idx, img_path in enumerate(st.session_state.results):
         with cols[idx % 3]:
-            st.image(img_path)
+            st.image(pack_file_source(THUMBNAIL_SERVICE.get_thumbnail(img_path, 512)))
 elif st.session_state.search_query:
     st.info("未找到匹配的表情包")
 
@@ -16,6 +16,7 @@ from config.settings import Config
 from stpages.utils import *
 from services.label_memes import LabelMemes
 from services.resource_pack import ResourcePackService
+from services.thumbnail import THUMBNAIL_SERVICE
 
 COVERS_DIR = os.path.join(Config().get_temp_path('covers'))
 # 封面图片尺寸
@@ -189,21 +190,27 @@ with st.sidebar:
                 tags = [tag.strip() for tag in pack_tags.split(",") if tag.strip()]
                 cover_path = st.session_state.cropped_cover_path if pack_cover else None
                 
-                # 创建资源包
-                pack_dir = ResourcePackService().create_resource_pack(
-                    name=pack_name,
-                    version=pack_version,
-                    author=pack_author,
-                    description=pack_description,
-                    image_paths=st.session_state.all_images_path,
-                    cover_image=cover_path,
-                    tags=tags
-                )
-                    
-                # 生成zip文件
+                # 创建资源包，边计算hash边写入zip
+                export_progress = st.progress(0.0, text="正在打包图片...")
+
+                def on_export_progress(event):
+                    if event["total"] and event["stage"] == "write":
+                        export_progress.progress(event["done"] / event["total"],
+                                                 text=f"正在打包图片 {event['done']}/{event['total']}")
+
                 try:
-                    zip_path = ResourcePackService().export_resource_pack(pack_dir)
-                    
+                    zip_path = ResourcePackService().build_resource_pack_zip(
+                        name=pack_name,
+                        version=pack_version,
+                        author=pack_author,
+                        description=pack_description,
+                        image_paths=st.session_state.all_images_path,
+                        cover_image=cover_path,
+                        tags=tags,
+                        progress_callback=on_export_progress
+                    )
+                    export_progress.empty()
+
                     # 提供zip文件下载
                     with open(zip_path, "rb") as f:
                         st.download_button(
@@ -218,8 +225,6 @@ with st.sidebar:
                 finally:
                     # 清理临时文件
                     try:
-                        if os.path.exists(pack_dir):
-                            shutil.rmtree(pack_dir)
                         if cover_path and os.path.exists(cover_path):
                             os.remove(cover_path)
                     except Exception as e:
@@ -378,7 +383,7 @@ if os.path.exists(st.session_state.image_folder_name):
         with st.container():
             col_img, col1, col2 = st.columns([1, 5, 1])
             with col_img:
-                st.image(img_path, width=128)
+                st.image(THUMBNAIL_SERVICE.get_thumbnail(img_path, 128), width=128)
             with col1:
                 filename = os.path.basename(img_path)
                 if original_idx == st.session_state.image_index:
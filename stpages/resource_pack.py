@@ -4,6 +4,7 @@ from config.settings import Config
 from services.resource_pack import RESOURCE_PACK_SERVICE
 from services.image_search import IMAGE_SEARCH_SERVICE
 from services.community_service import CommunityService
+from services.thumbnail import THUMBNAIL_SERVICE
 import requests
 import threading
 import asyncio
@@ -36,6 +37,20 @@ def on_disable_resource_pack(pack_id):
     else:
         st.error(f"禁用资源包失败")
 
+def on_delete_resource_pack(pack_id):
+    """删除资源包回调"""
+    if st.session_state.search_engine.delete_resource_pack(pack_id):
+        st.success(f"已删除资源包")
+        st.session_state.has_cache = st.session_state.search_engine.has_cache()
+    else:
+        st.error(f"删除资源包失败")
+
+def on_deduplicate_resource_packs():
+    """整理重复图片回调"""
+    with st.spinner('正在整理重复图片...'):
+        count = RESOURCE_PACK_SERVICE.deduplicate_resource_packs(st.session_state.search_engine.get_resource_packs())
+    st.success(f"已整理 {count} 个图片，相同的图片只保留一份")
+
 # """重新加载资源包回调"""
 st.session_state.search_engine.reload_resource_packs()
 st.success("已重新扫描资源包")
@@ -112,6 +127,14 @@ with left_col:
         use_container_width=True
     )
 
+    st.button(
+        "整理重复图片",
+        on_click=on_deduplicate_resource_packs,
+        help="不同资源包中相同的图片只保留一份，节省磁盘空间",
+        key="deduplicate_resource_packs_btn",
+        use_container_width=True
+    )
+
     # 显示缓存生成按钮
     if st.button(
             "重新生成缓存" if has_cache else "生成表情包缓存",
@@ -139,7 +162,7 @@ with left_col:
                     # 获取封面图片
                     cover_path = st.session_state.search_engine.get_resource_pack_cover(pack_id)
                     if cover_path:
-                        st.image(cover_path, width=64)
+                        st.image(THUMBNAIL_SERVICE.get_thumbnail(cover_path, 64), width=64)
                         
                     st.write(f"**{pack_info['name']}** v{pack_info['version']}")
                     st.caption(f"作者: {pack_info['author']}")
@@ -176,13 +199,24 @@ with left_col:
                             args=(pack_id,),
                             use_container_width=True
                         )
+                    if not pack_info.get('is_default', False):
+                        st.button(
+                            "删除",
+                            key=f"delete_{pack_id}",
+                            on_click=on_delete_resource_pack,
+                            args=(pack_id,),
+                            use_container_width=True
+                        )
                 
                 st.divider()
 
 with right_col:
     st.header("社区资源包组")
     if st.button("更新社区资源包组"):
-        CommunityService().update_local_manifests()
+        with st.spinner("正在同步社区资源包..."):
+            sync_results = CommunityService().update_local_manifests()
+        for uuid, summary in sync_results.items():
+            st.success(f"{uuid}: 新增 {summary['added']}，更新 {summary['changed']}，删除 {summary['removed']}")
     urls_config = Config().community.manifest_urls
     for k, v in urls_config.items():
         col1, col2, col3 = st.columns([3, 1, 1])
@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # fakeredis执行Lua脚本需要lupa
+
+from middleware import rate_limiter
+from middleware.rate_limiter import RedisRateLimiter
+
+
+class FakeClock:
+    """替换rate_limiter模块中的time，Lua脚本使用的时间戳和重试时间都由测试控制"""
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    @staticmethod
+    def sleep(seconds: float) -> None:
+        # 本地计数的清理线程
+        time.sleep(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def make_limiter(server, **kwargs) -> RedisRateLimiter:
+    client = fakeredis.aioredis.FakeRedis(server=server)
+    return RedisRateLimiter(client=client, retry_interval=5, **kwargs)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_sliding_window_limits_and_recovers(server, clock):
+    async def scenario():
+        limiter = make_limiter(server)
+        results = []
+        for _ in range(4):
+            results.append(await limiter.check("1.2.3.4", 3, 10))
+            clock.now += 1
+        # 第一个请求在10秒前，已经滑出窗口
+        clock.now += 6
+        results.append(await limiter.check("1.2.3.4", 3, 10))
+        # 其他客户端单独计数
+        results.append(await limiter.check("5.6.7.8", 3, 10))
+        return results
+
+    assert run(scenario()) == [True, True, True, False, True, True]
+
+
+def test_window_records_expire_with_pexpire(server, clock):
+    async def scenario():
+        limiter = make_limiter(server)
+        await limiter.check("1.2.3.4", 3, 10)
+        return await limiter.redis.pttl("ratelimit:1.2.3.4")
+
+    ttl = run(scenario())
+    assert 0 < ttl <= 10_000
+
+
+def test_members_are_unique_within_the_same_millisecond(server, clock):
+    async def scenario():
+        limiters = [make_limiter(server), make_limiter(server)]
+        for limiter in limiters:
+            for _ in range(3):
+                assert await limiter.check("1.2.3.4", 100, 10)
+        return await limiters[0].redis.zcard("ratelimit:1.2.3.4")
+
+    # 时间没有变化，成员仍然不会合并
+    assert run(scenario()) == 6
+
+
+def test_falls_back_to_local_counting_when_redis_is_down(server, clock):
+    async def scenario():
+        limiter = make_limiter(server)
+        server.connected = False
+        results = [await limiter.check("1.2.3.4", 2, 10) for _ in range(3)]
+        fallback_used = len(limiter.fallback)
+
+        # retry_interval之内不再尝试Redis
+        server.connected = True
+        clock.now += 1
+        results.append(await limiter.check("5.6.7.8", 2, 10))
+        in_redis_early = await limiter.redis.exists("ratelimit:5.6.7.8")
+
+        # 之后恢复使用Redis
+        clock.now += 5
+        results.append(await limiter.check("5.6.7.8", 2, 10))
+        in_redis_later = await limiter.redis.exists("ratelimit:5.6.7.8")
+        return results, fallback_used, in_redis_early, in_redis_later
+
+    results, fallback_used, in_redis_early, in_redis_later = run(scenario())
+    assert results == [True, True, False, True, True]
+    assert fallback_used == 1
+    assert in_redis_early == 0
+    assert in_redis_later == 1